@@ -28,6 +28,7 @@ default_task = ['clean', 'analyze', 'package']
 @init
 def set_properties(project):
     project.depends_on("boto3")
+    project.depends_on("futures")
     project.build_depends_on("moto")
     project.build_depends_on("unittest2")
     project.build_depends_on("mock")
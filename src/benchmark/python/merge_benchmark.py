@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark for StackUpdateParameter.merge().
+
+The stacks have the CloudFormation maximum of 60 parameters, the update
+sets range from a single parameter to large sets that mostly contain keys
+the stack does not know. Run from the project root:
+
+    python src/benchmark/python/merge_benchmark.py [repetitions]
+"""
+from __future__ import print_function
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.realpath(__file__)), '..', '..', 'main',
+    'python'))
+
+from crassus.deployer import StackUpdateParameter  # noqa: E402
+
+MAX_STACK_PARAMETERS = 60
+
+STACK_PARAMETERS = [
+    {'ParameterKey': 'Parameter{0}'.format(index),
+     'ParameterValue': 'value{0}'.format(index)}
+    for index in range(MAX_STACK_PARAMETERS)]
+
+
+def update_parameters(size, changed_ratio=0.5):
+    """
+    Return update parameters with size keys. The first keys exist in the
+    stack, changed_ratio of them with a new value, the rest are unknown.
+    """
+    parameters = {}
+    for index in range(size):
+        if index >= MAX_STACK_PARAMETERS:
+            parameters['Unknown{0}'.format(index)] = 'value'
+        elif index < MAX_STACK_PARAMETERS * changed_ratio:
+            parameters['Parameter{0}'.format(index)] = 'new{0}'.format(index)
+        else:
+            parameters['Parameter{0}'.format(index)] = 'value{0}'.format(
+                index)
+    return StackUpdateParameter({
+        'version': 1, 'stackName': 'benchmark', 'region': 'eu-west-1',
+        'parameters': parameters})
+
+
+def main(repetitions):
+    for size in [1, 10, 60, 500, 5000]:
+        sup = update_parameters(size)
+        timings = timeit.repeat(
+            lambda: sup.merge(STACK_PARAMETERS), number=repetitions,
+            repeat=3)
+        print('{0:>5} update keys: {1:8.2f} us per merge'.format(
+            size, min(timings) / repetitions * 1e6))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
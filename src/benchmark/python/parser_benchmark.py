@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark for parsing CloudFormation SNS messages in OutputConverter.
+
+Uses the recorded CloudFormation events of the unit test fixtures, and
+larger variants of them with a growing ResourceProperties value, which
+is the part of the message that varies the most in size. Run from the
+project root:
+
+    python src/benchmark/python/parser_benchmark.py [repetitions]
+"""
+from __future__ import print_function
+
+import json
+import os
+import sys
+import timeit
+
+BENCHMARK_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, '..', '..', 'main', 'python'))
+
+from crassus.output_converter import (  # noqa: E402
+    CONVERTED_KEYS, OutputConverter)
+
+FIXTURES_DIR = os.path.join(
+    BENCHMARK_DIR, '..', '..', 'unittest', 'python', 'fixtures')
+FIXTURES = ['cfn_event.json', 'cfn_event_different_termination.json']
+
+
+def recorded_messages():
+    for name in FIXTURES:
+        with open(os.path.join(FIXTURES_DIR, name)) as fp:
+            yield name, json.load(fp)['Records'][0]['Sns']['Message']
+
+
+def grown_message(message, property_count):
+    """
+    Return the message with property_count entries in the
+    ResourceProperties value.
+    """
+    properties = json.dumps(dict(
+        ('Property{0}'.format(index), 'value-{0}'.format(index))
+        for index in range(property_count)))
+    start = message.index("ResourceProperties='") + len(
+        "ResourceProperties='")
+    end = message.index("\n'\n", start)
+    return message[:start] + properties + message[end:]
+
+
+def messages():
+    for name, message in recorded_messages():
+        yield name, message
+    name, message = next(recorded_messages())
+    for property_count in [10, 100, 1000]:
+        yield ('{0} + {1} properties'.format(name, property_count),
+               grown_message(message, property_count))
+
+
+def main(repetitions):
+    converter = OutputConverter(None, None)
+    for name, message in messages():
+        print('{0} ({1} bytes)'.format(name, len(message)))
+        for label, keys in [('all keys', None),
+                            ('converted keys', CONVERTED_KEYS)]:
+            timings = timeit.repeat(
+                lambda: converter._parse_sns_message(message, keys),
+                number=repetitions, repeat=3)
+            print('    {0:<15} {1:9.2f} us per message'.format(
+                label, min(timings) / repetitions * 1e6))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measure the cold start import-to-handler time of both lambda entry points.
+
+Every sample imports the lambda script in a fresh interpreter, like a new
+lambda container does, and stops the clock when the handler function is
+resolved. Run from the project root:
+
+    python src/benchmark/python/startup_benchmark.py [samples]
+"""
+from __future__ import print_function
+
+import os
+import subprocess
+import sys
+
+ENTRY_POINTS = ['handler', 'cfn_output_converter']
+
+PROJECT_DIR = os.path.realpath(os.path.join(
+    os.path.dirname(os.path.realpath(__file__)), '..', '..', '..'))
+
+SAMPLE_SCRIPT = """
+import timeit
+start = timeit.default_timer()
+import crassus_deployer_lambda
+getattr(crassus_deployer_lambda, '{entry_point}')
+print(timeit.default_timer() - start)
+"""
+
+
+def measure(entry_point):
+    """
+    Return the import-to-handler time of one cold start in seconds.
+    """
+    environment = dict(os.environ)
+    environment.setdefault('AWS_DEFAULT_REGION', 'eu-west-1')
+    environment['PYTHONPATH'] = os.pathsep.join([
+        os.path.join(PROJECT_DIR, 'src', 'main', 'python'),
+        os.path.join(PROJECT_DIR, 'src', 'main', 'scripts')])
+    output = subprocess.check_output(
+        [sys.executable, '-c', SAMPLE_SCRIPT.format(entry_point=entry_point)],
+        env=environment)
+    return float(output.strip().splitlines()[-1])
+
+
+def main(samples):
+    for entry_point in ENTRY_POINTS:
+        timings = sorted(measure(entry_point) for _ in range(samples))
+        print('{0:<22} min {1:7.1f} ms  median {2:7.1f} ms  max {3:7.1f} ms'
+              .format(entry_point, timings[0] * 1000,
+                      timings[len(timings) // 2] * 1000,
+                      timings[-1] * 1000))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10)
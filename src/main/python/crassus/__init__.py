@@ -1,3 +1,4 @@
 from deployer import Crassus
+from batch_deployer import BatchDeployer
 
-__all__ = ['Crassus']
+__all__ = ['Crassus', 'BatchDeployer']
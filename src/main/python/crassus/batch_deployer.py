@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+
+from botocore.exceptions import ClientError
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from crassus.bulk import BulkStackUpdate, is_bulk_message
+from crassus.change_sets import wait_for_change_sets
+from crassus.dedup import DedupWindow
+from crassus.deployer import (
+    MESSAGE_UPDATE_PROBLEM, Crassus, StackUpdateParameter)
+from crassus.deployment_response import DeploymentResponse
+from crassus.metrics import PhaseTimer
+from crassus.result_publisher import BackgroundResultPublisher
+from crassus.utils import get_lambda_config, logger
+
+DEFAULT_MAX_WORKERS = 5
+
+# Seconds and number of (MessageId, stack name) pairs to remember for
+# dropping redelivered SNS messages
+DEDUP_TTL = 600
+DEDUP_MAX_SIZE = 10000
+
+_dedup_window = DedupWindow(DEDUP_TTL, DEDUP_MAX_SIZE)
+
+
+def _deploy(crassus):
+    """
+    Deploy a single stack update within a worker thread, up to the
+    creation of its change set in change set mode. Unexpected errors are
+    logged and notified as the failure of the update, so that they do
+    not abort the other deployments.
+
+    Return the emitted response and whether the update did not fail,
+    None for an update whose change set still has to be finished.
+    """
+    try:
+        response = crassus.deploy(finish_change_set=False)
+    except Exception as error:
+        logger.exception(
+            'Unexpected error while deploying stack {0}'
+            .format(crassus.stack_name))
+        return _failure(crassus, error)
+    if crassus.change_set is not None:
+        return None
+    return _result(crassus, response)
+
+
+def _finish_change_set(crassus):
+    """
+    Finish the change set of a single stack update within a worker
+    thread, like _deploy().
+    """
+    try:
+        response = crassus.finish_change_set()
+    except Exception as error:
+        logger.exception(
+            'Unexpected error while executing the change set of stack {0}'
+            .format(crassus.stack_name))
+        return _failure(crassus, error)
+    return _result(crassus, response)
+
+
+def _failure(crassus, error):
+    """
+    Notify the unexpected error as the failure of the update, so that
+    the sender learns about it, and return like _result().
+    """
+    try:
+        crassus.notify(
+            DeploymentResponse.STATUS_FAILURE,
+            MESSAGE_UPDATE_PROBLEM.format(
+                stack_name=crassus.stack_name, message=error))
+    except Exception:
+        logger.exception(
+            'Unable to notify the failure of stack {0}'
+            .format(crassus.stack_name))
+        return None, False
+    return crassus.response, False
+
+
+def _result(crassus, response):
+    """
+    Return the response and whether the update did not fail, and
+    remember the messages of the update as seen if it did not.
+    """
+    if crassus.status in (DeploymentResponse.STATUS_FAILURE,
+                          DeploymentResponse.STATUS_PENDING):
+        return response, False
+    # Only messages that were handled count as seen, so that a retry
+    # after a failure, crash or timeout, or of a pending update, is not
+    # dropped.
+    for message_id in crassus.stack_update_parameters.message_ids:
+        _dedup_window.add((message_id, crassus.stack_name))
+    return response, True
+
+
+class BatchDeployer(object):
+
+    """
+    Deploy all stack update messages of a received event within one
+    invocation.
+
+    SNS may deliver more than one record per event, every record is
+    turned into its own StackUpdateParameter. Messages that were already
+    deployed by this container are dropped, all updates for the same
+    stack are coalesced into one, with the last value of each parameter
+    winning. Every remaining update is deployed by its own Crassus
+    instance, which emits a DeploymentResponse for it.
+
+    The notifications are sent in batches by a BackgroundResultPublisher
+    while the deployment goes on, and drained before the invocation
+    times out.
+
+    Every update is sent to the CloudFormation endpoint of the region
+    named in its message, the updates are deployed grouped by region.
+
+    Independent stacks are loaded and updated concurrently by a bounded
+    pool of worker threads. The pool size can be passed as max_workers,
+    or set with the 'max_workers' property in the JSON description of
+    the lambda function, it defaults to DEFAULT_MAX_WORKERS. In change
+    set mode, the workers only create the change sets, all of them are
+    then polled together, before the workers execute the ones with
+    changes.
+
+    A version 2 message updates many stacks at once, it is turned into
+    a BulkStackUpdate, whose selected stacks are deployed like the other
+    updates. A summary of their outcome is sent to the result queues in
+    addition to the responses of the single stacks.
+
+    The records may also come from an SQS queue. The IDs of the messages
+    whose update failed are kept in failed_message_ids, and reported by
+    batch_item_failures(), so that only these are received again. Only
+    then an update whose stack stays busy can be pending, with
+    pending_busy_updates. Otherwise it fails, SNS does not retry a
+    successful invocation.
+    """
+
+    def __init__(self, event, context, max_workers=None,
+                 pending_busy_updates=False):
+        self.event = event
+        self.context = context
+        self._max_workers = max_workers
+        self.pending_busy_updates = pending_busy_updates
+        self.failed_message_ids = []
+        self.bulk_updates = []
+        # StackUpdateParameter.key -> status of its update
+        self.statuses = {}
+
+    @property
+    def max_workers(self):
+        if self._max_workers is None:
+            config = get_lambda_config(self.context) or {}
+            self._max_workers = max(
+                1, int(config.get('max_workers', DEFAULT_MAX_WORKERS)))
+        return self._max_workers
+
+    def parse_records(self):
+        """
+        Return the list of StackUpdateParameter objects for all records
+        in the event, bulk messages contribute one for each stack they
+        select. Records that can not be parsed are logged and skipped, so
+        that they do not hinder the deployment of the others.
+        """
+        stack_update_parameters_list = []
+        self.bulk_updates = []
+        for record in self.event.get('Records', []):
+            try:
+                message, message_id = StackUpdateParameter.decode_record(
+                    record)
+                if is_bulk_message(message):
+                    self.bulk_updates.append(
+                        BulkStackUpdate(message, message_id))
+                else:
+                    stack_update_parameters_list.append(
+                        StackUpdateParameter.from_message(
+                            message, message_id))
+            except (KeyError, TypeError, ValueError) as error:
+                logger.error(
+                    'Unable to parse stack update message from record '
+                    '{0}: {1}'.format(repr(record), repr(error)))
+        for bulk_update in self.bulk_updates:
+            stack_update_parameters_list.extend(self.select(bulk_update))
+        return stack_update_parameters_list
+
+    def select(self, bulk_update):
+        """
+        Return the StackUpdateParameter objects for the stacks selected
+        by the bulk update, none if they can not be selected.
+        """
+        crassus = Crassus(self.event, self.context,
+                          bulk_update.stack_update_parameters(None))
+        try:
+            stack_update_parameters_list = bulk_update.select(crassus)
+        except ClientError as error:
+            logger.error('Unable to select the stacks {0}: {1}'.format(
+                bulk_update.selector, error.message))
+            bulk_update.error = error.message
+            return []
+        logger.info('Selected {0} stacks with {1}'.format(
+            len(stack_update_parameters_list), bulk_update.selector))
+        return stack_update_parameters_list
+
+    def pending_updates(self):
+        """
+        Return the coalesced stack updates of the event, without the
+        messages that were already seen within the dedup window.
+        """
+        stack_update_parameters_list = []
+        for stack_update_parameters in self.parse_records():
+            if any((message_id, stack_update_parameters.stack_name)
+                   in _dedup_window
+                   for message_id in stack_update_parameters.message_ids):
+                logger.info(
+                    'Dropping redelivered message {0} for stack {1}'.format(
+                        stack_update_parameters.message_ids,
+                        stack_update_parameters.stack_name))
+                continue
+            stack_update_parameters_list.append(stack_update_parameters)
+        coalesced = StackUpdateParameter.coalesce(
+            stack_update_parameters_list)
+        if len(coalesced) < len(stack_update_parameters_list):
+            logger.info('Coalesced {0} stack updates into {1}'.format(
+                len(stack_update_parameters_list), len(coalesced)))
+        return coalesced
+
+    def deploy(self):
+        """
+        Deploy every parsed stack update, return the list of emitted
+        DeploymentResponse objects, grouped by region and in the order of
+        the records within a region, followed by the summaries of the
+        bulk updates.
+        """
+        timer = PhaseTimer()
+        with BackgroundResultPublisher(context=self.context) as publisher:
+            with timer.phase('parse'):
+                pending_updates = self.pending_updates()
+            with timer.phase('deploy'):
+                responses = self._deploy_all(pending_updates, publisher)
+            with timer.phase('publish'):
+                responses.extend(self.publish_summaries(publisher))
+                publisher.flush()
+        timer.emit('batch', Updates=len(pending_updates))
+        return responses
+
+    def _deploy_all(self, pending_updates, publisher):
+        crassus_list = [
+            Crassus(self.event, self.context, stack_update_parameters,
+                    publisher, self.pending_busy_updates)
+            for stack_update_parameters in pending_updates]
+        if not crassus_list:
+            return []
+        # Deploy grouped by region, so that the workers share the
+        # connections to one regional endpoint at a time.
+        crassus_list.sort(key=lambda crassus: crassus.region or '')
+        max_workers = min(self.max_workers, len(crassus_list))
+        logger.debug('Deploying {0} stack updates with {1} workers'.format(
+            len(crassus_list), max_workers))
+        if max_workers == 1:
+            results = self._run(map, crassus_list)
+        else:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                results = self._run(
+                    lambda function, items: list(
+                        executor.map(function, items)),
+                    crassus_list)
+        self.failed_message_ids = [
+            message_id
+            for crassus, (_, succeeded) in zip(crassus_list, results)
+            if not succeeded
+            for message_id in crassus.stack_update_parameters.message_ids]
+        self.statuses = dict(
+            (crassus.stack_update_parameters.key, crassus.status)
+            for crassus in crassus_list)
+        return [response for response, _ in results if response is not None]
+
+    def _run(self, map_function, crassus_list):
+        """
+        Deploy with the map function, then wait for the created change
+        sets and finish them. Return the results in the order of the
+        list.
+        """
+        results = map_function(_deploy, crassus_list)
+        open_crassus_list = [
+            crassus for crassus, result in zip(crassus_list, results)
+            if result is None]
+        if not open_crassus_list:
+            return results
+        logger.debug('Waiting for {0} change sets'.format(
+            len(open_crassus_list)))
+        wait_for_change_sets(
+            [crassus.change_set for crassus in open_crassus_list],
+            self.context)
+        finished = iter(map_function(_finish_change_set, open_crassus_list))
+        return [next(finished) if result is None else result
+                for result in results]
+
+    def publish_summaries(self, publisher):
+        """
+        Publish the summary of every bulk update to the result queues and
+        return them. Bulk updates whose stacks could not be selected
+        count as failed messages.
+        """
+        summaries = [bulk_update.summary(self.statuses)
+                     for bulk_update in self.bulk_updates]
+        if not summaries:
+            return []
+        for bulk_update in self.bulk_updates:
+            if bulk_update.error is not None:
+                self.failed_message_ids.extend(bulk_update.message_ids)
+        output_topics = (get_lambda_config(self.context) or {}).get(
+            'result_queue')
+        if output_topics:
+            for summary in summaries:
+                publisher.publish(output_topics, summary)
+        return summaries
+
+    def batch_item_failures(self):
+        """
+        Return the partial batch response of an SQS invocation, with the
+        messages whose update failed in the last deploy(). A bulk message
+        is reported once, however many of its stacks failed.
+        """
+        return {'batchItemFailures': [
+            {'itemIdentifier': message_id}
+            for message_id in OrderedDict.fromkeys(self.failed_message_ids)]}
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+from collections import Counter
+
+from crassus.deployer import StackUpdateParameter
+from crassus.deployment_response import DeploymentResponse
+from dateutil import tz
+
+BULK_VERSION = '2'
+# Exactly one of them selects the stacks of a bulk message
+SELECTOR_KEYS = ('stackNames', 'stackNamePrefix', 'stackTags')
+SELECTOR_TYPES = {
+    'stackNames': list, 'stackNamePrefix': basestring, 'stackTags': dict}
+# Stacks that were never created successfully, or are being deleted
+NOT_UPDATABLE_STATUSES = frozenset([
+    'CREATE_FAILED', 'ROLLBACK_IN_PROGRESS', 'ROLLBACK_FAILED',
+    'ROLLBACK_COMPLETE', 'DELETE_IN_PROGRESS', 'DELETE_FAILED'])
+
+MESSAGE_BULK_SUMMARY = 'Updated {count} stacks: {statuses}'
+MESSAGE_BULK_NO_STACKS = 'No stacks matched {selector}'
+MESSAGE_BULK_SELECT_PROBLEM = 'Unable to select the stacks {selector}: ' \
+    '{message}'
+
+
+def is_bulk_message(message):
+    """
+    Whether the decoded message is a version 2 message, which updates
+    many stacks at once.
+    """
+    return str(message.get('version', '')).split('.')[0] == BULK_VERSION
+
+
+class BulkStackUpdate(object):
+
+    """
+    A version 2 message, which applies the same parameters to many
+    stacks of one account and region. The stacks are selected by exactly
+    one of:
+    - stackNames: a list of stack names
+    - stackNamePrefix: all stacks whose name starts with the prefix
+    - stackTags: all stacks that have all of the tags, e.g.
+      {"team": "search"}
+
+    Stacks selected by prefix or tags are found by paginated
+    DescribeStacks calls, stacks that can not be updated, e.g.
+    ROLLBACK_COMPLETE, are left out. Every selected stack is updated like
+    a single stack message, summary() then aggregates their outcome into
+    one DeploymentResponse.
+    """
+
+    def __init__(self, message, message_id=None):
+        selector_keys = [key for key in SELECTOR_KEYS if message.get(key)]
+        if len(selector_keys) != 1:
+            raise ValueError('A bulk message needs exactly one of {0}'.format(
+                ', '.join(SELECTOR_KEYS)))
+        selector_key = selector_keys[0]
+        if not isinstance(message[selector_key],
+                          SELECTOR_TYPES[selector_key]):
+            raise TypeError('Invalid {0}: {1!r}'.format(
+                selector_key, message[selector_key]))
+        self.version = message['version']
+        self.region = message['region']
+        self.role_arn = message.get('roleArn')
+        self.account_id = message.get('accountId')
+        self.parameters = dict(message['parameters'])
+        self.selector = {selector_key: message[selector_key]}
+        self.message_ids = [] if message_id is None else [message_id]
+        # Names of the selected stacks, set by select()
+        self.stack_names = []
+        # Why the stacks could not be selected, if they could not
+        self.error = None
+
+    def stack_update_parameters(self, stack_name):
+        """
+        Return the StackUpdateParameter of the message for one stack.
+        """
+        stack_update_parameters = StackUpdateParameter({
+            'version': self.version,
+            'stackName': stack_name,
+            'region': self.region,
+            'roleArn': self.role_arn,
+            'accountId': self.account_id,
+            'parameters': self.parameters})
+        stack_update_parameters.message_ids.extend(self.message_ids)
+        return stack_update_parameters
+
+    def matches(self, stack):
+        """
+        Whether the described stack is selected by the prefix or the
+        tags of the message.
+        """
+        if stack.get('StackStatus') in NOT_UPDATABLE_STATUSES:
+            return False
+        prefix = self.selector.get('stackNamePrefix')
+        if prefix is not None:
+            return stack['StackName'].startswith(prefix)
+        tags = dict((tag['Key'], tag['Value'])
+                    for tag in stack.get('Tags') or [])
+        return all(tags.get(key) == value
+                   for key, value in self.selector['stackTags'].items())
+
+    def select(self, crassus):
+        """
+        Select the stacks, with the account and region of the Crassus
+        instance, and return a StackUpdateParameter for each of them.
+        """
+        if 'stackNames' in self.selector:
+            self.stack_names = list(self.selector['stackNames'])
+        else:
+            self.stack_names = [
+                stack['StackName']
+                for stack in crassus.describe_stacks(self.matches)]
+        return [self.stack_update_parameters(stack_name)
+                for stack_name in self.stack_names]
+
+    def summary(self, statuses):
+        """
+        Return the DeploymentResponse that aggregates the statuses of the
+        updated stacks, a dictionary from StackUpdateParameter.key to the
+        status of its update. The response carries the selector, and the
+        stackName and status of every stack in 'stacks'.
+
+        The summary fails if any stack update failed, it is pending if
+        any is pending, in progress if any is still in progress,
+        unchanged if all are unchanged.
+        """
+        stacks = []
+        for stack_name in self.stack_names:
+            key = self.stack_update_parameters(stack_name).key
+            if key in statuses:
+                stacks.append({
+                    'stackName': stack_name,
+                    'status': (statuses[key] or
+                               DeploymentResponse.STATUS_FAILURE)})
+        counts = Counter(stack['status'] for stack in stacks)
+        if self.error is not None:
+            status = DeploymentResponse.STATUS_FAILURE
+            message = MESSAGE_BULK_SELECT_PROBLEM.format(
+                selector=self.selector, message=self.error)
+        elif not stacks:
+            status = DeploymentResponse.STATUS_UNCHANGED
+            message = MESSAGE_BULK_NO_STACKS.format(selector=self.selector)
+        else:
+            if DeploymentResponse.STATUS_FAILURE in counts:
+                status = DeploymentResponse.STATUS_FAILURE
+            elif DeploymentResponse.STATUS_PENDING in counts:
+                status = DeploymentResponse.STATUS_PENDING
+            elif DeploymentResponse.STATUS_IN_PROGRESS in counts:
+                status = DeploymentResponse.STATUS_IN_PROGRESS
+            elif counts.keys() == [DeploymentResponse.STATUS_UNCHANGED]:
+                status = DeploymentResponse.STATUS_UNCHANGED
+            else:
+                status = DeploymentResponse.STATUS_SUCCESS
+            message = MESSAGE_BULK_SUMMARY.format(
+                count=len(stacks),
+                statuses=', '.join(
+                    '{0} {1}'.format(count, stack_status)
+                    for stack_status, count in sorted(counts.items())))
+        timestamp_str = datetime.datetime.now(tz=tz.tzutc()).isoformat()
+        return DeploymentResponse(
+            status, message, None, timestamp_str,
+            DeploymentResponse.EMITTER_CRASSUS,
+            selector=self.selector, stacks=stacks)
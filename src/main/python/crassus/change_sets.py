@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+import time
+import uuid
+
+from botocore.exceptions import ClientError
+from crassus.polling import PollInterval, call, remaining_time
+from crassus.throttling import RateLimitTimeout
+from crassus.utils import logger
+
+CHANGE_SET_PREFIX = 'crassus-'
+CHANGE_SET_CREATE_COMPLETE = 'CREATE_COMPLETE'
+CHANGE_SET_FAILED = 'FAILED'
+# Status reasons of change sets that were not created for lack of changes
+CHANGE_SET_NO_CHANGES = (
+    "didn't contain changes", 'No updates are to be performed')
+# Values of the Replacement of a resource change that replace a resource
+REPLACEMENTS = frozenset(['True', 'Conditional'])
+
+# Seconds between two polls, the interval grows while no change set is
+# ready
+MIN_POLL_INTERVAL = 1.0
+MAX_POLL_INTERVAL = 10.0
+# Seconds of the invocation that are kept for executing the change sets
+WAIT_MARGIN = 10.0
+
+
+class ChangeSet(object):
+
+    """
+    A change set that updates a stack. create() starts the creation,
+    poll() reads its status until it is final, i.e. CREATE_COMPLETE or
+    FAILED. CloudFormation fails the creation of change sets without any
+    change, is_empty tells these apart.
+
+    The API calls are made through the caller, e.g. a ThrottledCaller.
+    """
+
+    def __init__(self, client, stack_name, caller=call):
+        self.client = client
+        self.stack_name = stack_name
+        self.caller = caller
+        self.name = CHANGE_SET_PREFIX + uuid.uuid4().hex
+        self.change_set_id = None
+        self.status = None
+        self.status_reason = None
+        self.changes = []
+
+    def create(self, **arguments):
+        """
+        Create the change set with the arguments of an UpdateStack call.
+        """
+        self.change_set_id = self.caller(
+            self.client.create_change_set, StackName=self.stack_name,
+            ChangeSetName=self.name, **arguments)['Id']
+
+    def poll(self):
+        """
+        Read the status of the change set, and all of its changes once
+        it is created.
+        """
+        arguments = {'ChangeSetName': self.change_set_id}
+        response = self.caller(self.client.describe_change_set, **arguments)
+        self.status = response['Status']
+        self.status_reason = response.get('StatusReason')
+        changes = response.get('Changes', [])
+        while (self.status == CHANGE_SET_CREATE_COMPLETE and
+                response.get('NextToken')):
+            arguments['NextToken'] = response['NextToken']
+            response = self.caller(
+                self.client.describe_change_set, **arguments)
+            changes.extend(response.get('Changes', []))
+        self.changes = changes
+
+    @property
+    def is_final(self):
+        return self.status in (CHANGE_SET_CREATE_COMPLETE, CHANGE_SET_FAILED)
+
+    @property
+    def is_empty(self):
+        return (self.status == CHANGE_SET_FAILED and
+                any(reason in (self.status_reason or '')
+                    for reason in CHANGE_SET_NO_CHANGES))
+
+    @property
+    def replacements(self):
+        """
+        The logical IDs of the resources the change set may replace.
+        """
+        return [
+            change['ResourceChange']['LogicalResourceId']
+            for change in self.changes
+            if change.get('ResourceChange', {}).get('Replacement') in
+            REPLACEMENTS]
+
+    def delete(self):
+        self.caller(
+            self.client.delete_change_set, ChangeSetName=self.change_set_id)
+
+
+def wait_for_change_sets(change_sets, context=None):
+    """
+    Poll all change sets in rounds until they are final, or the time of
+    the lambda invocation of the context is up. The interval between the
+    rounds starts at MIN_POLL_INTERVAL, and grows up to MAX_POLL_INTERVAL
+    while no change set becomes final. A change set whose status can not
+    be read counts as failed. Waiting also ends when there is no time
+    left for the rate limit of the calls.
+    """
+    waiting = list(change_sets)
+    interval = PollInterval(MIN_POLL_INTERVAL, MAX_POLL_INTERVAL)
+    while waiting:
+        if interval.exceeds(remaining_time(context, WAIT_MARGIN)):
+            logger.warning(
+                'Stopped waiting for {0} change sets, the time is up'.format(
+                    len(waiting)))
+            return
+        # A change set is never created right away, so sleep first
+        time.sleep(interval.seconds)
+        still_waiting = []
+        for change_set in waiting:
+            try:
+                change_set.poll()
+            except RateLimitTimeout as error:
+                logger.warning(
+                    'Stopped waiting for {0} change sets: {1}'.format(
+                        len(waiting), error))
+                return
+            except ClientError as error:
+                change_set.status = CHANGE_SET_FAILED
+                change_set.status_reason = error.message
+            if not change_set.is_final:
+                still_waiting.append(change_set)
+        interval.update(len(still_waiting) < len(waiting))
+        waiting = still_waiting
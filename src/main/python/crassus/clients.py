@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+
+"""
+Registry of boto3 clients and resources shared by all parts of crassus.
+
+Clients and resources are created once per service and region and kept
+for the lifetime of the lambda container, so warm invocations reuse
+their HTTP connection pools instead of paying for the client
+construction and the TLS handshake again.
+
+Clients for other accounts are created from a session with the
+credentials of an assumed role. That session, and everything created
+from it, is reused until shortly before the credentials expire. The
+AssumeRole call is made while only holding the lock of its role, so it
+does not hold up the threads that use other roles or existing clients.
+
+Clients and resources whose calls are retried by crassus itself, e.g.
+through a ThrottledCaller, which retries throttling, server and
+connection errors, are created with retries=False. Their calls are then
+made exactly once by botocore, so that neither its own retries nor its
+sleeps bypass the rate limit and the time budget.
+
+Nothing is created at import time, boto3 itself is only imported when
+the first client or resource is requested.
+"""
+
+import calendar
+import threading
+import time
+
+# Name of the sessions crassus opens with AssumeRole
+ROLE_SESSION_NAME = 'crassus'
+# Assumed role sessions are renewed this many seconds before they expire
+ROLE_SESSION_EXPIRY_MARGIN = 300
+
+_session = None
+# role ARN -> (session, expiration timestamp)
+_role_sessions = {}
+# role ARN -> lock held while assuming the role
+_role_locks = {}
+# (service, region, role ARN, retries) -> (session, client or resource)
+_clients = {}
+_resources = {}
+# boto3 sessions are not thread safe, all creations are serialized
+_lock = threading.Lock()
+
+
+def _get_default_session():
+    """
+    Return the session with the own credentials, call with _lock held.
+    """
+    global _session
+    if _session is None:
+        import boto3
+        _session = boto3.session.Session()
+    return _session
+
+
+def _get_valid_role_session(role_arn):
+    """
+    Return the session of the role, None if there is none whose
+    credentials are still valid. Call with _lock held.
+    """
+    role_session, expiration = _role_sessions.get(role_arn, (None, 0))
+    if expiration - ROLE_SESSION_EXPIRY_MARGIN <= time.time():
+        return None
+    return role_session
+
+
+def _get_session(role_arn=None):
+    """
+    Return the session for the role, the default session without one.
+    """
+    with _lock:
+        session = _get_default_session()
+        if role_arn is None:
+            return session
+        role_session = _get_valid_role_session(role_arn)
+        if role_session is not None:
+            return role_session
+        role_lock = _role_locks.setdefault(role_arn, threading.Lock())
+    with role_lock:
+        with _lock:
+            # Another thread may have assumed the role meanwhile
+            role_session = _get_valid_role_session(role_arn)
+            if role_session is not None:
+                return role_session
+            sts = _get_cached(_clients, 'client', 'sts', None, None, session)
+        credentials = sts.assume_role(
+            RoleArn=role_arn,
+            RoleSessionName=ROLE_SESSION_NAME)['Credentials']
+        expiration = calendar.timegm(
+            credentials['Expiration'].utctimetuple())
+        with _lock:
+            import boto3
+            role_session = boto3.session.Session(
+                aws_access_key_id=credentials['AccessKeyId'],
+                aws_secret_access_key=credentials['SecretAccessKey'],
+                aws_session_token=credentials['SessionToken'],
+                region_name=session.region_name)
+            _role_sessions[role_arn] = (role_session, expiration)
+        return role_session
+
+
+def _get_cached(cache, factory_name, service_name, region_name, role_arn,
+                session, retries=True):
+    """
+    Return the client or resource of the cache, created by the session
+    if there is none yet. Call with _lock held.
+    """
+    key = (service_name, region_name, role_arn, retries)
+    cached_session, cached = cache.get(key, (None, None))
+    if cached_session is not session:
+        # Not created yet, or created with credentials that expired
+        arguments = {'region_name': region_name}
+        if not retries:
+            from botocore.config import Config
+            arguments['config'] = Config(retries={'max_attempts': 0})
+        cached = getattr(session, factory_name)(service_name, **arguments)
+        cache[key] = (session, cached)
+    return cached
+
+
+def get_client(service_name, region_name=None, role_arn=None, retries=True):
+    """
+    Return the shared client for the service in the given region, the
+    region of the session if region_name is None. With a role_arn, the
+    client acts with the credentials of that assumed role. With
+    retries=False, botocore does not retry any failed call.
+
+    Clients are thread safe and may be used by all worker threads.
+    """
+    session = _get_session(role_arn)
+    with _lock:
+        return _get_cached(
+            _clients, 'client', service_name, region_name, role_arn,
+            session, retries)
+
+
+def get_resource(service_name, region_name=None, role_arn=None,
+                 retries=True):
+    """
+    Return the shared service resource for the service in the given
+    region, the region of the session if region_name is None. With a
+    role_arn, the resource acts with the credentials of that assumed
+    role. With retries=False, botocore does not retry any failed call,
+    also not those of the client of the resource.
+
+    Only the factory methods of the service resource (e.g. Stack()) are
+    meant to be used from several threads, the created sub-resources
+    must stay within the thread that created them.
+    """
+    session = _get_session(role_arn)
+    with _lock:
+        return _get_cached(
+            _resources, 'resource', service_name, region_name, role_arn,
+            session, retries)
+
+
+class LazyClient(object):
+
+    """
+    Stand-in for the shared client of a service, the client is only
+    looked up in the registry when an attribute is first accessed, e.g.
+    with the first API call. It is kept from then on, so further calls
+    do not wait for the lock of the registry.
+    """
+
+    def __init__(self, service_name, region_name=None):
+        self.service_name = service_name
+        self.region_name = region_name
+        self._client = None
+
+    def __getattr__(self, name):
+        client = self._client
+        if client is None:
+            client = get_client(self.service_name, self.region_name)
+            self._client = client
+        return getattr(client, name)
+
+
+def reset():
+    """
+    Forget all sessions and all clients and resources created so far.
+    """
+    global _session
+    with _lock:
+        _session = None
+        _role_sessions.clear()
+        _role_locks.clear()
+        _clients.clear()
+        _resources.clear()
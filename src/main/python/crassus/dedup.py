@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+from crassus.clients import get_client
+from crassus.ttl_cache import TTLCache
+
+# Attributes of the items in the DynamoDB table of a DynamoDBDedupStore
+DEDUP_KEY_ATTRIBUTE = 'dedupKey'
+DEDUP_EXPIRES_ATTRIBUTE = 'expires'
+
+
+class DedupWindow(TTLCache):
+
+    """
+    Remember keys for ttl seconds, up to max_size of them, to recognize
+    messages that were delivered more than once to the same lambda
+    container.
+    """
+
+    def add(self, key):
+        """
+        Remember the key for ttl seconds from now.
+        """
+        self.put(key, True)
+
+    def seen_before(self, key):
+        """
+        Return whether the key was already seen within the window, and
+        remember it for ttl seconds from now in any case.
+        """
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            seen = key in self._entries
+            self._put(key, True, now)
+            return seen
+
+
+class DynamoDBDedupStore(object):
+
+    """
+    Remember keys for ttl seconds in a DynamoDB table, to recognize
+    messages that were delivered more than once to any lambda container.
+
+    The table needs a string hash key named DEDUP_KEY_ATTRIBUTE. Items
+    carry their expiry time in DEDUP_EXPIRES_ATTRIBUTE, which can be
+    used as the TTL attribute of the table, so that expired keys are
+    eventually deleted.
+    """
+
+    def __init__(self, table_name, ttl):
+        self.table_name = table_name
+        self.ttl = ttl
+
+    def __contains__(self, key):
+        """
+        Return whether the key was added within the last ttl seconds.
+        """
+        item = get_client('dynamodb').get_item(
+            TableName=self.table_name,
+            Key={DEDUP_KEY_ATTRIBUTE: {'S': key}},
+            ConsistentRead=True).get('Item')
+        return (item is not None and
+                int(item[DEDUP_EXPIRES_ATTRIBUTE]['N']) >= time.time())
+
+    def add(self, key):
+        """
+        Remember the key for ttl seconds from now.
+        """
+        get_client('dynamodb').put_item(
+            TableName=self.table_name,
+            Item={
+                DEDUP_KEY_ATTRIBUTE: {'S': key},
+                DEDUP_EXPIRES_ATTRIBUTE: {
+                    'N': str(int(time.time()) + self.ttl)}})
@@ -1,50 +1,220 @@
 import datetime
 import json
+import time
+from collections import OrderedDict
 
-import boto3
 from botocore.exceptions import ClientError
-from crassus.utils import get_lambda_config_property, sqs_send_message, logger
+from crassus.change_sets import (
+    CHANGE_SET_CREATE_COMPLETE, ChangeSet, wait_for_change_sets)
+from crassus.clients import get_resource
+from crassus.utils import (
+    get_lambda_config, get_lambda_config_property, sqs_send_message, logger)
 from crassus.deployment_response import DeploymentResponse
+from crassus.metrics import PhaseTimer
+from crassus.stack_waiter import (
+    STACK_UPDATE_COMPLETE, StackWaiter, is_terminal)
+from crassus.throttling import RateLimitTimeout, ThrottledCaller
+from crassus.ttl_cache import TTLCache
 from dateutil import tz
 
 NOTIFICATION_SUBJECT = 'Crassus deployer notification'
 MESSAGE_STACK_NOT_FOUND = 'Stack not found {stack_name}: {message}'
+MESSAGE_ASSUME_ROLE_PROBLEM = \
+    'Unable to assume role {role_arn} for stack {stack_name}: {message}'
 MESSAGE_UPDATE_PROBLEM = 'Problem while updating stack {stack_name}: {message}'
+MESSAGE_UNCHANGED = 'No parameter changes, stack {stack_name} was not updated.'
+MESSAGE_TRIGGERED = 'Cloudformation was triggered successfully.'
+MESSAGE_COMPLETED = 'Stack update completed with {stack_status}.'
+MESSAGE_FAILED = 'Stack update failed with {stack_status}: {reasons}'
+MESSAGE_PENDING = \
+    'Stack {stack_name} is busy with {stack_status}, the update is pending.'
+MESSAGE_BUSY = \
+    'Stack {stack_name} is busy with {stack_status}, the update was not ' \
+    'applied.'
+MESSAGE_CHANGE_SET_NOT_READY = \
+    'Change set of stack {stack_name} was not ready in time, status ' \
+    '{status}.'
+MESSAGE_STILL_IN_PROGRESS = \
+    'Cloudformation was triggered successfully, the update was still in ' \
+    'progress when the time was up.'
+# Error message of CloudFormation for updates without any change
+CFN_NO_UPDATES = 'No updates are to be performed'
+# Role assumed in the target account, if a message only names the account
+DEFAULT_CROSS_ACCOUNT_ROLE = 'crassus-deployer'
+
+# Seconds the described data of a stack is reused, and number of stacks
+STACK_CACHE_TTL = 30
+STACK_CACHE_MAX_SIZE = 1000
+# Seconds an update waits for a busy stack at most
+DEFAULT_MAX_BUSY_WAIT = 120
+
+# Described stacks, so that repeated updates skip DescribeStacks
+_stack_cache = TTLCache(STACK_CACHE_TTL, STACK_CACHE_MAX_SIZE)
+
+
+def _arn_region(arn):
+    """
+    Return the region of an ARN, None if it is not an ARN.
+    """
+    parts = arn.split(':')
+    if len(parts) < 6 or parts[0] != 'arn':
+        return None
+    return parts[3]
 
 
 class Crassus(object):
 
-    def __init__(self, event, context):
+    def __init__(self, event, context, stack_update_parameters=None,
+                 publisher=None, pending_busy_updates=False):
         self.event = event
         logger.debug('Received event: %r', event)
         self.context = context
         logger.debug('Received context: %r', context)
 
-        self.aws_cfn = boto3.resource('cloudformation')
-        self.aws_sns = boto3.resource('sns')
-        self.aws_lambda = boto3.client('lambda')
-
+        self._aws_cfn = None
+        self._cfn_caller = None
+        self._wait_for_completion = None
+        self._use_change_sets = None
+        self._max_busy_wait = None
         self._output_topics = None
         self._cfn_output_topics = None
         self._stack_update_parameters = None
         self._stack_name = None
         self.stack = None
+        # ChangeSet created by update() in change set mode, until it is
+        # finished
+        self.change_set = None
+        # Whether the data of the stack was taken from the cache
+        self.loaded_from_cache = False
+        self.response = None
+        # Status of the last notification, also without output topics
+        self.status = None
+        # Optional ResultPublisher buffering the notifications
+        self.publisher = publisher
+        # Whether an update whose stack stays busy is pending instead of
+        # failed, only for messages that are received again while pending
+        self.pending_busy_updates = pending_busy_updates
+        self.timer = PhaseTimer()
+
+        if stack_update_parameters is not None:
+            self._stack_update_parameters = stack_update_parameters
+            self._stack_name = stack_update_parameters.stack_name
+
+    @property
+    def region(self):
+        return self.stack_update_parameters.region
+
+    @property
+    def role_arn(self):
+        """
+        The role to assume for updating a stack in another account, None
+        to use the own role. A message names either the full roleArn, or
+        the accountId, then the role name is taken from the
+        'cross_account_role' property of the lambda configuration.
+        """
+        stack_update_parameters = self.stack_update_parameters
+        if stack_update_parameters.role_arn:
+            return stack_update_parameters.role_arn
+        if not stack_update_parameters.account_id:
+            return None
+        with self.timer.phase('config'):
+            role_name = (get_lambda_config(self.context) or {}).get(
+                'cross_account_role', DEFAULT_CROSS_ACCOUNT_ROLE)
+        return 'arn:aws:iam::{0}:role/{1}'.format(
+            stack_update_parameters.account_id, role_name)
+
+    @property
+    def aws_cfn(self):
+        """
+        The shared CloudFormation resource of the account and region the
+        stack is in, the default region if the message does not name one.
+        Its calls are not retried by botocore, they are made through
+        cfn_caller, which retries them within the rate limit and the
+        time budget.
+        """
+        if self._aws_cfn is None:
+            self._aws_cfn = get_resource(
+                'cloudformation', self.region, self.role_arn, retries=False)
+        return self._aws_cfn
+
+    @property
+    def cfn_caller(self):
+        """
+        Makes the CloudFormation calls, rate limited per account and
+        region, and retried while they are throttled.
+        """
+        if self._cfn_caller is None:
+            self._cfn_caller = ThrottledCaller(
+                (self.role_arn, self.region), self.context)
+        return self._cfn_caller
+
+    @property
+    def wait_for_completion(self):
+        """
+        Whether to follow an update until the stack reaches a terminal
+        status, and report that status instead of the triggering. Set
+        with the 'wait_for_completion' property of the lambda
+        configuration.
+        """
+        if self._wait_for_completion is None:
+            with self.timer.phase('config'):
+                self._wait_for_completion = bool(
+                    (get_lambda_config(self.context) or {}).get(
+                        'wait_for_completion'))
+        return self._wait_for_completion
+
+    @property
+    def use_change_sets(self):
+        """
+        Whether to update the stack with a change set, which is only
+        executed if it contains changes. Set with the 'use_change_sets'
+        property of the lambda configuration.
+        """
+        if self._use_change_sets is None:
+            with self.timer.phase('config'):
+                self._use_change_sets = bool(
+                    (get_lambda_config(self.context) or {}).get(
+                        'use_change_sets'))
+        return self._use_change_sets
+
+    @property
+    def max_busy_wait(self):
+        """
+        Seconds to wait for a busy stack at most, before the update is
+        given up. Set with the 'max_busy_wait' property of the lambda
+        configuration, it defaults to DEFAULT_MAX_BUSY_WAIT.
+        """
+        if self._max_busy_wait is None:
+            with self.timer.phase('config'):
+                self._max_busy_wait = float(
+                    (get_lambda_config(self.context) or {}).get(
+                        'max_busy_wait', DEFAULT_MAX_BUSY_WAIT))
+        return self._max_busy_wait
+
+    @property
+    def stack_cache_key(self):
+        """
+        Identifies the stack in the cache, by the account of the role,
+        the region and the stack name.
+        """
+        return (self.role_arn, self.region, self.stack_name)
 
     @property
     def stack_name(self):
-        if not self._stack_name:
+        if self._stack_name is None:
             self.parse_event()
         return self._stack_name
 
     @property
     def stack_update_parameters(self):
-        if not self._stack_update_parameters:
+        if self._stack_update_parameters is None:
             self.parse_event()
         return self._stack_update_parameters
 
     def parse_event(self):
-        message = json.loads(self.event['Records'][0]['Sns']['Message'])
-        self._stack_update_parameters = StackUpdateParameter(message)
+        with self.timer.phase('parse'):
+            self._stack_update_parameters = \
+                StackUpdateParameter.from_record(self.event['Records'][0])
         self._stack_name = self._stack_update_parameters.stack_name
         logger.debug('Extracted Update Parameters: %r',
                      self._stack_update_parameters)
@@ -53,59 +223,403 @@ class Crassus(object):
     def output_topics(self):
         if self._output_topics:
             return self._output_topics
-        self._output_topics = get_lambda_config_property(
-            self.context, 'result_queue')
+        with self.timer.phase('config'):
+            self._output_topics = get_lambda_config_property(
+                self.context, 'result_queue')
         return self._output_topics
 
     @property
     def cfn_output_topics(self):
         if self._cfn_output_topics is not None:
             return self._cfn_output_topics
-        self._cfn_output_topics = get_lambda_config_property(
-            self.context, 'cfn_events')
+        with self.timer.phase('config'):
+            self._cfn_output_topics = get_lambda_config_property(
+                self.context, 'cfn_events')
         return self._cfn_output_topics
 
-    def notify(self, status, message):
+    @property
+    def notification_arns(self):
+        """
+        The configured CloudFormation event topics that can be used for
+        the stack. CloudFormation only accepts topics of the region of
+        the stack, so topic ARNs of other regions are left out.
+
+        Return None if no topic is usable, the notification topics of the
+        stack then stay as they are.
+        """
+        if not self.cfn_output_topics or not self.region:
+            return self.cfn_output_topics or None
+        notification_arns = [
+            topic_arn for topic_arn in self.cfn_output_topics
+            if _arn_region(topic_arn) in (None, self.region)]
+        return notification_arns or None
+
+    def notify(self, status, message, **extra_fields):
+        self.status = status
         if self.output_topics is None:
             return
         timestamp_str = datetime.datetime.now(tz=tz.tzutc()).isoformat()
         result_message = DeploymentResponse(
             status, message, self.stack_name, timestamp_str,
-            DeploymentResponse.EMITTER_CRASSUS)
-        sqs_send_message(self.output_topics, result_message)
+            DeploymentResponse.EMITTER_CRASSUS,
+            timings=dict(self.timer.timings), **extra_fields)
+        self.response = result_message
+        with self.timer.phase('notify'):
+            if self.publisher is not None:
+                self.publisher.publish(self.output_topics, result_message)
+            else:
+                sqs_send_message(self.output_topics, result_message)
 
     def load(self):
-        self.stack = self.aws_cfn.Stack(self.stack_name)
         try:
-            self.stack.load()
+            with self.timer.phase('load'):
+                aws_cfn = self.aws_cfn
+        except ClientError as error:
+            logger.error(MESSAGE_ASSUME_ROLE_PROBLEM.format(
+                role_arn=self.role_arn, stack_name=self.stack_name,
+                message=error.message))
+            self.notify(DeploymentResponse.STATUS_FAILURE, error.message)
+            return False
+        self.stack = aws_cfn.Stack(self.stack_name)
+        cached_data = _stack_cache.get(self.stack_cache_key)
+        if cached_data is not None:
+            # The resource reads its attributes from the data, it is
+            # only described again by an explicit load()
+            self.stack.meta.data = cached_data
+            self.loaded_from_cache = True
+            logger.debug('Using cached Stack: %r', self.stack)
+            return True
+        try:
+            self.reload()
             logger.debug('Loaded Stack: %r', self.stack)
+            return True
         except ClientError as error:
             logger.error(MESSAGE_STACK_NOT_FOUND.format(
                 stack_name=self.stack_name, message=error.message))
             self.notify(DeploymentResponse.STATUS_FAILURE, error.message)
+            return False
+
+    def reload(self):
+        """
+        Describe the stack and cache its data.
+        """
+        with self.timer.phase('load'):
+            self.cfn_caller(self.stack.load)
+        self.loaded_from_cache = False
+        _stack_cache.put(self.stack_cache_key, self.stack.meta.data)
+
+    def reload_and_update(self):
+        """
+        Retry the update with freshly described data, for a decision
+        that was based on cached data, which may be outdated.
+        """
+        logger.info(
+            'Cached data of stack {0} may be outdated, describing it '
+            'again'.format(self.stack_name))
+        _stack_cache.invalidate(self.stack_cache_key)
+        if self.load():
+            self.update()
+
+    def describe_stacks(self, predicate):
+        """
+        Return the described data of all stacks of the account and region
+        for which the predicate is true, page by page. Their data is
+        cached, so that their updates do not describe them again.
+        """
+        client = self.aws_cfn.meta.client
+        stacks = []
+        arguments = {}
+        while True:
+            with self.timer.phase('load'):
+                response = self.cfn_caller(
+                    client.describe_stacks, **arguments)
+            for stack in response['Stacks']:
+                if predicate(stack):
+                    _stack_cache.put(
+                        (self.role_arn, self.region, stack['StackName']),
+                        stack)
+                    stacks.append(stack)
+            if not response.get('NextToken'):
+                return stacks
+            arguments['NextToken'] = response['NextToken']
+
+    def is_busy(self):
+        """
+        Whether the loaded stack is in the middle of an operation, e.g.
+        UPDATE_IN_PROGRESS, so that it can not be updated now.
+        """
+        return not is_terminal(self.stack.stack_status)
 
     def update(self):
+        if self.is_busy() and not self.wait_until_settled():
+            return
         logger.debug('Parameters to be updated: %s', self.stack.parameters)
-        merged = self.stack_update_parameters.merge(self.stack.parameters)
+        with self.timer.phase('merge'):
+            merged = self.stack_update_parameters.merge(
+                self.stack.parameters)
         logger.debug('Merged parameters: %s', merged)
+        if StackUpdateParameter.is_unchanged(merged):
+            if self.loaded_from_cache:
+                self.reload_and_update()
+                return
+            self.notify_unchanged()
+            return
+        update_arguments = dict(
+            UsePreviousTemplate=True,
+            Parameters=merged,
+            Capabilities=['CAPABILITY_IAM'])
+        if self.notification_arns is not None:
+            update_arguments['NotificationARNs'] = self.notification_arns
+        if self.use_change_sets:
+            self.create_change_set(update_arguments)
+            return
         try:
             logger.debug('Will try to update Cloudformation')
-            self.stack.update(
-                UsePreviousTemplate=True,
-                Parameters=merged,
-                Capabilities=['CAPABILITY_IAM'],
-                NotificationARNs=self.cfn_output_topics)
-            message = 'Cloudformation was triggered successfully.'
-            logger.debug(message)
-            self.notify(DeploymentResponse.STATUS_SUCCESS, message)
+            self.trigger(self.stack.update, **update_arguments)
         except ClientError as error:
+            if CFN_NO_UPDATES in error.message:
+                self.notify_unchanged()
+                return
+            if self.loaded_from_cache:
+                self.reload_and_update()
+                return
             logger.error(MESSAGE_UPDATE_PROBLEM.format(
                 stack_name=self.stack_name, message=error.message))
             self.notify(DeploymentResponse.STATUS_FAILURE, error.message)
 
-    def deploy(self):
-        self.load()
-        self.update()
+    def trigger(self, function, extra_fields=None, **arguments):
+        """
+        Start the update of the stack by calling the function with the
+        arguments, e.g. stack.update, and notify that it was triggered,
+        or its outcome when waiting for completion. The extra fields are
+        added to the notification. Errors of the function are raised.
+        """
+        extra_fields = extra_fields or {}
+        waiter = self.start_waiter()
+        try:
+            with self.timer.phase('update'):
+                self.cfn_caller(function, **arguments)
+        finally:
+            # The parameters and the status of the stack changed
+            _stack_cache.invalidate(self.stack_cache_key)
+        if waiter is not None:
+            self.notify_completion(waiter, **extra_fields)
+            return
+        logger.debug(MESSAGE_TRIGGERED)
+        self.notify(DeploymentResponse.STATUS_SUCCESS, MESSAGE_TRIGGERED,
+                    **extra_fields)
+
+    def create_change_set(self, update_arguments):
+        """
+        Create a change set with the update arguments, it is kept in
+        change_set until finish_change_set() executes it.
+        """
+        change_set = ChangeSet(
+            self.aws_cfn.meta.client, self.stack_name, self.cfn_caller)
+        try:
+            with self.timer.phase('change_set'):
+                change_set.create(**update_arguments)
+        except ClientError as error:
+            if self.loaded_from_cache:
+                self.reload_and_update()
+                return
+            logger.error(MESSAGE_UPDATE_PROBLEM.format(
+                stack_name=self.stack_name, message=error.message))
+            self.notify(DeploymentResponse.STATUS_FAILURE, error.message)
+            return
+        self.change_set = change_set
+
+    def finish_change_set(self):
+        """
+        Execute the change set, once it is final, if it contains changes,
+        otherwise delete it. Notify the outcome, the resources that the
+        change set may replace are in 'replacements'. Return the emitted
+        DeploymentResponse.
+        """
+        change_set, self.change_set = self.change_set, None
+        if change_set.status != CHANGE_SET_CREATE_COMPLETE:
+            self.delete_change_set(change_set)
+            if change_set.is_empty:
+                self.notify_unchanged()
+            else:
+                message = change_set.status_reason or \
+                    MESSAGE_CHANGE_SET_NOT_READY.format(
+                        stack_name=self.stack_name, status=change_set.status)
+                logger.error(MESSAGE_UPDATE_PROBLEM.format(
+                    stack_name=self.stack_name, message=message))
+                self.notify(DeploymentResponse.STATUS_FAILURE, message)
+        else:
+            replacements = change_set.replacements
+            if replacements:
+                logger.warning(
+                    'Update of stack {0} may replace {1}'.format(
+                        self.stack_name, ', '.join(replacements)))
+            try:
+                self.trigger(
+                    change_set.client.execute_change_set,
+                    {'replacements': replacements},
+                    ChangeSetName=change_set.change_set_id)
+            except ClientError as error:
+                logger.error(MESSAGE_UPDATE_PROBLEM.format(
+                    stack_name=self.stack_name, message=error.message))
+                self.notify(DeploymentResponse.STATUS_FAILURE, error.message)
+        self.timer.emit('deploy', StackName=self._stack_name)
+        return self.response
+
+    def delete_change_set(self, change_set):
+        try:
+            with self.timer.phase('change_set'):
+                change_set.delete()
+        except ClientError as error:
+            logger.warning(
+                'Unable to delete change set {0} of stack {1}: {2}'.format(
+                    change_set.name, self.stack_name, error.message))
+
+    def wait_until_settled(self):
+        """
+        Wait until the busy stack is no longer busy, then the update can
+        go on. Nothing is kept for later, an update whose stack stays
+        busy is retried by its sender.
+
+        Return whether to go on with the update. If not, the update is
+        notified as pending with pending_busy_updates, as its message is
+        received again, e.g. from SQS. Otherwise it is notified as
+        failed, SNS does not retry a successful invocation.
+        """
+        settled, stack_status = self._wait_until_not_busy()
+        if settled:
+            return True
+        if self.pending_busy_updates:
+            self.notify_pending(MESSAGE_PENDING.format(
+                stack_name=self.stack_name, stack_status=stack_status))
+        else:
+            message = MESSAGE_BUSY.format(
+                stack_name=self.stack_name, stack_status=stack_status)
+            logger.error(message)
+            self.notify(DeploymentResponse.STATUS_FAILURE, message)
+        return False
+
+    def _wait_until_not_busy(self):
+        """
+        Wait until the stack is no longer busy, for max_busy_wait seconds
+        at most. Return whether it settled, and the last busy status of
+        the stack.
+        """
+        deadline = time.time() + self.max_busy_wait
+        stack_status = None
+        while self.is_busy():
+            stack_status = self.stack.stack_status
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                return False, stack_status
+            try:
+                settled = self._wait_for_stack(timeout)
+                if settled:
+                    self.reload()
+            except (ClientError, RateLimitTimeout) as error:
+                logger.warning(
+                    'Unable to follow busy stack {0}: {1}'.format(
+                        self.stack_name, error))
+                settled = False
+            if not settled:
+                return False, stack_status
+        return True, stack_status
+
+    def _wait_for_stack(self, timeout=None):
+        """
+        Wait until the busy stack reaches a terminal status, return
+        whether it did within the timeout and the time of the invocation.
+        """
+        waiter = StackWaiter(
+            self.aws_cfn.meta.client, self.stack_name, self.context,
+            self.cfn_caller, timeout)
+        with self.timer.phase('wait'):
+            waiter.start()
+            # The stack may have settled before the waiter started
+            self.reload()
+            if not self.is_busy():
+                return True
+            stack_status = waiter.wait()
+        return stack_status is not None and is_terminal(stack_status)
+
+    def notify_pending(self, message):
+        logger.info(message)
+        self.notify(DeploymentResponse.STATUS_PENDING, message)
+
+    def start_waiter(self):
+        """
+        Return a started StackWaiter for the stack, None if not waiting
+        for completion, or if the stack events can not be read.
+        """
+        if not self.wait_for_completion:
+            return None
+        waiter = StackWaiter(
+            self.aws_cfn.meta.client, self.stack_name, self.context,
+            self.cfn_caller)
+        try:
+            with self.timer.phase('wait'):
+                waiter.start()
+        except (ClientError, RateLimitTimeout) as error:
+            logger.warning(
+                'Unable to read the events of stack {0}, not waiting for '
+                'completion: {1}'.format(self.stack_name, error))
+            return None
+        return waiter
+
+    def notify_completion(self, waiter, **extra_fields):
+        """
+        Wait for the triggered update to finish and notify its outcome,
+        with the last seen stack status as 'stackStatus', and the extra
+        fields.
+        """
+        try:
+            with self.timer.phase('wait'):
+                waiter.wait()
+        except (ClientError, RateLimitTimeout) as error:
+            logger.warning(
+                'Unable to read the events of stack {0}, stopped waiting '
+                'for completion: {1}'.format(self.stack_name, error))
+        stack_status = waiter.stack_status
+        if stack_status == STACK_UPDATE_COMPLETE:
+            status = DeploymentResponse.STATUS_SUCCESS
+            message = MESSAGE_COMPLETED.format(stack_status=stack_status)
+        elif stack_status is not None and is_terminal(stack_status):
+            status = DeploymentResponse.STATUS_FAILURE
+            message = MESSAGE_FAILED.format(
+                stack_status=stack_status,
+                reasons='; '.join(waiter.failure_reasons))
+            logger.error(message)
+        else:
+            status = DeploymentResponse.STATUS_IN_PROGRESS
+            message = MESSAGE_STILL_IN_PROGRESS
+        self.notify(status, message, stackStatus=stack_status,
+                    **extra_fields)
+
+    def notify_unchanged(self):
+        message = MESSAGE_UNCHANGED.format(stack_name=self.stack_name)
+        logger.info(message)
+        self.notify(DeploymentResponse.STATUS_UNCHANGED, message)
+
+    def deploy(self, finish_change_set=True):
+        """
+        Load and update the stack, return the emitted DeploymentResponse.
+        The time spent in every phase is emitted as metrics.
+
+        In change set mode, deploy waits for the created change set and
+        finishes it. With finish_change_set=False, it returns right after
+        the change set was created, the caller then waits for it and
+        calls finish_change_set(), e.g. to wait for many change sets at
+        once.
+        """
+        if self.load():
+            self.update()
+        if self.change_set is not None:
+            if not finish_change_set:
+                return self.response
+            wait_for_change_sets([self.change_set], self.context)
+            return self.finish_change_set()
+        self.timer.emit('deploy', StackName=self._stack_name)
+        return self.response
 
 
 class StackUpdateParameter(dict):
@@ -114,7 +628,79 @@ class StackUpdateParameter(dict):
         self.version = message['version']
         self.stack_name = message['stackName']
         self.region = message['region']
+        # Optional target of a cross account update
+        self.role_arn = message.get('roleArn')
+        self.account_id = message.get('accountId')
         self.update(message['parameters'])
+        # IDs of the SNS messages these parameters were created from
+        self.message_ids = []
+
+    @staticmethod
+    def decode_record(record):
+        """
+        Return the decoded JSON message of one SNS or SQS record of the
+        received event, and the ID of the message, None if unknown. The
+        body of an SQS record may also be an SNS notification, if the
+        queue is subscribed to a topic without raw message delivery.
+        """
+        if 'Sns' in record:
+            message = json.loads(record['Sns']['Message'])
+            message_id = record['Sns'].get('MessageId')
+        else:
+            message = json.loads(record['body'])
+            message_id = record.get('messageId')
+            if message.get('Type') == 'Notification' and 'Message' in message:
+                message = json.loads(message['Message'])
+        return message, message_id
+
+    @classmethod
+    def from_record(cls, record):
+        """
+        Create the update parameters from the message of one SNS or SQS
+        record of the received event.
+        """
+        return cls.from_message(*cls.decode_record(record))
+
+    @classmethod
+    def from_message(cls, message, message_id=None):
+        """
+        Create the update parameters from a decoded message, with the ID
+        of the message if it is known.
+        """
+        stack_update_parameters = cls(message)
+        if message_id is not None:
+            stack_update_parameters.message_ids.append(message_id)
+        return stack_update_parameters
+
+    @property
+    def key(self):
+        """
+        Identifies the stack the update is for.
+        """
+        return (self.role_arn, self.account_id, self.region, self.stack_name)
+
+    @classmethod
+    def coalesce(cls, stack_update_parameters_list):
+        """
+        Merge all updates for the same stack, account and region into
+        one, in the order of the list, so the last given value of every
+        parameter wins. The stacks keep the order of their first update.
+        """
+        coalesced = OrderedDict()
+        for stack_update_parameters in stack_update_parameters_list:
+            key = stack_update_parameters.key
+            if key not in coalesced:
+                coalesced[key] = cls({
+                    'version': stack_update_parameters.version,
+                    'stackName': stack_update_parameters.stack_name,
+                    'region': stack_update_parameters.region,
+                    'roleArn': stack_update_parameters.role_arn,
+                    'accountId': stack_update_parameters.account_id,
+                    'parameters': {}})
+            coalesced[key].update(stack_update_parameters)
+            coalesced[key].message_ids.extend(
+                stack_update_parameters.message_ids)
+        return coalesced.values()
 
     def to_aws_format(self):
         return [
@@ -122,30 +708,46 @@ class StackUpdateParameter(dict):
             for key, value in self.items()]
 
     def merge(self, stack_parameters):
-        merged_stack_parameters = []
+        """
+        Merge the update parameters into the current parameters of the
+        stack, in a single pass over both.
+
+        Parameters with a changed value come first, all other parameters
+        of the stack are kept with UsePreviousValue. Update parameters
+        that the stack does not have are ignored.
+        """
+        stack_parameters = stack_parameters or []
+        current_values = dict(
+            (parameter.get('ParameterKey'), parameter.get('ParameterValue'))
+            for parameter in stack_parameters)
 
-        for update_key in self:
-            update_value = self[update_key]
-            filtered_list = filter(
-                lambda x: x.get('ParameterKey') == update_key,
-                stack_parameters)
-            if not filtered_list:
+        merged_stack_parameters = []
+        changed_keys = set()
+        for update_key, update_value in self.items():
+            if update_key not in current_values:
                 # No such parameter in stack parameters
                 continue
-            if filtered_list[0].get('ParameterValue') != update_value:
+            if current_values[update_key] != update_value:
                 merged_stack_parameters.append({
                     'ParameterKey': update_key,
                     'ParameterValue': update_value})
-                stack_parameters = filter(
-                    lambda x: x.get('ParameterKey') != update_key,
-                    stack_parameters)
+                changed_keys.add(update_key)
 
         # Turn all remaining key-values to UsePreviousValue = True
-        stack_parameters = map(
-            lambda x: {
-                'ParameterKey': x.get('ParameterKey'),
-                'UsePreviousValue': True},
-            stack_parameters)
-        merged_stack_parameters.extend(stack_parameters)
+        merged_stack_parameters.extend(
+            {'ParameterKey': parameter.get('ParameterKey'),
+             'UsePreviousValue': True}
+            for parameter in stack_parameters
+            if parameter.get('ParameterKey') not in changed_keys)
 
         return merged_stack_parameters
+
+    @staticmethod
+    def is_unchanged(merged_stack_parameters):
+        """
+        Return whether the result of merge() keeps the previous values of
+        all parameters, so that an update would not change anything.
+        """
+        return all(
+            parameter.get('UsePreviousValue')
+            for parameter in merged_stack_parameters)
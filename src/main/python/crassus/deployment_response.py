@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 
+import json
 
-class DeploymentResponse(dict):
+
+class DeploymentResponse(object):
 
     """
     A message that crassus returns for events such as fail or success
@@ -9,8 +11,12 @@ class DeploymentResponse(dict):
     transmitted as JSON encoded strings, used by Gaius.
 
     It is initialized with the following parameters:
-    - status: STATUS_FAILURE or STATUS_SUCCESS, if crassus emitted,
-      if cloudformation, then the respective CFN status
+    - status: STATUS_FAILURE, STATUS_SUCCESS, STATUS_UNCHANGED (no
+      parameter value changed, the stack was not updated),
+      STATUS_PENDING (the stack was busy, the update was not applied
+      yet) or STATUS_IN_PROGRESS (the update was applied, but did not
+      finish while crassus waited for it), if crassus emitted, if
+      cloudformation, then the respective CFN status
 
     - emitter: tells which direction the response comes from:
       either EMITTER_CRASSUS or EMITTER_CFN
@@ -24,19 +30,93 @@ class DeploymentResponse(dict):
       self.version
 
     - message: the textual message for the notification.
+
+    Any further keyword arguments are extra fields of the message, e.g.
+    'resourceType' for CloudFormation events. Responses emitted by
+    crassus additionally carry 'timings', the milliseconds spent in each
+    phase of the deployment up to the notification, e.g.
+    {"load": 120.5, "merge": 0.1, "update": 310.2}.
+
+    A response is immutable, its JSON encoding is created once and
+    reused for every queue it is sent to. Fields are read like the keys
+    of a dictionary, e.g. response['stackName'].
     """
 
+    __slots__ = ('_fields', '_json')
+
     version = '1.1'
     STATUS_SUCCESS = 'success'
     STATUS_FAILURE = 'failure'
+    STATUS_UNCHANGED = 'unchanged'
+    STATUS_PENDING = 'pending'
+    STATUS_IN_PROGRESS = 'in_progress'
 
     EMITTER_CRASSUS = 'crassus'
     EMITTER_CFN = 'cloudformation'
 
-    def __init__(self, status, message, stack_name, timestamp, emitter):
-        self['version'] = self.version
-        self['emitter'] = emitter
-        self['stackName'] = stack_name
-        self['timestamp'] = timestamp
-        self['status'] = status
-        self['message'] = message
+    def __init__(self, status, message, stack_name, timestamp, emitter,
+                 **extra_fields):
+        fields = dict(extra_fields)
+        fields.update({
+            'version': self.version,
+            'emitter': emitter,
+            'stackName': stack_name,
+            'timestamp': timestamp,
+            'status': status,
+            'message': message})
+        object.__setattr__(self, '_fields', fields)
+        object.__setattr__(self, '_json', None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(
+            '{0} is immutable'.format(type(self).__name__))
+
+    __delattr__ = __setattr__
+
+    def to_json(self):
+        """
+        Return the JSON encoded message, as it is sent to the queues.
+        """
+        if self._json is None:
+            object.__setattr__(self, '_json', json.dumps(self._fields))
+        return self._json
+
+    def to_dict(self):
+        """
+        Return the fields of the message as a new dictionary.
+        """
+        return dict(self._fields)
+
+    def __getitem__(self, key):
+        return self._fields[key]
+
+    def get(self, key, default=None):
+        return self._fields.get(key, default)
+
+    def __contains__(self, key):
+        return key in self._fields
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def keys(self):
+        return self._fields.keys()
+
+    def items(self):
+        return self._fields.items()
+
+    def __eq__(self, other):
+        if isinstance(other, DeploymentResponse):
+            other = other._fields
+        return self._fields == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '{0}({1!r})'.format(type(self).__name__, self._fields)
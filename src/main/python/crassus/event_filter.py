@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+from fnmatch import fnmatchcase
+
+from crassus.utils import logger
+
+# Keys of the CloudFormation message that can be filtered on
+FILTERED_KEYS = ('ResourceStatus', 'ResourceType', 'StackName')
+STACK_LEVEL_ONLY = 'stack_level_only'
+STACK_RESOURCE_TYPE = 'AWS::CloudFormation::Stack'
+
+
+class EventFilter(object):
+
+    """
+    Decide which CloudFormation events are forwarded to the result
+    queues.
+
+    It is configured with the 'cfn_event_filter' property of the JSON
+    description of the lambda function, e.g.:
+
+        {"ResourceStatus": {"deny": ["*_IN_PROGRESS"]},
+         "ResourceType": {"allow": ["AWS::CloudFormation::Stack",
+                                    "AWS::AutoScaling::*"]},
+         "StackName": {"deny": ["test-*"]},
+         "stack_level_only": false}
+
+    Every list entry is an exact value or a shell-style wildcard pattern.
+    An event passes, if its value matches at least one 'allow' entry (if
+    there are any) and no 'deny' entry, for each of the configured keys.
+    With 'stack_level_only', only the events of the stack itself pass,
+    not the ones of its resources or nested stacks.
+
+    Without configuration, all events pass.
+    """
+
+    def __init__(self, config=None):
+        self.rules = {}
+        self.stack_level_only = False
+        if config is None:
+            return
+        if not isinstance(config, dict):
+            logger.error(
+                'cfn_event_filter must be a JSON object, but was {0}, '
+                'not filtering'.format(repr(config)))
+            return
+        for key, rule in config.items():
+            if key == STACK_LEVEL_ONLY:
+                self.stack_level_only = bool(rule)
+            elif key in FILTERED_KEYS and isinstance(rule, dict):
+                self.rules[key] = (rule.get('allow') or [],
+                                   rule.get('deny') or [])
+            else:
+                logger.warning(
+                    'Ignoring unknown cfn_event_filter rule {0}: {1}'
+                    .format(key, repr(rule)))
+
+    def _matches(self, value, patterns):
+        return any(fnmatchcase(value, pattern) for pattern in patterns)
+
+    def accepts(self, message):
+        """
+        Return whether the parsed CloudFormation message passes the
+        filter.
+        """
+        if self.stack_level_only and (
+                message.get('ResourceType') != STACK_RESOURCE_TYPE or
+                message.get('LogicalResourceId') !=
+                message.get('StackName')):
+            return False
+        for key, (allow, deny) in self.rules.items():
+            value = message.get(key) or ''
+            if allow and not self._matches(value, allow):
+                return False
+            if self._matches(value, deny):
+                return False
+        return True
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+"""
+Timing of the phases of a deployment or conversion, emitted as
+CloudWatch Embedded Metric Format (EMF) log lines.
+
+Lambda sends everything written to stdout to CloudWatch Logs, which
+extracts the metrics of every line that is an EMF JSON document. The
+lines are therefore printed as they are, not through the logger, whose
+prefix would hide them from the extraction.
+"""
+
+from __future__ import print_function
+
+import json
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+METRICS_NAMESPACE = 'Crassus'
+METRICS_UNIT = 'Milliseconds'
+# Dimension of all metrics, the name of the timed operation
+OPERATION_DIMENSION = 'Operation'
+
+# Serializes the output of the worker threads, so lines do not mix
+_output_lock = threading.Lock()
+
+
+class PhaseTimer(object):
+
+    """
+    Collect the milliseconds spent in named phases. Phases may be
+    entered more than once, their times add up. Phases may also be
+    nested, the inner time then counts for both.
+    """
+
+    def __init__(self):
+        self.timings = OrderedDict()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = (time.time() - start) * 1000
+            self.timings[name] = round(
+                self.timings.get(name, 0) + elapsed, 3)
+
+    def emit(self, operation, **properties):
+        """
+        Print the timings as an EMF document, with the operation as
+        dimension. The properties are added to the document for log
+        searches, they do not become dimensions.
+        """
+        if not self.timings:
+            return
+        document = OrderedDict([
+            ('_aws', {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': METRICS_NAMESPACE,
+                    'Dimensions': [[OPERATION_DIMENSION]],
+                    'Metrics': [
+                        {'Name': name, 'Unit': METRICS_UNIT}
+                        for name in self.timings]}]}),
+            (OPERATION_DIMENSION, operation)])
+        document.update(properties)
+        document.update(self.timings)
+        line = json.dumps(document)
+        with _output_lock:
+            print(line)
+            sys.stdout.flush()
@@ -2,19 +2,65 @@
 from __future__ import print_function
 
 import json
+import re
 
-from crassus.utils import get_lambda_config_property, sqs_send_message, logger
+from botocore.exceptions import BotoCoreError, ClientError
+from crassus.dedup import DedupWindow, DynamoDBDedupStore
+from crassus.event_filter import EventFilter
+from crassus.metrics import PhaseTimer
+from crassus.result_publisher import BackgroundResultPublisher
+from crassus.utils import (
+    get_lambda_config, get_lambda_config_property, logger)
 from deployment_response import DeploymentResponse
 
 PATTERN_KEYSPLITTER = '=\''
 PATTERN_LINESPLITTER = '\'\n'
 
+# Values of JSON numbers, the only JSON values not recognized by their
+# first character
+PATTERN_JSON_NUMBER = re.compile(r'-?\d+(\.\d+)?([eE][-+]?\d+)?$')
+JSON_START_CHARACTERS = frozenset('{["')
+JSON_LITERALS = frozenset(['true', 'false', 'null'])
+
+# Keys of the CloudFormation message that are needed for the conversion
+# and the event filter
+CONVERTED_KEYS = frozenset([
+    'ResourceStatus', 'ResourceStatusReason', 'StackName', 'Timestamp',
+    'ResourceType', 'LogicalResourceId', 'EventId'])
+
+# Seconds and number of CloudFormation events to remember for dropping
+# redelivered notifications
+EVENT_DEDUP_TTL = 3600
+EVENT_DEDUP_MAX_SIZE = 10000
+
+_event_window = DedupWindow(EVENT_DEDUP_TTL, EVENT_DEDUP_MAX_SIZE)
+
+
+def event_key(message):
+    """
+    Return the key that identifies a parsed CloudFormation event, its
+    EventId, or the stack, resource, status and time if it has none.
+    """
+    return message.get('EventId') or '|'.join(
+        unicode(message.get(key)) for key in (
+            'StackName', 'LogicalResourceId', 'ResourceStatus', 'Timestamp'))
+
 
 class OutputConverter(object):
 
     """
     Output converter class to do the message conversion for the command
     line client.
+
+    Every CloudFormation event is published once, redelivered events are
+    dropped. An event only counts as published once its message was
+    delivered to all result queues, so that the redelivery of an event
+    whose message got lost, e.g. by a timeout, is published again. The
+    events published within EVENT_DEDUP_TTL seconds are kept in memory,
+    up to EVENT_DEDUP_MAX_SIZE of them. To recognize events that are
+    redelivered to another lambda container, name a DynamoDB table in
+    the 'cfn_event_dedup_table' property of the JSON description of the
+    lambda function (see DynamoDBDedupStore).
     """
 
     event = None
@@ -25,13 +71,21 @@ class OutputConverter(object):
         self.event = event
         self.context = context
 
+    def _looks_like_json(self, value):
+        return (
+            value[:1] in JSON_START_CHARACTERS or
+            value in JSON_LITERALS or
+            PATTERN_JSON_NUMBER.match(value) is not None)
+
     def _cast_type(self, value):
         """
         Try to JSON cast the value. It can be parsed this way to dict,
-        list or integers.
+        list or integers. Only values that look like JSON are decoded.
 
         Return the string value, if nothing else succeeds.
         """
+        if not self._looks_like_json(value):
+            return value
         try:
             # Try to cast to integer, or JSON
             value = json.loads(value)
@@ -39,36 +93,123 @@ class OutputConverter(object):
         except ValueError:
             return value
 
-    def _parse_sns_message(self, sns_message):
+    def _iter_sns_message(self, sns_message, keys=None):
         """
-        Parse the received SNS message from cloudformation.
+        Scan the received SNS message from cloudformation in a single
+        pass, and lazily yield its key-value pairs.
 
         Beware: the lines are terminated with "'\n", so they must be
         split up along this pattern. There can be deviations sometimes,
         hence the workaround.
 
+        If keys is given, only the values of these keys are extracted
+        and JSON sanitized, all other lines are skipped.
+        """
+        position = 0
+        length = len(sns_message)
+        while position < length:
+            end = sns_message.find(PATTERN_LINESPLITTER, position)
+            if end == -1:
+                next_position = end = length
+                # Workaround for when the last parameter is not
+                # terminated with the same separator pattern, then a
+                # closing quote might remain.
+                if sns_message[-1] == '\'':
+                    end -= 1
+            else:
+                next_position = end + len(PATTERN_LINESPLITTER)
+            split_position = sns_message.find(
+                PATTERN_KEYSPLITTER, position, end)
+            if split_position != -1:
+                key = sns_message[position:split_position].strip()
+                if keys is None or key in keys:
+                    value = sns_message[
+                        split_position + len(PATTERN_KEYSPLITTER):end]
+                    yield key, self._cast_type(value.rstrip())
+            # Lines without the key splitter are unparseable, skip them
+            position = next_position
+
+    def _parse_sns_message(self, sns_message, keys=None):
+        """
+        Parse the received SNS message from cloudformation.
+
         Returns the parsed key-value pairs as a dictionary, while trying
-        to JSON sanitize the values.
+        to JSON sanitize the values. If keys is given, only these keys
+        are parsed.
         """
-        splitted_list = sns_message.split(PATTERN_LINESPLITTER)
-        # Workaround for when the last parameter is not terminated with
-        # the same separator pattern, then a closing quote might remain.
-        if splitted_list[-1] != '' and splitted_list[-1][-1] == '\'':
-            # Cut the last character from the last item
-            splitted_list[-1] = splitted_list[-1][:-1]
-        result_dict = {}
-        for line_item in splitted_list:
-            line_item = line_item.strip()
-            if PATTERN_KEYSPLITTER not in line_item:
-                # Unparseable line, do not parse
-                continue
-            key, value = line_item.split(PATTERN_KEYSPLITTER, 1)
-            result_dict[key] = self._cast_type(value)
-        return result_dict
+        return dict(self._iter_sns_message(sns_message, keys))
 
     def convert(self):
-        queue_url_list = get_lambda_config_property(
-            self.context, 'result_queue')
+        """
+        Convert and publish all records of the event. The time spent in
+        every phase is emitted as metrics.
+        """
+        timer = PhaseTimer()
+        with timer.phase('config'):
+            queue_url_list = get_lambda_config_property(
+                self.context, 'result_queue')
+            config = get_lambda_config(self.context) or {}
+            event_filter = EventFilter(config.get('cfn_event_filter'))
+            dedup_table = config.get('cfn_event_dedup_table')
+            dedup_store = dedup_table and DynamoDBDedupStore(
+                dedup_table, EVENT_DEDUP_TTL)
+        with BackgroundResultPublisher(context=self.context) as publisher:
+            with timer.phase('parse'):
+                published = self._convert_records(
+                    queue_url_list, event_filter, publisher, dedup_store)
+            with timer.phase('publish'):
+                undelivered = publisher.flush()
+                self._remember_delivered(published, undelivered, dedup_store)
+        timer.emit('convert', Records=len(self.event['Records']))
+
+    def _is_duplicate(self, key, dedup_store):
+        """
+        Return whether the event with the key was already published. If
+        the dedup store fails, the event counts as new, duplicates are
+        better than lost events.
+        """
+        if key in _event_window:
+            return True
+        if dedup_store is None:
+            return False
+        try:
+            return key in dedup_store
+        except (BotoCoreError, ClientError) as error:
+            logger.error(
+                'Unable to check event {0} for duplicates: {1}'.format(
+                    key, error))
+            return False
+
+    def _remember_delivered(self, published, undelivered, dedup_store):
+        """
+        Remember the keys of the published events whose messages were
+        delivered to all queues, a list of (key, message body) pairs and
+        the result of flush(). Events that were not delivered are not
+        remembered, so that their redelivery is published again.
+        """
+        undelivered_bodies = set(
+            body for message_list in undelivered.values()
+            for body in message_list)
+        for key, body in published:
+            if body in undelivered_bodies:
+                continue
+            _event_window.add(key)
+            if dedup_store is None:
+                continue
+            try:
+                dedup_store.add(key)
+            except (BotoCoreError, ClientError) as error:
+                logger.error('Unable to remember event {0}: {1}'.format(
+                    key, error))
+
+    def _convert_records(self, queue_url_list, event_filter, publisher,
+                         dedup_store=None):
+        """
+        Publish the accepted new events of the records, return the list
+        of their (key, message body) pairs.
+        """
+        published = []
+        published_keys = set()
         for event_item in self.event['Records']:
             sns_message = event_item.get('Sns', {}).get('Message')
             if sns_message is None:
@@ -76,10 +217,21 @@ class OutputConverter(object):
                     'No \'Sns\' or \'Message\' in received event: {0}'
                     .format(event_item))
                 continue
-            message = self._parse_sns_message(sns_message)
+            message = self._parse_sns_message(sns_message, CONVERTED_KEYS)
+            if not event_filter.accepts(message):
+                logger.debug('Filtered out event: {0}'.format(message))
+                continue
+            key = event_key(message)
+            if (key in published_keys or
+                    self._is_duplicate(key, dedup_store)):
+                logger.info('Dropping redelivered event: {0}'.format(key))
+                continue
             deployment_response = DeploymentResponse(
                 message['ResourceStatus'], message['ResourceStatusReason'],
                 message['StackName'], message['Timestamp'],
-                DeploymentResponse.EMITTER_CFN)
-            deployment_response['resourceType'] = message['ResourceType']
-            sqs_send_message(queue_url_list, deployment_response)
+                DeploymentResponse.EMITTER_CFN,
+                resourceType=message['ResourceType'])
+            publisher.publish(queue_url_list, deployment_response)
+            published_keys.add(key)
+            published.append((key, deployment_response.to_json()))
+        return published
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+"""
+Helpers for polling AWS until something reaches a final state, e.g. a
+stack or its change sets, within the time of the lambda invocation.
+"""
+
+from crassus.utils import get_remaining_time
+
+# Factor by which the poll interval grows while nothing happens
+POLL_INTERVAL_FACTOR = 1.5
+
+
+def call(function, *args, **kwargs):
+    """
+    Call the function right away, the caller for API calls that are
+    not made through a ThrottledCaller.
+    """
+    return function(*args, **kwargs)
+
+
+def remaining_time(context, margin):
+    """
+    Return the seconds left for polling, which keeps margin seconds of
+    the invocation of the context. None if the context does not tell.
+    """
+    remaining_time = get_remaining_time(context)
+    if remaining_time is None:
+        return None
+    return remaining_time - margin
+
+
+class PollInterval(object):
+
+    """
+    The seconds to sleep between two polls. The interval starts at
+    minimum, grows by POLL_INTERVAL_FACTOR up to maximum while a poll
+    makes no progress, and starts over at minimum once one does.
+    """
+
+    def __init__(self, minimum, maximum):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.seconds = minimum
+
+    def update(self, progressed):
+        """
+        Adapt the interval to whether the last poll made progress.
+        """
+        if progressed:
+            self.seconds = self.minimum
+        else:
+            self.seconds = min(
+                self.maximum, self.seconds * POLL_INTERVAL_FACTOR)
+
+    def exceeds(self, remaining_time):
+        """
+        Whether sleeping for the interval would exceed the remaining
+        time, never if it is None.
+        """
+        return remaining_time is not None and self.seconds > remaining_time
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+
+import threading
+from collections import OrderedDict
+
+from botocore.exceptions import BotoCoreError, ClientError
+from concurrent.futures import ThreadPoolExecutor, wait
+from crassus import utils
+from crassus.deployment_response import DeploymentResponse
+from crassus.utils import get_remaining_time, logger
+
+# Maximum number of entries SQS accepts in one SendMessageBatch call
+SQS_BATCH_SIZE = 10
+# Maximum number of queues that are sent to concurrently
+MAX_QUEUE_WORKERS = 5
+# Seconds of the invocation that are kept for returning, when draining
+# the background publisher
+DRAIN_MARGIN = 1.0
+
+
+def _chunks(items, size):
+    for index in range(0, len(items), size):
+        yield items[index:index + size]
+
+
+class ResultPublisher(object):
+
+    """
+    Buffer DeploymentResponse messages during an invocation and send
+    them to their SQS queues with SendMessageBatch, SQS_BATCH_SIZE
+    messages per call and queue.
+
+    The queues are sent to concurrently by a bounded pool of threads,
+    so a slow or throttled queue does not delay the others.
+
+    publish() has the same signature as sqs_send_message(). Use the
+    publisher as a context manager, so that the buffered messages are
+    flushed when the block is left, even on errors:
+
+        with ResultPublisher() as publisher:
+            publisher.publish(queue_url_list, deployment_response)
+    """
+
+    def __init__(self, max_workers=MAX_QUEUE_WORKERS):
+        self.max_workers = max_workers
+        self._messages = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def publish(self, queue_url_list, message):
+        """
+        Buffer the message for all given queues. The message is JSON
+        encoded once, regardless of the number of queues.
+        """
+        if not isinstance(message, DeploymentResponse):
+            logger.error(
+                'publish: got wrong type of message parameter: {0}: {1}'
+                .format(type(message), repr(message)))
+            return
+        message_str = message.to_json()
+        with self._lock:
+            for queue_url in queue_url_list or []:
+                self._messages.setdefault(queue_url, []).append(message_str)
+
+    def flush(self):
+        """
+        Send all buffered messages. Entries the batch call reports as
+        failed are retried one by one with SendMessage.
+
+        Return a dictionary of queue URL to the list of message bodies
+        that could not be delivered to it, an empty list means success.
+        """
+        with self._lock:
+            messages = self._messages
+            self._messages = OrderedDict()
+        if not messages:
+            return {}
+        max_workers = min(self.max_workers, len(messages))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                (queue_url, executor.submit(self._send, queue_url, bodies))
+                for queue_url, bodies in messages.items()]
+            return dict(
+                (queue_url, future.result()) for queue_url, future in futures)
+
+    def _send(self, queue_url, message_list):
+        try:
+            failed = []
+            for chunk in _chunks(message_list, SQS_BATCH_SIZE):
+                failed.extend(self._send_batch(queue_url, chunk))
+            return [
+                message_str for message_str in failed
+                if not self._send_single(queue_url, message_str)]
+        except Exception:
+            logger.exception(
+                'Unexpected error while sending to {0}'.format(queue_url))
+            return list(message_list)
+
+    def _send_single(self, queue_url, message_str):
+        """
+        Send one message, return whether it was delivered.
+        """
+        try:
+            utils.aws_sqs.send_message(
+                QueueUrl=queue_url, MessageBody=message_str, DelaySeconds=0)
+            return True
+        except (BotoCoreError, ClientError) as error:
+            logger.error('Unable to send message to {0}: {1}'.format(
+                queue_url, error))
+            return False
+
+    def _send_batch(self, queue_url, chunk):
+        """
+        Send one chunk of messages, return the bodies of the failed
+        entries.
+        """
+        entries = [
+            {'Id': str(index), 'MessageBody': message_str, 'DelaySeconds': 0}
+            for index, message_str in enumerate(chunk)]
+        try:
+            response = utils.aws_sqs.send_message_batch(
+                QueueUrl=queue_url, Entries=entries)
+        except (BotoCoreError, ClientError) as error:
+            logger.warning(
+                'Batch sending to {0} failed, retrying messages one by one: '
+                '{1}'.format(queue_url, error))
+            return list(chunk)
+        failed = response.get('Failed', [])
+        if failed:
+            logger.warning(
+                '{0} messages of batch to {1} failed, retrying them: {2}'
+                .format(len(failed), queue_url, repr(failed)))
+        return [chunk[int(entry['Id'])] for entry in failed]
+
+
+class BackgroundResultPublisher(ResultPublisher):
+
+    """
+    Send published messages right away from background threads, while
+    the caller goes on with its work.
+
+    Every queue has at most one sender at a time, which sends all
+    messages that were buffered for the queue so far, in batches of
+    SQS_BATCH_SIZE, until its buffer is empty. Messages published while
+    a batch is on its way are sent with the next one.
+
+    flush() waits for the senders to finish, but only until the given
+    timeout, by default until DRAIN_MARGIN seconds before the lambda
+    invocation of the context times out. Messages that are not confirmed
+    by then are reported as undelivered.
+    """
+
+    def __init__(self, max_workers=MAX_QUEUE_WORKERS, context=None):
+        super(BackgroundResultPublisher, self).__init__(max_workers)
+        self.context = context
+        self._executor = None
+        # queue URL -> future of its running sender
+        self._senders = {}
+        # queue URL -> bodies the sender is sending right now
+        self._in_flight = {}
+        self._undelivered = OrderedDict()
+
+    def publish(self, queue_url_list, message):
+        """
+        Buffer the message for all given queues and start sending it.
+        """
+        super(BackgroundResultPublisher, self).publish(
+            queue_url_list, message)
+        with self._lock:
+            for queue_url in self._messages:
+                self._undelivered.setdefault(queue_url, [])
+                if queue_url not in self._senders:
+                    if self._executor is None:
+                        self._executor = ThreadPoolExecutor(
+                            max_workers=self.max_workers)
+                    self._senders[queue_url] = self._executor.submit(
+                        self._sender, queue_url)
+
+    def _sender(self, queue_url):
+        while True:
+            with self._lock:
+                message_list = self._messages.pop(queue_url, None)
+                if not message_list:
+                    del self._senders[queue_url]
+                    return
+                self._in_flight[queue_url] = message_list
+            undelivered = self._send(queue_url, message_list)
+            with self._lock:
+                del self._in_flight[queue_url]
+                self._undelivered.setdefault(queue_url, []).extend(
+                    undelivered)
+
+    def drain_timeout(self):
+        remaining_time = get_remaining_time(self.context)
+        if remaining_time is None:
+            return None
+        return max(0, remaining_time - DRAIN_MARGIN)
+
+    def flush(self, timeout=None):
+        """
+        Wait for all messages to be sent, at most timeout seconds, by
+        default the drain_timeout() of the lambda invocation.
+
+        Return a dictionary of queue URL to the list of message bodies
+        that could not be delivered to it, or were not confirmed within
+        the timeout. An empty list means success.
+        """
+        if timeout is None:
+            timeout = self.drain_timeout()
+        with self._lock:
+            senders = list(self._senders.values())
+        not_done = wait(senders, timeout).not_done
+        with self._lock:
+            undelivered = self._undelivered
+            self._undelivered = OrderedDict()
+            if not_done:
+                # The senders may still deliver these, but too late
+                for queue_url, message_list in (
+                        self._in_flight.items() + self._messages.items()):
+                    undelivered.setdefault(queue_url, []).extend(
+                        message_list)
+                self._messages = OrderedDict()
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+        for queue_url, message_list in undelivered.items():
+            if message_list:
+                logger.error(
+                    '{0} messages could not be delivered to {1}: {2}'.format(
+                        len(message_list), queue_url, message_list))
+        return dict(undelivered)
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+from crassus.event_filter import STACK_RESOURCE_TYPE
+from crassus.polling import PollInterval, call, remaining_time
+from crassus.utils import logger
+
+# Stack status of a successfully finished update
+STACK_UPDATE_COMPLETE = 'UPDATE_COMPLETE'
+
+# Seconds between two polls, the interval grows while nothing happens
+MIN_POLL_INTERVAL = 2.0
+MAX_POLL_INTERVAL = 15.0
+# Seconds of the invocation that are kept for reporting the result
+WAIT_MARGIN = 5.0
+
+
+def is_terminal(stack_status):
+    return not stack_status.endswith('_IN_PROGRESS')
+
+
+class StackWaiter(object):
+
+    """
+    Follow the events of a stack until it reaches a terminal status,
+    e.g. UPDATE_COMPLETE or UPDATE_ROLLBACK_COMPLETE.
+
+    start() remembers the newest event before the update. Every poll
+    only fetches the events since the last one seen, the pages of
+    describe_stack_events are read from the newest event until that
+    one. The poll interval starts at MIN_POLL_INTERVAL and grows up to
+    MAX_POLL_INTERVAL while no new events arrive.
+
+    Waiting ends WAIT_MARGIN seconds before the lambda invocation of the
+    context times out, or timeout seconds after the waiter was created,
+    whichever comes first. The API calls are made through the caller, e.g.
+    a ThrottledCaller.
+    """
+
+    def __init__(self, client, stack_name, context=None, caller=call,
+                 timeout=None):
+        self.client = client
+        self.stack_name = stack_name
+        self.context = context
+        self.caller = caller
+        self.deadline = None if timeout is None else time.time() + timeout
+        self.last_event_id = None
+        self.stack_status = None
+        # Reasons of the failed resources, in the order of the events
+        self.failure_reasons = []
+
+    def start(self):
+        """
+        Remember the newest event of the stack, call before updating.
+        """
+        events = self.caller(
+            self.client.describe_stack_events,
+            StackName=self.stack_name)['StackEvents']
+        if events:
+            self.last_event_id = events[0]['EventId']
+
+    def new_events(self):
+        """
+        Return the events since the last seen one, oldest first. Without
+        a last seen event, only the first page is read.
+        """
+        new_events = []
+        arguments = {'StackName': self.stack_name}
+        while True:
+            response = self.caller(
+                self.client.describe_stack_events, **arguments)
+            for event in response['StackEvents']:
+                if event['EventId'] == self.last_event_id:
+                    break
+                new_events.append(event)
+            else:
+                if (self.last_event_id is not None and
+                        response.get('NextToken')):
+                    arguments['NextToken'] = response['NextToken']
+                    continue
+            break
+        new_events.reverse()
+        if new_events:
+            self.last_event_id = new_events[-1]['EventId']
+        return new_events
+
+    def _track(self, event):
+        if (event.get('ResourceType') == STACK_RESOURCE_TYPE and
+                event.get('LogicalResourceId') == event.get('StackName')):
+            self.stack_status = event['ResourceStatus']
+        elif (event.get('ResourceStatus', '').endswith('_FAILED') and
+                event.get('ResourceStatusReason')):
+            self.failure_reasons.append('{0}: {1}'.format(
+                event.get('LogicalResourceId'),
+                event['ResourceStatusReason']))
+
+    def remaining_time(self):
+        time_left = remaining_time(self.context, WAIT_MARGIN)
+        if self.deadline is not None:
+            until_deadline = self.deadline - time.time()
+            if time_left is None or until_deadline < time_left:
+                time_left = until_deadline
+        return time_left
+
+    def wait(self):
+        """
+        Poll the stack events until the stack reaches a terminal status,
+        or the time is up. Return the last seen stack status, None if
+        the update did not show up yet.
+        """
+        interval = PollInterval(MIN_POLL_INTERVAL, MAX_POLL_INTERVAL)
+        while True:
+            events = self.new_events()
+            for event in events:
+                self._track(event)
+            if self.stack_status is not None and is_terminal(
+                    self.stack_status):
+                return self.stack_status
+            interval.update(bool(events))
+            if interval.exceeds(self.remaining_time()):
+                logger.warning(
+                    'Stopped waiting for stack {0} in status {1}, the time '
+                    'is up'.format(self.stack_name, self.stack_status))
+                return self.stack_status
+            time.sleep(interval.seconds)
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+"""
+Rate limiting and retries for AWS API calls that are throttled under
+load.
+
+All calls to the same account and region share a token bucket, whose
+rate adapts to the throttling errors AWS returns: it is halved on every
+throttling error and slowly grows back with successful calls. Throttled
+calls are retried with jittered exponential backoff, as long as the
+remaining time of the lambda invocation allows it. So are calls that
+failed for transient reasons, i.e. server errors and errors of the
+connection to the endpoint, which do not change the rate.
+"""
+
+import random
+import threading
+import time
+
+from botocore.exceptions import (
+    ClientError, ConnectionError, HTTPClientError)
+from crassus.utils import get_remaining_time, logger
+
+THROTTLING_ERROR_CODES = frozenset([
+    'Throttling', 'ThrottlingException', 'RequestLimitExceeded',
+    'TooManyRequestsException'])
+# Error codes of server side failures, also retried
+TRANSIENT_ERROR_CODES = frozenset([
+    'InternalFailure', 'InternalError', 'ServiceUnavailable',
+    'RequestTimeout', 'RequestTimeoutException'])
+# Errors of the connection, e.g. EndpointConnectionError or a read timeout
+TRANSIENT_EXCEPTIONS = (ConnectionError, HTTPClientError)
+
+# Calls per second and burst size of a token bucket
+DEFAULT_RATE = 5.0
+MIN_RATE = 0.5
+RATE_INCREASE = 0.1
+BUCKET_CAPACITY = 10
+
+MAX_ATTEMPTS = 6
+BASE_DELAY = 0.5
+MAX_DELAY = 8.0
+# Seconds of the invocation that are left for reporting the result
+TIME_BUDGET_MARGIN = 2.0
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+class RateLimitTimeout(Exception):
+
+    """
+    Raised instead of making a call, when the remaining time of the
+    invocation does not allow to wait for the rate limit.
+    """
+
+
+class TokenBucket(object):
+
+    """
+    Thread safe token bucket with an adjustable rate.
+    """
+
+    def __init__(self, rate=DEFAULT_RATE, capacity=BUCKET_CAPACITY):
+        self.rate = rate
+        self.max_rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        # A clock that was set back must not cost tokens
+        elapsed = max(0, now - self._updated)
+        self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+        self._updated = now
+
+    def take(self):
+        """
+        Take a token, return the seconds to wait until it is available.
+        The token is taken right away, so the caller has to wait that
+        long before making its call.
+        """
+        with self._lock:
+            self._refill(time.time())
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.rate
+
+    def put_back(self):
+        """
+        Return a taken token that was not used for a call.
+        """
+        with self._lock:
+            self._tokens = min(self.capacity, self._tokens + 1)
+
+    def throttled(self):
+        with self._lock:
+            self.rate = max(MIN_RATE, self.rate / 2)
+
+    def succeeded(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + RATE_INCREASE)
+
+
+def get_bucket(key):
+    """
+    Return the shared token bucket for the key, e.g. an (account,
+    region) tuple.
+    """
+    with _buckets_lock:
+        if key not in _buckets:
+            _buckets[key] = TokenBucket()
+        return _buckets[key]
+
+
+def is_throttling_error(error):
+    return (isinstance(error, ClientError) and
+            error.response.get('Error', {}).get('Code') in
+            THROTTLING_ERROR_CODES)
+
+
+def is_transient_error(error):
+    """
+    Whether the error is worth a retry without being throttling, i.e. a
+    server error or an error of the connection.
+    """
+    if isinstance(error, TRANSIENT_EXCEPTIONS):
+        return True
+    if not isinstance(error, ClientError):
+        return False
+    return (error.response.get('Error', {}).get('Code') in
+            TRANSIENT_ERROR_CODES or
+            error.response.get('ResponseMetadata', {}).get(
+                'HTTPStatusCode', 0) >= 500)
+
+
+class ThrottledCaller(object):
+
+    """
+    Call functions that make AWS API calls through the token bucket of
+    the key, and retry them on throttling and transient errors.
+
+    The lambda context, if given, limits waiting and retrying to the
+    remaining time of the invocation, minus TIME_BUDGET_MARGIN. If there
+    is no time left to wait for a token, RateLimitTimeout is raised
+    without making the call. When the attempts or the time are used up,
+    the last throttling or transient error is raised. All other errors
+    are raised right away.
+    """
+
+    def __init__(self, key, context=None):
+        self.key = key
+        self.context = context
+        self.bucket = get_bucket(key)
+
+    def remaining_time(self):
+        """
+        Seconds left for waiting, None if there is no known limit.
+        """
+        remaining_time = get_remaining_time(self.context)
+        if remaining_time is None:
+            return None
+        return remaining_time - TIME_BUDGET_MARGIN
+
+    def _wait(self, seconds):
+        """
+        Sleep for the given seconds, return False without sleeping if
+        that would exceed the time budget.
+        """
+        if seconds <= 0:
+            return True
+        remaining_time = self.remaining_time()
+        if remaining_time is not None and seconds > remaining_time:
+            return False
+        time.sleep(seconds)
+        return True
+
+    def __call__(self, function, *args, **kwargs):
+        attempt = 0
+        while True:
+            attempt += 1
+            if not self._wait(self.bucket.take()):
+                self.bucket.put_back()
+                raise RateLimitTimeout(
+                    'No time left to wait for the rate limit of {0}'
+                    .format(self.key))
+            try:
+                result = function(*args, **kwargs)
+            except Exception as error:
+                if is_throttling_error(error):
+                    self.bucket.throttled()
+                elif not is_transient_error(error):
+                    raise
+                delay = random.uniform(
+                    0, min(MAX_DELAY, BASE_DELAY * 2 ** attempt))
+                if attempt >= MAX_ATTEMPTS or not self._wait(delay):
+                    logger.error(
+                        'Giving up on failing call for {0} after {1} '
+                        'attempts: {2}'.format(self.key, attempt, error))
+                    raise
+                logger.info(
+                    'Failed call for {0}, retrying in {1:.2f}s: {2}'.format(
+                        self.key, delay, error))
+                continue
+            self.bucket.succeeded()
+            return result
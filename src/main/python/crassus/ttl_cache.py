@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache(object):
+
+    """
+    A mapping of up to max_size keys to values, each of which is kept
+    for ttl seconds after it was put, e.g. the described data of stacks.
+
+    The cache lives in memory, so it is only shared by the invocations
+    of the same (warm) lambda container. When it is full, the least
+    recently put keys are forgotten first.
+    """
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        # key -> (expiry time, value), in the order they were put
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Return the value of the key, the default if it was not put
+        within the last ttl seconds.
+        """
+        with self._lock:
+            self._expire(time.time())
+            entry = self._entries.get(key)
+            return default if entry is None else entry[1]
+
+    def put(self, key, value):
+        """
+        Keep the value of the key for ttl seconds from now.
+        """
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            self._put(key, value, now)
+
+    def invalidate(self, key):
+        """
+        Forget the key, e.g. after the stack was updated.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def _put(self, key, value, now):
+        self._entries.pop(key, None)
+        self._entries[key] = (now + self.ttl, value)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def _expire(self, now):
+        # All keys have the same ttl, so the expired ones are first
+        while self._entries:
+            expires, _ = next(self._entries.itervalues())
+            if expires > now:
+                break
+            self._entries.popitem(last=False)
+
+    def __contains__(self, key):
+        with self._lock:
+            self._expire(time.time())
+            return key in self._entries
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
@@ -3,35 +3,60 @@
 import json
 import logging
 import os
+import threading
+import time
 
-import boto3
+from crassus.clients import LazyClient
 from crassus.deployment_response import DeploymentResponse
 
 """Utility functions module."""
 
-aws_cf = boto3.client('cloudformation')
-aws_sqs = boto3.client('sqs')
-aws_lambda = boto3.client('lambda')
+# The clients are created on first use, not at import time
+aws_sqs = LazyClient('sqs')
+aws_lambda = LazyClient('lambda')
+
+# Seconds the decoded lambda function configuration is served from memory
+LAMBDA_CONFIG_TTL = 300
+
+_VERSION = None
+_lambda_config_cache = {}
+_lambda_config_lock = threading.Lock()
+
+
+def _read_VERSION(file_path):
+    """
+    Return the content of the VERSION file, None if it is not readable.
+    """
+    try:
+        with open(file_path, 'r') as fp:
+            return 'v{0}'.format(fp.read().strip())
+    except IOError:
+        return None
 
 
 def _get_VERSION():
     """
-    Walk up the directory tree while trying to find a file named 'VERSION'.
+    Try to find a file named 'VERSION', first in the lambda task root,
+    then while walking up the directory tree.
 
-    If the file is found and readable, return its content, if not, return None.
+    If the file is found and readable, return its content, if not, return
+    'NO_VERSION'. The result is cached for the lifetime of the process.
     """
+    global _VERSION
+    if _VERSION is not None:
+        return _VERSION
+    task_root = os.environ.get('LAMBDA_TASK_ROOT')
+    if task_root:
+        _VERSION = _read_VERSION(os.path.join(task_root, 'VERSION'))
     actual_dir = os.path.dirname(os.path.realpath(__file__))
-    while True:
-        file_path = os.path.join(actual_dir, 'VERSION')
-        try:
-            with open(file_path, 'r') as fp:
-                return 'v{0}'.format(fp.read())
-        except IOError:
-            if os.path.realpath(actual_dir) == '/':
-                # We are at the top level, exit
-                return 'NO_VERSION'
+    while _VERSION is None:
+        _VERSION = _read_VERSION(os.path.join(actual_dir, 'VERSION'))
+        if os.path.realpath(actual_dir) == '/':
+            # We are at the top level, exit
+            _VERSION = _VERSION or 'NO_VERSION'
         # Iterate with the parent directory
         actual_dir = os.path.dirname(actual_dir)
+    return _VERSION
 
 
 def sqs_send_message(queue_url_list, message):
@@ -39,44 +64,101 @@ def sqs_send_message(queue_url_list, message):
     Send an message to a given SQS queue. The function is not foolproof,
     you should have the rights to transmit to the SQS queue.
     """
-    if type(message) is not DeploymentResponse:
+    if not isinstance(message, DeploymentResponse):
         logger.error(
             'sqs_send_message: got wrong type of message parameter: {0}: {1}'
             .format(type(message), repr(message)))
         return
-    message_str = json.dumps(message)
+    message_str = message.to_json()
     for queue_url in queue_url_list:
         aws_sqs.send_message(
             QueueUrl=queue_url, MessageBody=message_str, DelaySeconds=0)
 
 
-def get_lambda_config_property(context, property_name):
+def get_remaining_time(context):
     """
-    Extract JSON properties from the JSON encoded description.
+    Return the seconds left until the lambda invocation times out, None
+    if the context does not tell, e.g. for local invocations.
+    """
+    get_remaining_time_in_millis = getattr(
+        context, 'get_remaining_time_in_millis', None)
+    if get_remaining_time_in_millis is None:
+        return None
+    return get_remaining_time_in_millis() / 1000.0
 
-    Return the value for the property, None if not found.
+
+def _load_lambda_config(function_arn, qualifier):
+    """
+    Fetch the configuration of the lambda function and decode the JSON
+    encoded description.
+
+    Return the decoded configuration, None if it is not valid JSON.
     """
-    function_arn = context.invoked_function_arn
-    qualifier = context.function_version
     description = aws_lambda.get_function_configuration(
         FunctionName=function_arn,
         Qualifier=qualifier
     )['Description']
     try:
-        data = json.loads(description)
-        return_value = data[property_name]
-        logger.debug('Extracted {0} property: %{1}'.format(
-            property_name, repr(return_value)))
-        return return_value
+        return json.loads(description)
     except ValueError:
         logger.error(
             'Description of function must contain JSON, but was "{0}"'
             .format(description))
+
+
+def get_lambda_config(context):
+    """
+    Extract the JSON encoded configuration from the description of the
+    lambda function.
+
+    The decoded configuration is cached per function ARN and version for
+    LAMBDA_CONFIG_TTL seconds, so warm containers do not have to call
+    GetFunctionConfiguration again. The returned value is shared, do not
+    modify it.
+
+    Return the decoded configuration, None if it is not valid JSON.
+    """
+    cache_key = (context.invoked_function_arn, context.function_version)
+    now = time.time()
+    # The lock is held during the API call, so concurrent workers wait
+    # for the first one instead of fetching the configuration as well.
+    with _lambda_config_lock:
+        cached = _lambda_config_cache.get(cache_key)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+        config = _load_lambda_config(*cache_key)
+        _lambda_config_cache[cache_key] = (now + LAMBDA_CONFIG_TTL, config)
+    return config
+
+
+def clear_lambda_config_cache():
+    """
+    Forget all cached lambda function configurations.
+    """
+    with _lambda_config_lock:
+        _lambda_config_cache.clear()
+
+
+def get_lambda_config_property(context, property_name):
+    """
+    Extract JSON properties from the JSON encoded description.
+
+    Return the value for the property, None if not found.
+    """
+    config = get_lambda_config(context)
+    if config is None:
+        return
+    try:
+        return_value = config[property_name]
+        logger.debug('Extracted {0} property: %{1}'.format(
+            property_name, repr(return_value)))
+        return return_value
     except KeyError:
         logger.error(
             'Unable to find \'{0}\' property in the JSON description.'
             .format(property_name))
 
+
 logger = logging.getLogger('crassus-{0}'.format(_get_VERSION()))
 logger.setLevel(logging.DEBUG)
 consoleLogger = logging.StreamHandler()
@@ -1,11 +1,26 @@
 from __future__ import print_function
-from crassus import Crassus
+from crassus import BatchDeployer
 from crassus.output_converter import OutputConverter
 
 
 def handler(event, context):
-    crassus = Crassus(event, context)
-    crassus.deploy()
+    """
+    Deploy the stack updates of all SNS records in the received event.
+    """
+    batch_deployer = BatchDeployer(event, context)
+    batch_deployer.deploy()
+
+
+def sqs_handler(event, context):
+    """
+    Deploy the stack updates of a batch of SQS messages. Return the
+    messages whose update failed, so that only these are retried.
+    Updates of busy stacks are pending, they are received again.
+    """
+    batch_deployer = BatchDeployer(
+        event, context, pending_busy_updates=True)
+    batch_deployer.deploy()
+    return batch_deployer.batch_item_failures()
 
 
 def cfn_output_converter(event, context):
@@ -0,0 +1,388 @@
+import json
+import threading
+import unittest
+
+from botocore.exceptions import ClientError
+from crassus import batch_deployer as batch_deployer_module
+from crassus.batch_deployer import DEFAULT_MAX_WORKERS, BatchDeployer
+from crassus.deployer import StackUpdateParameter
+from crassus.deployment_response import DeploymentResponse
+from mock import Mock, patch
+
+
+def sqs_record(stack_name, message_id):
+    return {
+        'eventSource': 'aws:sqs',
+        'messageId': message_id,
+        'body': json.dumps({
+            'version': '1',
+            'stackName': stack_name,
+            'region': 'eu-west-1',
+            'parameters': {'KEY': 'VALUE'}})
+    }
+
+
+def bulk_record(message_id, **selector):
+    message = {
+        'version': '2',
+        'region': 'eu-west-1',
+        'parameters': {'KEY': 'VALUE'}}
+    message.update(selector)
+    return {
+        'eventSource': 'aws:sqs',
+        'messageId': message_id,
+        'body': json.dumps(message)}
+
+
+def sns_record(stack_name, parameters=None, message_id=None,
+               region='eu-west-1'):
+    return {
+        'EventSource': 'aws:sns',
+        'Sns': {
+            'MessageId': message_id or 'MESSAGE-ID-{0}'.format(stack_name),
+            'Message': json.dumps({
+                'version': '1',
+                'stackName': stack_name,
+                'region': region,
+                'parameters': parameters or {'KEY': 'VALUE'}})
+        }
+    }
+
+
+class TestBatchDeployer(unittest.TestCase):
+
+    def setUp(self):
+        self.context = Mock(invoked_function_arn='any_arn',
+                            function_version='any_version')
+        self.context.get_remaining_time_in_millis.return_value = 60000
+        self.event = {'Records': [
+            sns_record('STACK1'), sns_record('STACK2'), sns_record('STACK3')]}
+
+        self.patch_logger = patch('crassus.batch_deployer.logger')
+        self.mock_logger = self.patch_logger.start()
+
+        self.patch_config = patch('crassus.batch_deployer.get_lambda_config')
+        self.mock_config = self.patch_config.start()
+        self.mock_config.return_value = {}
+
+        batch_deployer_module._dedup_window.clear()
+
+        # Keep the printed EMF metrics out of the test output
+        patcher = patch('crassus.metrics.print', create=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.patch_logger.stop()
+        self.patch_config.stop()
+        batch_deployer_module._dedup_window.clear()
+
+    def crassus_factory(self, responses, deployed_in=None, failed=(),
+                        change_sets=()):
+        """
+        Return a side effect for the mocked Crassus class, whose
+        instances return the response for their stack from deploy(). The
+        updates of the failed stacks end with the failure status. The
+        stacks in change_sets return their response from
+        finish_change_set() instead. A notification sets the status, and
+        the (status, message) pair as the response.
+        """
+        def create_crassus(event, context, stack_update_parameters,
+                           publisher=None, pending_busy_updates=False):
+            stack_name = stack_update_parameters.stack_name
+            crassus = Mock(stack_name=stack_name, change_set=None,
+                           pending_busy_updates=pending_busy_updates,
+                           status='failure' if stack_name in failed
+                           else 'success',
+                           region=stack_update_parameters.region,
+                           stack_update_parameters=stack_update_parameters)
+
+            def deploy(finish_change_set=True):
+                if deployed_in is not None:
+                    deployed_in[stack_name] = threading.current_thread()
+                if stack_name in change_sets and not finish_change_set:
+                    crassus.change_set = 'CHANGE-SET-{0}'.format(stack_name)
+                    return None
+                return responses[stack_name]
+
+            def finish_change_set():
+                crassus.change_set = None
+                return responses[stack_name]
+
+            def notify(status, message):
+                crassus.status = status
+                crassus.response = (status, message)
+            crassus.deploy.side_effect = deploy
+            crassus.finish_change_set.side_effect = finish_change_set
+            crassus.notify.side_effect = notify
+            return crassus
+        return create_crassus
+
+    def test_parse_records_returns_one_parameter_per_record(self):
+        batch_deployer = BatchDeployer(self.event, self.context)
+        parameters = batch_deployer.parse_records()
+        self.assertEqual(
+            [item.stack_name for item in parameters],
+            ['STACK1', 'STACK2', 'STACK3'])
+
+    def test_parse_records_skips_invalid_records(self):
+        self.event['Records'].insert(1, {'Sns': {'Message': 'NO JSON'}})
+        self.event['Records'].insert(1, {'foo': 1})
+        batch_deployer = BatchDeployer(self.event, self.context)
+        parameters = batch_deployer.parse_records()
+        self.assertEqual(
+            [item.stack_name for item in parameters],
+            ['STACK1', 'STACK2', 'STACK3'])
+        self.assertEqual(self.mock_logger.error.call_count, 2)
+
+    @patch('crassus.batch_deployer.Crassus')
+    def test_deploy_deploys_every_record(self, crassus_mock):
+        crassus_mock.side_effect = self.crassus_factory({
+            'STACK1': 'RESPONSE1', 'STACK2': None, 'STACK3': 'RESPONSE3'})
+        batch_deployer = BatchDeployer(self.event, self.context)
+        responses = batch_deployer.deploy()
+        self.assertEqual(crassus_mock.call_count, 3)
+        self.assertEqual(
+            [args[0][2].stack_name for args in crassus_mock.call_args_list],
+            ['STACK1', 'STACK2', 'STACK3'])
+        self.assertEqual(responses, ['RESPONSE1', 'RESPONSE3'])
+
+    @patch('crassus.batch_deployer.BackgroundResultPublisher')
+    @patch('crassus.batch_deployer.PhaseTimer')
+    @patch('crassus.batch_deployer.Crassus')
+    def test_deploy_emits_timings(
+            self, crassus_mock, timer_mock, publisher_mock):
+        crassus_mock.side_effect = self.crassus_factory({
+            'STACK1': 'RESPONSE1', 'STACK2': None, 'STACK3': 'RESPONSE3'})
+        BatchDeployer(self.event, self.context).deploy()
+        publisher_mock.return_value.__enter__.return_value.flush\
+            .assert_called_once_with()
+        timer_mock.return_value.emit.assert_called_once_with(
+            'batch', Updates=3)
+
+    @patch('crassus.batch_deployer.Crassus')
+    def test_deploy_uses_worker_threads(self, crassus_mock):
+        deployed_in = {}
+        crassus_mock.side_effect = self.crassus_factory(
+            {'STACK1': 1, 'STACK2': 2, 'STACK3': 3}, deployed_in)
+        batch_deployer = BatchDeployer(self.event, self.context)
+        self.assertEqual(batch_deployer.deploy(), [1, 2, 3])
+        self.assertNotIn(threading.current_thread(), deployed_in.values())
+
+    @patch('crassus.batch_deployer.Crassus')
+    def test_deploy_serially_with_one_worker(self, crassus_mock):
+        deployed_in = {}
+        crassus_mock.side_effect = self.crassus_factory(
+            {'STACK1': 1, 'STACK2': 2, 'STACK3': 3}, deployed_in)
+        batch_deployer = BatchDeployer(self.event, self.context, 1)
+        self.assertEqual(batch_deployer.deploy(), [1, 2, 3])
+        self.assertEqual(
+            set(deployed_in.values()), set([threading.current_thread()]))
+
+    @patch('crassus.batch_deployer.Crassus')
+    def test_updates_of_busy_stacks_are_pending_on_request(self, crassus_mock):
+        crassus_mock.side_effect = self.crassus_factory(
+            {'STACK1': 1, 'STACK2': 2, 'STACK3': 3})
+        BatchDeployer(self.event, self.context).deploy()
+        self.assertFalse(any(
+            args[0][4] for args in crassus_mock.call_args_list))
+        crassus_mock.reset_mock()
+        batch_deployer_module._dedup_window.clear()
+        BatchDeployer(self.event, self.context,
+                      pending_busy_updates=True).deploy()
+        self.assertEqual(crassus_mock.call_count, 3)
+        self.assertTrue(all(
+            args[0][4] for args in crassus_mock.call_args_list))
+
+    @patch('crassus.batch_deployer.Crassus')
+    def test_deploy_continues_after_unexpected_error(self, crassus_mock):
+        crassus_mock.side_effect = self.crassus_factory(
+            {'STACK1': 1, 'STACK3': 3})
+        batch_deployer = BatchDeployer(self.event, self.context)
+        responses = batch_deployer.deploy()
+        self.assertEqual(responses[::2], [1, 3])
+        self.assertEqual(responses[1][0], 'failure')
+        self.assertTrue(responses[1][1].startswith(
+            'Problem while updating stack STACK2: '))
+        self.assertEqual(self.mock_logger.exception.call_count, 1)
+        self.assertEqual(
+            batch_deployer.statuses[(None, None, 'eu-west-1', 'STACK2')],
+            'failure')
+
+    @patch('crassus.batch_deployer.wait_for_change_sets')
+    @patch('crassus.batch_deployer.Crassus')
+    def test_deploy_waits_for_all_change_sets_at_once(
+            self, crassus_mock, wait_mock):
+        crassus_mock.side_effect = self.crassus_factory(
+            {'STACK1': 1, 'STACK2': 2, 'STACK3': 3}, failed=['STACK3'],
+            change_sets=['STACK1', 'STACK3'])
+        batch_deployer = BatchDeployer(self.event, self.context)
+        self.assertEqual(batch_deployer.deploy(), [1, 2, 3])
+        wait_mock.assert_called_once_with(
+            ['CHANGE-SET-STACK1', 'CHANGE-SET-STACK3'], self.context)
+        self.assertEqual(batch_deployer.batch_item_failures(), {
+            'batchItemFailures': [{'itemIdentifier': 'MESSAGE-ID-STACK3'}]})
+
+    @patch('crassus.batch_deployer.wait_for_change_sets', Mock())
+    @patch('crassus.batch_deployer.Crassus')
+    def test_deploy_finishes_change_sets_serially_with_one_worker(
+            self, crassus_mock):
+        crassus_mock.side_effect = self.crassus_factory(
+            {'STACK1': 1, 'STACK2': 2, 'STACK3': 3}, change_sets=['STACK2'])
+        batch_deployer = BatchDeployer(self.event, self.context, 1)
+        self.assertEqual(batch_deployer.deploy(), [1, 2, 3])
+
+    def test_max_workers_defaults(self):
+        batch_deployer = BatchDeployer(self.event, self.context)
+        self.assertEqual(batch_deployer.max_workers, DEFAULT_MAX_WORKERS)
+
+    def test_max_workers_from_lambda_config(self):
+        self.mock_config.return_value = {'max_workers': 2}
+        batch_deployer = BatchDeployer(self.event, self.context)
+        self.assertEqual(batch_deployer.max_workers, 2)
+
+    def test_max_workers_without_lambda_config(self):
+        self.mock_config.return_value = None
+        batch_deployer = BatchDeployer(self.event, self.context)
+        self.assertEqual(batch_deployer.max_workers, DEFAULT_MAX_WORKERS)
+
+    @patch('crassus.batch_deployer.Crassus')
+    def test_deploy_coalesces_updates_of_the_same_stack(self, crassus_mock):
+        crassus_mock.side_effect = self.crassus_factory(
+            {'STACK1': 1, 'STACK2': 2})
+        self.event['Records'] = [
+            sns_record('STACK1', {'A': '1', 'B': '1'}, 'ID1'),
+            sns_record('STACK2', {'A': '1'}, 'ID2'),
+            sns_record('STACK1', {'B': '2', 'C': '2'}, 'ID3')]
+        batch_deployer = BatchDeployer(self.event, self.context)
+        self.assertEqual(batch_deployer.deploy(), [1, 2])
+        deployed = [args[0][2] for args in crassus_mock.call_args_list]
+        self.assertEqual(
+            [item.stack_name for item in deployed], ['STACK1', 'STACK2'])
+        self.assertEqual(deployed[0], {'A': '1', 'B': '2', 'C': '2'})
+        self.assertEqual(deployed[0].message_ids, ['ID1', 'ID3'])
+
+    @patch('crassus.batch_deployer.Crassus')
+    def test_deploy_drops_redelivered_messages(self, crassus_mock):
+        crassus_mock.side_effect = self.crassus_factory(
+            {'STACK1': 1, 'STACK2': 2, 'STACK3': 3})
+        BatchDeployer(self.event, self.context).deploy()
+        self.event['Records'].append(sns_record('STACK4'))
+        crassus_mock.reset_mock()
+        crassus_mock.side_effect = self.crassus_factory({'STACK4': 4})
+        self.assertEqual(
+            BatchDeployer(self.event, self.context).deploy(), [4])
+        self.assertEqual(crassus_mock.call_count, 1)
+
+    @patch('crassus.batch_deployer.Crassus')
+    def test_deploy_retries_messages_that_crashed(self, crassus_mock):
+        crassus_mock.side_effect = self.crassus_factory(
+            {'STACK1': 1, 'STACK3': 3})
+        BatchDeployer(self.event, self.context).deploy()
+        crassus_mock.side_effect = self.crassus_factory({'STACK2': 2})
+        self.assertEqual(
+            BatchDeployer(self.event, self.context).deploy(), [2])
+
+    @patch('crassus.batch_deployer.Crassus')
+    def test_deploy_retries_messages_that_failed(self, crassus_mock):
+        crassus_mock.side_effect = self.crassus_factory(
+            {'STACK1': 1, 'STACK2': 2, 'STACK3': 3}, failed=['STACK2'])
+        BatchDeployer(self.event, self.context).deploy()
+        crassus_mock.side_effect = self.crassus_factory({'STACK2': 2})
+        self.assertEqual(
+            BatchDeployer(self.event, self.context).deploy(), [2])
+
+    @patch('crassus.batch_deployer.Crassus')
+    def test_batch_item_failures(self, crassus_mock):
+        crassus_mock.side_effect = self.crassus_factory(
+            {'STACK1': 1, 'STACK2': 2}, failed=['STACK2'])
+        self.event['Records'] = [
+            sqs_record('STACK1', 'ID1'), sqs_record('STACK2', 'ID2'),
+            sqs_record('STACK3', 'ID3'), sqs_record('STACK2', 'ID4')]
+        batch_deployer = BatchDeployer(self.event, self.context)
+        self.assertEqual(batch_deployer.deploy()[:2], [1, 2])
+        self.assertEqual(batch_deployer.batch_item_failures(), {
+            'batchItemFailures': [
+                {'itemIdentifier': 'ID2'}, {'itemIdentifier': 'ID4'},
+                {'itemIdentifier': 'ID3'}]})
+
+    def test_batch_item_failures_without_records(self):
+        batch_deployer = BatchDeployer({'Records': []}, self.context)
+        batch_deployer.deploy()
+        self.assertEqual(
+            batch_deployer.batch_item_failures(), {'batchItemFailures': []})
+
+    @patch('crassus.batch_deployer.Crassus')
+    def test_deploy_groups_updates_by_region(self, crassus_mock):
+        crassus_mock.side_effect = self.crassus_factory(
+            {'STACK1': 1, 'STACK2': 2, 'STACK3': 3, 'STACK4': 4})
+        self.event['Records'] = [
+            sns_record('STACK1', region='us-east-1'),
+            sns_record('STACK2', region='eu-west-1'),
+            sns_record('STACK3', region='us-east-1'),
+            sns_record('STACK4', region='eu-central-1')]
+        batch_deployer = BatchDeployer(self.event, self.context, 1)
+        self.assertEqual(batch_deployer.deploy(), [4, 2, 1, 3])
+
+    @patch('crassus.batch_deployer.BackgroundResultPublisher')
+    @patch('crassus.batch_deployer.Crassus')
+    def test_deploy_bulk_message(self, crassus_mock, publisher_mock):
+        self.mock_config.return_value = {'result_queue': ['ANY_QUEUE']}
+        crassus_mock.side_effect = self.crassus_factory(
+            {'STACK1': 1, 'STACK2': 2, 'STACK4': 4}, failed=['STACK2'])
+        self.event['Records'] = [
+            sqs_record('STACK4', 'ID1'),
+            bulk_record('BULK-ID', stackNames=['STACK1', 'STACK2'])]
+        batch_deployer = BatchDeployer(self.event, self.context)
+        responses = batch_deployer.deploy()
+
+        self.assertEqual(responses[:3], [4, 1, 2])
+        summary = responses[3]
+        self.assertEqual(summary['status'], DeploymentResponse.STATUS_FAILURE)
+        self.assertEqual(summary['stacks'], [
+            {'stackName': 'STACK1', 'status': 'success'},
+            {'stackName': 'STACK2', 'status': 'failure'}])
+        publisher_mock.return_value.__enter__.return_value.publish\
+            .assert_called_once_with(['ANY_QUEUE'], summary)
+        self.assertEqual(batch_deployer.batch_item_failures(), {
+            'batchItemFailures': [{'itemIdentifier': 'BULK-ID'}]})
+
+    @patch('crassus.batch_deployer.BulkStackUpdate.select')
+    @patch('crassus.batch_deployer.Crassus', Mock())
+    def test_deploy_bulk_message_without_selected_stacks(self, select_mock):
+        select_mock.side_effect = ClientError(
+            {'Error': {'Code': 'AccessDenied', 'Message': 'denied'}},
+            'DescribeStacks')
+        self.event['Records'] = [
+            bulk_record('BULK-ID', stackNamePrefix='app-')]
+        batch_deployer = BatchDeployer(self.event, self.context)
+        responses = batch_deployer.deploy()
+
+        self.assertEqual(len(responses), 1)
+        self.assertEqual(
+            responses[0]['status'], DeploymentResponse.STATUS_FAILURE)
+        self.assertEqual(batch_deployer.batch_item_failures(), {
+            'batchItemFailures': [{'itemIdentifier': 'BULK-ID'}]})
+
+
+class TestCoalesce(unittest.TestCase):
+
+    def test_last_value_wins_per_stack_and_region(self):
+        updates = [
+            StackUpdateParameter.from_record(record) for record in [
+                sns_record('STACK1', {'A': '1', 'B': '1'}, 'ID1'),
+                sns_record('STACK2', {'A': '1'}, 'ID2'),
+                sns_record('STACK1', {'A': '3'}, 'ID3')]]
+        updates[1].region = 'us-east-1'
+        updates.append(StackUpdateParameter({
+            'version': '1', 'stackName': 'STACK2', 'region': 'eu-west-1',
+            'parameters': {'A': '4'}}))
+
+        coalesced = StackUpdateParameter.coalesce(updates)
+
+        self.assertEqual(
+            [(item.stack_name, item.region, item, item.message_ids)
+             for item in coalesced], [
+                ('STACK1', 'eu-west-1', {'A': '3', 'B': '1'}, ['ID1', 'ID3']),
+                ('STACK2', 'us-east-1', {'A': '1'}, ['ID2']),
+                ('STACK2', 'eu-west-1', {'A': '4'}, [])])
@@ -0,0 +1,155 @@
+import unittest
+
+from crassus.bulk import BulkStackUpdate, is_bulk_message
+from crassus.deployment_response import DeploymentResponse
+from mock import Mock
+
+
+def bulk_message(**selector):
+    message = {
+        'version': '2',
+        'region': 'eu-west-1',
+        'parameters': {'AmiId': 'ami-123'}}
+    message.update(selector)
+    return message
+
+
+def key(stack_name):
+    return (None, None, 'eu-west-1', stack_name)
+
+
+class TestIsBulkMessage(unittest.TestCase):
+
+    def test_version_two_is_bulk(self):
+        self.assertTrue(is_bulk_message({'version': 2}))
+        self.assertTrue(is_bulk_message({'version': '2.0'}))
+
+    def test_version_one_is_not_bulk(self):
+        self.assertFalse(is_bulk_message({'version': '1'}))
+        self.assertFalse(is_bulk_message({}))
+
+
+class TestBulkStackUpdate(unittest.TestCase):
+
+    def test_needs_exactly_one_selector(self):
+        self.assertRaises(ValueError, BulkStackUpdate, bulk_message())
+        self.assertRaises(ValueError, BulkStackUpdate, bulk_message(
+            stackNames=['A'], stackNamePrefix='app-'))
+
+    def test_rejects_invalid_selector(self):
+        self.assertRaises(TypeError, BulkStackUpdate, bulk_message(
+            stackTags=['team']))
+
+    def test_stack_update_parameters(self):
+        bulk_update = BulkStackUpdate(
+            bulk_message(stackNames=['A'], roleArn='ANY_ROLE'), 'ID1')
+        stack_update_parameters = bulk_update.stack_update_parameters('A')
+        self.assertEqual(stack_update_parameters, {'AmiId': 'ami-123'})
+        self.assertEqual(stack_update_parameters.stack_name, 'A')
+        self.assertEqual(stack_update_parameters.region, 'eu-west-1')
+        self.assertEqual(stack_update_parameters.role_arn, 'ANY_ROLE')
+        self.assertEqual(stack_update_parameters.message_ids, ['ID1'])
+
+    def test_selects_stack_names_without_describing(self):
+        bulk_update = BulkStackUpdate(bulk_message(stackNames=['A', 'B']))
+        crassus = Mock()
+        self.assertEqual(
+            [item.stack_name for item in bulk_update.select(crassus)],
+            ['A', 'B'])
+        self.assertFalse(crassus.describe_stacks.called)
+
+    def test_selects_described_stacks(self):
+        bulk_update = BulkStackUpdate(bulk_message(stackNamePrefix='app-'))
+        crassus = Mock()
+        crassus.describe_stacks.return_value = [
+            {'StackName': 'app-1'}, {'StackName': 'app-2'}]
+        self.assertEqual(
+            [item.stack_name for item in bulk_update.select(crassus)],
+            ['app-1', 'app-2'])
+        crassus.describe_stacks.assert_called_once_with(bulk_update.matches)
+
+    def test_matches_prefix(self):
+        bulk_update = BulkStackUpdate(bulk_message(stackNamePrefix='app-'))
+        self.assertTrue(bulk_update.matches(
+            {'StackName': 'app-1', 'StackStatus': 'UPDATE_COMPLETE'}))
+        self.assertFalse(bulk_update.matches(
+            {'StackName': 'db-1', 'StackStatus': 'UPDATE_COMPLETE'}))
+
+    def test_matches_all_tags(self):
+        bulk_update = BulkStackUpdate(bulk_message(
+            stackTags={'team': 'search', 'stage': 'live'}))
+        self.assertTrue(bulk_update.matches({
+            'StackName': 'app-1', 'StackStatus': 'CREATE_COMPLETE',
+            'Tags': [{'Key': 'team', 'Value': 'search'},
+                     {'Key': 'stage', 'Value': 'live'},
+                     {'Key': 'owner', 'Value': 'anyone'}]}))
+        self.assertFalse(bulk_update.matches({
+            'StackName': 'app-1', 'StackStatus': 'CREATE_COMPLETE',
+            'Tags': [{'Key': 'team', 'Value': 'search'}]}))
+
+    def test_does_not_match_stacks_that_can_not_be_updated(self):
+        bulk_update = BulkStackUpdate(bulk_message(stackNamePrefix='app-'))
+        self.assertFalse(bulk_update.matches(
+            {'StackName': 'app-1', 'StackStatus': 'ROLLBACK_COMPLETE'}))
+
+
+class TestSummary(unittest.TestCase):
+
+    def setUp(self):
+        self.bulk_update = BulkStackUpdate(
+            bulk_message(stackNames=['A', 'B', 'C']))
+        self.bulk_update.select(Mock())
+
+    def test_aggregates_statuses(self):
+        summary = self.bulk_update.summary({
+            key('A'): DeploymentResponse.STATUS_SUCCESS,
+            key('B'): DeploymentResponse.STATUS_UNCHANGED,
+            key('C'): DeploymentResponse.STATUS_SUCCESS})
+        self.assertEqual(summary['status'], DeploymentResponse.STATUS_SUCCESS)
+        self.assertEqual(
+            summary['message'], 'Updated 3 stacks: 2 success, 1 unchanged')
+        self.assertEqual(summary['selector'], {'stackNames': ['A', 'B', 'C']})
+        self.assertEqual(summary['stacks'], [
+            {'stackName': 'A', 'status': 'success'},
+            {'stackName': 'B', 'status': 'unchanged'},
+            {'stackName': 'C', 'status': 'success'}])
+
+    def test_fails_if_any_stack_failed(self):
+        summary = self.bulk_update.summary({
+            key('A'): DeploymentResponse.STATUS_PENDING,
+            key('B'): None,
+            key('C'): DeploymentResponse.STATUS_SUCCESS})
+        self.assertEqual(summary['status'], DeploymentResponse.STATUS_FAILURE)
+
+    def test_pending_if_any_stack_is_pending(self):
+        summary = self.bulk_update.summary({
+            key('A'): DeploymentResponse.STATUS_PENDING,
+            key('B'): DeploymentResponse.STATUS_SUCCESS})
+        self.assertEqual(summary['status'], DeploymentResponse.STATUS_PENDING)
+        self.assertEqual(len(summary['stacks']), 2)
+
+    def test_in_progress_if_any_stack_is_in_progress(self):
+        summary = self.bulk_update.summary({
+            key('A'): DeploymentResponse.STATUS_IN_PROGRESS,
+            key('B'): DeploymentResponse.STATUS_SUCCESS})
+        self.assertEqual(
+            summary['status'], DeploymentResponse.STATUS_IN_PROGRESS)
+
+    def test_unchanged_if_all_stacks_are_unchanged(self):
+        summary = self.bulk_update.summary(dict(
+            (key(stack_name), DeploymentResponse.STATUS_UNCHANGED)
+            for stack_name in 'ABC'))
+        self.assertEqual(
+            summary['status'], DeploymentResponse.STATUS_UNCHANGED)
+
+    def test_without_selected_stacks(self):
+        summary = self.bulk_update.summary({})
+        self.assertEqual(
+            summary['status'], DeploymentResponse.STATUS_UNCHANGED)
+        self.assertEqual(summary['stacks'], [])
+
+    def test_fails_if_stacks_could_not_be_selected(self):
+        self.bulk_update.error = 'Access denied'
+        summary = self.bulk_update.summary({})
+        self.assertEqual(summary['status'], DeploymentResponse.STATUS_FAILURE)
+        self.assertIn('Access denied', summary['message'])
@@ -0,0 +1,123 @@
+import unittest
+
+from botocore.exceptions import ClientError
+from crassus.change_sets import ChangeSet, wait_for_change_sets
+from crassus.throttling import RateLimitTimeout
+from mock import Mock, call, patch
+
+
+def change(logical_resource_id, replacement):
+    return {'Type': 'Resource', 'ResourceChange': {
+        'LogicalResourceId': logical_resource_id,
+        'Replacement': replacement}}
+
+
+class TestChangeSet(unittest.TestCase):
+
+    def setUp(self):
+        self.client = Mock()
+        self.client.create_change_set.return_value = {'Id': 'ANY_ID'}
+        self.change_set = ChangeSet(self.client, 'ANY_STACK')
+
+    def test_create(self):
+        self.change_set.create(UsePreviousTemplate=True, Parameters=[])
+        self.client.create_change_set.assert_called_once_with(
+            StackName='ANY_STACK', ChangeSetName=self.change_set.name,
+            UsePreviousTemplate=True, Parameters=[])
+        self.assertTrue(self.change_set.name.startswith('crassus-'))
+        self.assertEqual(self.change_set.change_set_id, 'ANY_ID')
+
+    def test_poll_reads_all_changes_of_created_change_set(self):
+        self.change_set.create()
+        self.client.describe_change_set.side_effect = [
+            {'Status': 'CREATE_COMPLETE',
+             'Changes': [change('Instance', 'True')], 'NextToken': 'TOKEN'},
+            {'Status': 'CREATE_COMPLETE',
+             'Changes': [change('Queue', 'False'),
+                         change('Volume', 'Conditional')]}]
+        self.change_set.poll()
+        self.assertTrue(self.change_set.is_final)
+        self.assertFalse(self.change_set.is_empty)
+        self.assertEqual(len(self.change_set.changes), 3)
+        self.assertEqual(
+            self.change_set.replacements, ['Instance', 'Volume'])
+        self.client.describe_change_set.assert_has_calls([
+            call(ChangeSetName='ANY_ID'),
+            call(ChangeSetName='ANY_ID', NextToken='TOKEN')])
+
+    def test_poll_change_set_in_progress(self):
+        self.client.describe_change_set.return_value = {
+            'Status': 'CREATE_IN_PROGRESS'}
+        self.change_set.poll()
+        self.assertFalse(self.change_set.is_final)
+
+    def test_change_set_without_changes_is_empty(self):
+        self.client.describe_change_set.return_value = {
+            'Status': 'FAILED',
+            'StatusReason': "The submitted information didn't contain "
+                            "changes. Submit different information to "
+                            "create a change set."}
+        self.change_set.poll()
+        self.assertTrue(self.change_set.is_final)
+        self.assertTrue(self.change_set.is_empty)
+
+    def test_failed_change_set_is_not_empty(self):
+        self.client.describe_change_set.return_value = {
+            'Status': 'FAILED', 'StatusReason': 'Parameter is invalid'}
+        self.change_set.poll()
+        self.assertFalse(self.change_set.is_empty)
+
+
+@patch('crassus.change_sets.time')
+class TestWaitForChangeSets(unittest.TestCase):
+
+    def change_set(self, *statuses):
+        change_set = ChangeSet(Mock(), 'ANY_STACK')
+        change_set.client.describe_change_set.side_effect = [
+            {'Status': status} for status in statuses]
+        return change_set
+
+    def test_polls_until_all_change_sets_are_final(self, time_mock):
+        first = self.change_set('CREATE_PENDING', 'CREATE_COMPLETE')
+        second = self.change_set(
+            'CREATE_PENDING', 'CREATE_IN_PROGRESS', 'FAILED')
+        wait_for_change_sets([first, second])
+        self.assertEqual(first.status, 'CREATE_COMPLETE')
+        self.assertEqual(second.status, 'FAILED')
+        self.assertEqual(first.client.describe_change_set.call_count, 2)
+        self.assertEqual(second.client.describe_change_set.call_count, 3)
+
+    def test_interval_grows_until_a_change_set_is_final(self, time_mock):
+        change_set = self.change_set(
+            'CREATE_PENDING', 'CREATE_PENDING', 'CREATE_COMPLETE')
+        wait_for_change_sets([change_set])
+        self.assertEqual(
+            time_mock.sleep.call_args_list,
+            [call(1.0), call(1.5), call(2.25)])
+
+    def test_unreadable_change_set_counts_as_failed(self, time_mock):
+        change_set = ChangeSet(Mock(), 'ANY_STACK')
+        change_set.client.describe_change_set.side_effect = ClientError(
+            {'Error': {'Code': 'ChangeSetNotFound', 'Message': 'gone'}},
+            'DescribeChangeSet')
+        wait_for_change_sets([change_set])
+        self.assertEqual(change_set.status, 'FAILED')
+        self.assertIn('gone', change_set.status_reason)
+
+    @patch('crassus.change_sets.logger', Mock())
+    def test_stops_when_the_time_is_up(self, time_mock):
+        context = Mock()
+        context.get_remaining_time_in_millis.side_effect = [12000, 11000]
+        change_set = self.change_set('CREATE_PENDING', 'CREATE_PENDING')
+        wait_for_change_sets([change_set], context)
+        self.assertEqual(change_set.status, 'CREATE_PENDING')
+        self.assertEqual(time_mock.sleep.call_count, 1)
+
+    @patch('crassus.change_sets.logger', Mock())
+    def test_stops_without_time_for_the_rate_limit(self, time_mock):
+        first = ChangeSet(Mock(), 'ANY_STACK', caller=Mock(
+            side_effect=RateLimitTimeout('No time left')))
+        second = self.change_set('CREATE_COMPLETE')
+        wait_for_change_sets([first, second])
+        self.assertIsNone(first.status)
+        self.assertFalse(second.client.describe_change_set.called)
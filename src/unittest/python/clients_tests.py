@@ -0,0 +1,153 @@
+import datetime
+import unittest
+
+from crassus import clients
+from dateutil import tz
+from mock import Mock, call, patch
+
+EXPIRATION = datetime.datetime(2016, 1, 1, 12, 0, tzinfo=tz.tzutc())
+EXPIRATION_TIMESTAMP = 1451649600
+
+
+class TestClients(unittest.TestCase):
+
+    """
+    Tests for the shared client and resource registry.
+    """
+
+    def setUp(self):
+        self.patch_session = patch('boto3.session.Session')
+        self.mock_session_class = self.patch_session.start()
+        self.mock_session = self.mock_session_class.return_value
+        self.mock_session.client.side_effect = \
+            lambda service, region_name: (service, region_name, 'client')
+        self.mock_session.resource.side_effect = \
+            lambda service, region_name: (service, region_name, 'resource')
+        clients.reset()
+
+        self.patch_time = patch('crassus.clients.time')
+        self.mock_time = self.patch_time.start()
+        self.mock_time.time.return_value = EXPIRATION_TIMESTAMP - 3600
+
+    def tearDown(self):
+        self.patch_session.stop()
+        self.patch_time.stop()
+        clients.reset()
+
+    def prepare_assume_role(self):
+        """
+        Let the default session return an STS client mock, and every new
+        session another mock.
+        """
+        sts_mock = Mock()
+        sts_mock.assume_role.return_value = {'Credentials': {
+            'AccessKeyId': 'KEY',
+            'SecretAccessKey': 'SECRET',
+            'SessionToken': 'TOKEN',
+            'Expiration': EXPIRATION}}
+        self.mock_session.client.side_effect = \
+            lambda service, region_name: sts_mock
+        self.mock_session_class.side_effect = \
+            lambda **kwargs: self.mock_session if not kwargs else Mock()
+        return sts_mock
+
+    def test_client_is_reused(self):
+        client = clients.get_client('sqs')
+        self.assertIs(clients.get_client('sqs'), client)
+        self.mock_session.client.assert_called_once_with(
+            'sqs', region_name=None)
+
+    def test_resource_is_reused(self):
+        resource = clients.get_resource('cloudformation')
+        self.assertIs(clients.get_resource('cloudformation'), resource)
+        self.mock_session.resource.assert_called_once_with(
+            'cloudformation', region_name=None)
+
+    def test_resource_without_retries(self):
+        self.mock_session.resource.side_effect = None
+        clients.get_resource('cloudformation', retries=False)
+        clients.get_resource('cloudformation', retries=False)
+        clients.get_resource('cloudformation')
+        without_retries, with_retries = \
+            self.mock_session.resource.call_args_list
+        self.assertEqual(
+            without_retries[1]['config'].retries, {'max_attempts': 0})
+        self.assertEqual(with_retries, call(
+            'cloudformation', region_name=None))
+
+    def test_clients_are_kept_per_service_and_region(self):
+        clients.get_client('sqs')
+        clients.get_client('lambda')
+        clients.get_client('sqs', 'us-east-1')
+        clients.get_client('sqs', 'us-east-1')
+        self.assertEqual(self.mock_session.client.call_args_list, [
+            call('sqs', region_name=None),
+            call('lambda', region_name=None),
+            call('sqs', region_name='us-east-1')])
+
+    def test_session_is_shared(self):
+        clients.get_client('sqs')
+        clients.get_resource('cloudformation')
+        self.assertEqual(self.mock_session_class.call_count, 1)
+
+    def test_lazy_client_is_created_on_first_use(self):
+        lazy_client = clients.LazyClient('sqs', 'us-east-1')
+        self.assertFalse(self.mock_session.client.called)
+        self.assertEqual(lazy_client.index('client'), 2)
+        self.mock_session.client.assert_called_once_with(
+            'sqs', region_name='us-east-1')
+
+    def test_lazy_client_keeps_its_client(self):
+        lazy_client = clients.LazyClient('sqs', 'us-east-1')
+        lazy_client.index('client')
+        with patch('crassus.clients.get_client') as get_client_mock:
+            self.assertEqual(lazy_client.index('client'), 2)
+        self.assertFalse(get_client_mock.called)
+
+    def test_role_is_assumed_without_holding_the_registry(self):
+        sts_mock = self.prepare_assume_role()
+        credentials = sts_mock.assume_role.return_value
+
+        def assume_role(**kwargs):
+            # Other threads can get their clients meanwhile
+            self.assertTrue(clients._lock.acquire(False))
+            clients._lock.release()
+            return credentials
+        sts_mock.assume_role.side_effect = assume_role
+        clients.get_client('cloudformation', None, 'ROLE')
+        self.assertEqual(sts_mock.assume_role.call_count, 1)
+
+    def test_role_clients_use_assumed_role_session(self):
+        sts_mock = self.prepare_assume_role()
+        client = clients.get_client('cloudformation', 'us-east-1', 'ROLE')
+        sts_mock.assume_role.assert_called_once_with(
+            RoleArn='ROLE', RoleSessionName='crassus')
+        self.assertEqual(self.mock_session_class.call_args_list[-1], call(
+            aws_access_key_id='KEY', aws_secret_access_key='SECRET',
+            aws_session_token='TOKEN',
+            region_name=self.mock_session.region_name))
+        # Not created by the default session, which returns the STS mock
+        self.assertIsNot(client, sts_mock)
+
+    def test_role_session_is_reused_until_shortly_before_expiry(self):
+        sts_mock = self.prepare_assume_role()
+        client = clients.get_client('cloudformation', None, 'ROLE')
+        resource = clients.get_resource('cloudformation', None, 'ROLE')
+        self.mock_time.time.return_value = EXPIRATION_TIMESTAMP - 301
+        self.assertIs(
+            clients.get_client('cloudformation', None, 'ROLE'), client)
+        self.assertIs(
+            clients.get_resource('cloudformation', None, 'ROLE'), resource)
+        self.assertEqual(sts_mock.assume_role.call_count, 1)
+
+        self.mock_time.time.return_value = EXPIRATION_TIMESTAMP - 300
+        self.assertIsNot(
+            clients.get_client('cloudformation', None, 'ROLE'), client)
+        self.assertEqual(sts_mock.assume_role.call_count, 2)
+
+    def test_role_sessions_are_kept_per_role(self):
+        sts_mock = self.prepare_assume_role()
+        client1 = clients.get_client('cloudformation', None, 'ROLE1')
+        client2 = clients.get_client('cloudformation', None, 'ROLE2')
+        self.assertIsNot(client1, client2)
+        self.assertEqual(sts_mock.assume_role.call_count, 2)
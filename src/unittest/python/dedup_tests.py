@@ -0,0 +1,97 @@
+import unittest
+
+from botocore.exceptions import ClientError
+from crassus.dedup import DedupWindow, DynamoDBDedupStore
+from mock import patch
+
+
+class TestDedupWindow(unittest.TestCase):
+
+    def setUp(self):
+        self.patch_time = patch('crassus.ttl_cache.time')
+        self.mock_time = self.patch_time.start()
+        self.mock_time.time.return_value = 1000
+        self.patch_dedup_time = patch('crassus.dedup.time', self.mock_time)
+        self.patch_dedup_time.start()
+        self.window = DedupWindow(ttl=60, max_size=3)
+
+    def tearDown(self):
+        self.patch_time.stop()
+        self.patch_dedup_time.stop()
+
+    def test_seen_before(self):
+        self.assertFalse(self.window.seen_before('KEY'))
+        self.assertTrue(self.window.seen_before('KEY'))
+        self.assertFalse(self.window.seen_before('OTHER_KEY'))
+
+    def test_add_and_contains(self):
+        self.assertNotIn('KEY', self.window)
+        self.window.add('KEY')
+        self.assertIn('KEY', self.window)
+
+    def test_keys_expire_after_ttl(self):
+        self.window.add('KEY')
+        self.mock_time.time.return_value = 1059
+        self.assertIn('KEY', self.window)
+        self.mock_time.time.return_value = 1060
+        self.assertNotIn('KEY', self.window)
+        self.assertEqual(len(self.window), 0)
+
+    def test_oldest_keys_are_dropped_when_full(self):
+        for key in ['KEY1', 'KEY2', 'KEY3', 'KEY4']:
+            self.window.add(key)
+        self.assertNotIn('KEY1', self.window)
+        self.assertEqual(len(self.window), 3)
+
+    def test_seen_before_keeps_recently_seen_keys(self):
+        for key in ['KEY1', 'KEY2', 'KEY3']:
+            self.window.add(key)
+        self.assertTrue(self.window.seen_before('KEY1'))
+        self.window.add('KEY4')
+        self.assertIn('KEY1', self.window)
+        self.assertNotIn('KEY2', self.window)
+
+
+class TestDynamoDBDedupStore(unittest.TestCase):
+
+    def setUp(self):
+        self.patch_time = patch('crassus.dedup.time')
+        self.mock_time = self.patch_time.start()
+        self.mock_time.time.return_value = 1000.5
+        self.patch_client = patch('crassus.dedup.get_client')
+        self.mock_dynamodb = self.patch_client.start().return_value
+        self.store = DynamoDBDedupStore('TABLE', 60)
+
+    def tearDown(self):
+        self.patch_time.stop()
+        self.patch_client.stop()
+
+    def test_add_writes_key(self):
+        self.store.add('KEY')
+        self.mock_dynamodb.put_item.assert_called_once_with(
+            TableName='TABLE',
+            Item={'dedupKey': {'S': 'KEY'}, 'expires': {'N': '1060'}})
+
+    def test_contains_added_key(self):
+        self.mock_dynamodb.get_item.return_value = {
+            'Item': {'dedupKey': {'S': 'KEY'}, 'expires': {'N': '1060'}}}
+        self.assertIn('KEY', self.store)
+        self.mock_dynamodb.get_item.assert_called_once_with(
+            TableName='TABLE', Key={'dedupKey': {'S': 'KEY'}},
+            ConsistentRead=True)
+
+    def test_does_not_contain_missing_key(self):
+        self.mock_dynamodb.get_item.return_value = {}
+        self.assertNotIn('KEY', self.store)
+
+    def test_does_not_contain_expired_key(self):
+        self.mock_dynamodb.get_item.return_value = {
+            'Item': {'dedupKey': {'S': 'KEY'}, 'expires': {'N': '1000'}}}
+        self.assertNotIn('KEY', self.store)
+
+    def test_errors_are_raised(self):
+        self.mock_dynamodb.get_item.side_effect = ClientError(
+            {'Error': {'Code': 'AccessDeniedException', 'Message': ''}},
+            'GetItem')
+        self.assertRaises(
+            ClientError, self.store.__contains__, 'KEY')
@@ -1,9 +1,13 @@
+import json
 import unittest
 from textwrap import dedent
 
 from botocore.exceptions import ClientError
+from crassus import deployer as deployer_module
 from crassus.deployer import Crassus, StackUpdateParameter
 from crassus.deployment_response import DeploymentResponse
+from crassus.throttling import RateLimitTimeout, TokenBucket
+from crassus.utils import clear_lambda_config_cache
 from mock import ANY, Mock, call, patch
 
 PARAMETER = 'ANY_PARAMETER'
@@ -64,6 +68,27 @@ class TestDeployStack(unittest.TestCase):
         load_mock.assert_called_once_with()
         update_mock.assert_called_once_with()
 
+    @patch('crassus.deployer.Crassus.update')
+    @patch('crassus.deployer.Crassus.load')
+    def test_should_not_update_unloaded_stack(self, load_mock, update_mock):
+        load_mock.return_value = False
+        crassus = Crassus(None, None)
+        crassus.deploy()
+        self.assertFalse(update_mock.called)
+
+    @patch('crassus.deployer.Crassus.update', Mock())
+    @patch('crassus.deployer.Crassus.load', Mock())
+    @patch('crassus.deployer.PhaseTimer')
+    def test_deploy_emits_timings(self, timer_mock):
+        crassus = Crassus(None, None, StackUpdateParameter({
+            'version': '1',
+            'stackName': STACK_NAME,
+            'region': 'ANY_REGION',
+            'parameters': {}}))
+        crassus.deploy()
+        timer_mock.return_value.emit.assert_called_once_with(
+            'deploy', StackName=STACK_NAME)
+
 
 class TestParseParameters(unittest.TestCase):
 
@@ -75,13 +100,24 @@ class TestParseParameters(unittest.TestCase):
         self.assertEqual(self.crassus.stack_update_parameters.stack_name,
                          STACK_NAME)
 
+    def test_uses_given_update_parameters(self):
+        stack_update_parameters = StackUpdateParameter({
+            'version': '1',
+            'stackName': 'OTHER_STACK',
+            'region': 'eu-west-1',
+            'parameters': {}})
+        crassus = Crassus(SAMPLE_EVENT, None, stack_update_parameters)
+        self.assertIs(crassus.stack_update_parameters,
+                      stack_update_parameters)
+        self.assertEqual(crassus.stack_name, 'OTHER_STACK')
+
 
 class TestNotify(unittest.TestCase):
     STATUS = 'success'
     MESSAGE = 'ANY MESSAGE'
 
     @patch('crassus.deployer.sqs_send_message')
-    @patch('boto3.resource')
+    @patch('crassus.deployer.get_resource')
     def test_should_notify_sns(self, resource_mock, mock_sqs):
         topic_mock = Mock()
         sns_mock = Mock()
@@ -103,7 +139,23 @@ class TestNotify(unittest.TestCase):
                 'stackName': 'ANY_STACK',
                 'version': '1.1',
                 'message': 'ANY MESSAGE',
-                'emitter': 'crassus'}))
+                'emitter': 'crassus',
+                'timings': {}}))
+
+    @patch('crassus.deployer.sqs_send_message')
+    @patch('crassus.deployer.get_resource', Mock())
+    def test_should_notify_through_publisher(self, mock_sqs):
+        publisher = Mock()
+        self.crassus = Crassus(None, None, publisher=publisher)
+        self.crassus._stack_name = STACK_NAME
+        self.crassus._output_topics = ANY_TOPIC
+
+        self.crassus.notify(self.STATUS, self.MESSAGE)
+
+        self.assertFalse(mock_sqs.called)
+        publisher.publish.assert_called_once_with(
+            ANY_TOPIC, self.crassus.response)
+        self.assertEqual(self.crassus.response['status'], self.STATUS)
 
     @patch('crassus.deployer.Crassus.output_topics', None)
     def test_should_do_gracefully_nothing(self):
@@ -144,17 +196,21 @@ class TestUpdateStack(unittest.TestCase):
         self.crassus = Crassus(None, self.context_mock)
         self.crassus._stack_update_parameters = \
             StackUpdateParameter(self.update_parameters)
+        self.stack_mock.stack_status = 'UPDATE_COMPLETE'
         self.crassus.stack = self.stack_mock
+        self.crassus._wait_for_completion = False
+        self.crassus._use_change_sets = False
+        self.crassus.cfn_caller.bucket = TokenBucket()
+        deployer_module._stack_cache.clear()
+        self.addCleanup(deployer_module._stack_cache.clear)
+        self.context_mock.get_remaining_time_in_millis.return_value = 60000
         self.crassus._stack_name = STACK_NAME
         self.crassus._output_topics = ANY_TOPIC
-        self.crassus.aws_lambda = Mock()
-        self.crassus.aws_lambda.get_function_configuration.return_value = {
-            'Description': dedent("""
-                {"result_queue":[
-                    "arn:aws:sns:eu-west-1:123456789012:crassus-output",
-                    "arn:aws:sns:eu-west-1:123456789012:random-topic"
-                    ],
-                    "cfn_events": ["CFN-SNS-TOPIC-1"]}""")}
+
+        # Keep the printed EMF metrics out of the test output
+        patcher = patch('crassus.metrics.print', create=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
 
     @patch('crassus.deployer.Crassus.notify', Mock())
     @patch('crassus.deployer.get_lambda_config_property')
@@ -168,7 +224,217 @@ class TestUpdateStack(unittest.TestCase):
             NotificationARNs=['CFN-SQS-QUEUE-1'])
         self.assertEqual(self.crassus.cfn_output_topics, ['CFN-SQS-QUEUE-1'])
 
-    @patch('crassus.deployer.get_lambda_config_property', Mock())
+    @patch('crassus.deployer.sqs_send_message', Mock())
+    @patch('crassus.deployer.get_lambda_config_property')
+    def test_update_stack_reports_timings(self, mock_lambda):
+        mock_lambda.return_value = None
+        self.crassus.update()
+        self.assertEqual(
+            sorted(self.crassus.response['timings']),
+            ['config', 'merge', 'update'])
+        self.assertEqual(
+            sorted(self.crassus.timer.timings),
+            ['config', 'merge', 'notify', 'update'])
+
+    @patch('crassus.deployer.Crassus.notify', Mock())
+    @patch('crassus.deployer.get_lambda_config_property')
+    def test_update_stack_only_uses_topics_of_stack_region(self, mock_lambda):
+        self.crassus.stack_update_parameters.region = 'us-east-1'
+        mock_lambda.return_value = [
+            'arn:aws:sns:eu-west-1:123456789012:cfn-events',
+            'arn:aws:sns:us-east-1:123456789012:cfn-events']
+        self.crassus.update()
+        self.stack_mock.update.assert_called_once_with(
+            UsePreviousTemplate=True,
+            Parameters=self.expected_parameters,
+            Capabilities=['CAPABILITY_IAM'],
+            NotificationARNs=[
+                'arn:aws:sns:us-east-1:123456789012:cfn-events'])
+
+    @patch('crassus.deployer.Crassus.notify', Mock())
+    @patch('crassus.deployer.get_lambda_config_property')
+    def test_update_stack_without_topics_of_stack_region(self, mock_lambda):
+        self.crassus.stack_update_parameters.region = 'us-east-1'
+        mock_lambda.return_value = [
+            'arn:aws:sns:eu-west-1:123456789012:cfn-events']
+        self.crassus.update()
+        self.stack_mock.update.assert_called_once_with(
+            UsePreviousTemplate=True,
+            Parameters=self.expected_parameters,
+            Capabilities=['CAPABILITY_IAM'])
+
+    def wait_for_completion(self, stack_status, failure_reasons=(),
+                            wait_error=None):
+        self.crassus._wait_for_completion = True
+        self.crassus._aws_cfn = Mock()
+        waiter = Mock(stack_status=stack_status,
+                      failure_reasons=list(failure_reasons))
+        waiter.wait.side_effect = wait_error
+        with patch('crassus.deployer.StackWaiter', return_value=waiter):
+            self.crassus.update()
+        waiter.start.assert_called_once_with()
+        waiter.wait.assert_called_once_with()
+
+    @patch('crassus.deployer.get_lambda_config_property',
+           Mock(return_value=None))
+    @patch('crassus.deployer.Crassus.notify')
+    def test_update_stack_waits_for_completion(self, notify_mock):
+        self.wait_for_completion('UPDATE_COMPLETE')
+        notify_mock.assert_called_once_with(
+            DeploymentResponse.STATUS_SUCCESS,
+            'Stack update completed with UPDATE_COMPLETE.',
+            stackStatus='UPDATE_COMPLETE')
+
+    @patch('crassus.deployer.get_lambda_config_property',
+           Mock(return_value=None))
+    @patch('crassus.deployer.Crassus.notify')
+    @patch('crassus.deployer.logger', Mock())
+    def test_update_stack_reports_failed_update(self, notify_mock):
+        self.wait_for_completion(
+            'UPDATE_ROLLBACK_COMPLETE', ['Instance: Invalid type'])
+        notify_mock.assert_called_once_with(
+            DeploymentResponse.STATUS_FAILURE,
+            'Stack update failed with UPDATE_ROLLBACK_COMPLETE: '
+            'Instance: Invalid type',
+            stackStatus='UPDATE_ROLLBACK_COMPLETE')
+
+    @patch('crassus.deployer.get_lambda_config_property',
+           Mock(return_value=None))
+    @patch('crassus.deployer.Crassus.notify')
+    def test_update_stack_reports_update_in_progress(self, notify_mock):
+        self.wait_for_completion('UPDATE_IN_PROGRESS')
+        notify_mock.assert_called_once_with(
+            DeploymentResponse.STATUS_IN_PROGRESS,
+            'Cloudformation was triggered successfully, the update was '
+            'still in progress when the time was up.',
+            stackStatus='UPDATE_IN_PROGRESS')
+
+    @patch('crassus.deployer.get_lambda_config_property',
+           Mock(return_value=None))
+    @patch('crassus.deployer.Crassus.notify')
+    @patch('crassus.deployer.logger', Mock())
+    def test_update_stack_reports_update_without_time_for_rate_limit(
+            self, notify_mock):
+        self.wait_for_completion(
+            'UPDATE_IN_PROGRESS', wait_error=RateLimitTimeout('No time'))
+        notify_mock.assert_called_once_with(
+            DeploymentResponse.STATUS_IN_PROGRESS, ANY,
+            stackStatus='UPDATE_IN_PROGRESS')
+
+    def busy_stack(self, stack_status_after_wait, pending_busy_updates=True):
+        """
+        Let the stack be busy until the patched StackWaiter waited, and
+        report stack_status_after_wait from it. Return the patched
+        StackWaiter class.
+        """
+        self.crassus._aws_cfn = Mock()
+        self.crassus._max_busy_wait = 60.0
+        self.crassus.pending_busy_updates = pending_busy_updates
+        self.stack_mock.stack_status = 'UPDATE_IN_PROGRESS'
+        waiter = Mock()
+
+        def wait():
+            self.stack_mock.stack_status = stack_status_after_wait
+            return stack_status_after_wait
+        waiter.wait.side_effect = wait
+        patcher = patch('crassus.deployer.StackWaiter', return_value=waiter)
+        stack_waiter_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+        return stack_waiter_mock
+
+    @patch('crassus.deployer.get_lambda_config_property',
+           Mock(return_value=None))
+    @patch('crassus.deployer.Crassus.notify')
+    def test_update_of_busy_stack_waits_until_settled(self, notify_mock):
+        self.busy_stack('UPDATE_COMPLETE')
+        self.crassus.update()
+        self.assertEqual(self.stack_mock.update.call_count, 1)
+        notify_mock.assert_called_once_with(
+            DeploymentResponse.STATUS_SUCCESS, ANY)
+
+    @patch('crassus.deployer.Crassus.notify')
+    @patch('crassus.deployer.logger', Mock())
+    def test_update_of_busy_stack_is_pending(self, notify_mock):
+        self.busy_stack('UPDATE_IN_PROGRESS')
+        self.crassus.update()
+        self.assertFalse(self.stack_mock.update.called)
+        notify_mock.assert_called_once_with(
+            DeploymentResponse.STATUS_PENDING,
+            'Stack ANY_STACK is busy with UPDATE_IN_PROGRESS, the update '
+            'is pending.')
+
+    @patch('crassus.deployer.get_lambda_config_property',
+           Mock(return_value=None))
+    @patch('crassus.deployer.Crassus.notify')
+    def test_update_of_busy_stack_settles_without_pending(self, notify_mock):
+        self.busy_stack('UPDATE_COMPLETE', pending_busy_updates=False)
+        self.crassus.update()
+        self.assertEqual(self.stack_mock.update.call_count, 1)
+        notify_mock.assert_called_once_with(
+            DeploymentResponse.STATUS_SUCCESS, ANY)
+
+    @patch('crassus.deployer.Crassus.notify')
+    @patch('crassus.deployer.logger', Mock())
+    def test_update_of_busy_stack_fails_without_pending(self, notify_mock):
+        self.busy_stack('UPDATE_IN_PROGRESS', pending_busy_updates=False)
+        self.crassus.update()
+        self.assertFalse(self.stack_mock.update.called)
+        notify_mock.assert_called_once_with(
+            DeploymentResponse.STATUS_FAILURE,
+            'Stack ANY_STACK is busy with UPDATE_IN_PROGRESS, the update '
+            'was not applied.')
+
+    @patch('crassus.deployer.Crassus.notify', Mock())
+    @patch('crassus.deployer.logger', Mock())
+    def test_wait_for_busy_stack_is_limited(self):
+        stack_waiter_mock = self.busy_stack('UPDATE_IN_PROGRESS')
+        self.crassus.update()
+        timeout = stack_waiter_mock.call_args[0][4]
+        self.assertTrue(0 < timeout <= 60.0)
+
+    @patch('crassus.deployer.Crassus.notify')
+    @patch('crassus.deployer.logger', Mock())
+    def test_no_wait_for_busy_stack_without_max_busy_wait(self, notify_mock):
+        stack_waiter_mock = self.busy_stack(
+            'UPDATE_COMPLETE', pending_busy_updates=False)
+        self.crassus._max_busy_wait = 0.0
+        self.crassus.update()
+        self.assertFalse(stack_waiter_mock.called)
+        self.assertFalse(self.stack_mock.update.called)
+        notify_mock.assert_called_once_with(
+            DeploymentResponse.STATUS_FAILURE, ANY)
+
+    @patch('crassus.deployer.get_lambda_config_property',
+           Mock(return_value=None))
+    @patch('crassus.deployer.Crassus.notify', Mock())
+    @patch('crassus.deployer.logger', Mock())
+    def test_pending_update_is_not_applied_by_next_update(self):
+        self.busy_stack('UPDATE_IN_PROGRESS')
+        self.crassus.update()
+        # The pending update is received again from SQS, meanwhile the
+        # stack was updated by another one
+        self.stack_mock.stack_status = 'UPDATE_COMPLETE'
+        self.stack_mock.parameters = [
+            {'ParameterKey': 'KeyOne', 'ParameterValue': 'NewerValueOne'},
+            {'ParameterKey': 'KeyTwo', 'ParameterValue': 'Original'}]
+        crassus = Crassus(None, self.context_mock, StackUpdateParameter(
+            dict(self.update_parameters, parameters={'KeyTwo': 'New'})),
+            pending_busy_updates=True)
+        crassus.stack = self.stack_mock
+        crassus._wait_for_completion = False
+        crassus._use_change_sets = False
+        crassus._output_topics = ANY_TOPIC
+        crassus.cfn_caller.bucket = TokenBucket()
+        crassus.update()
+        self.stack_mock.update.assert_called_once_with(
+            UsePreviousTemplate=True,
+            Parameters=[
+                {'ParameterKey': 'KeyTwo', 'ParameterValue': 'New'},
+                {'ParameterKey': 'KeyOne', 'UsePreviousValue': True}],
+            Capabilities=['CAPABILITY_IAM'])
+
+    @patch('crassus.deployer.get_lambda_config_property',
+           Mock(return_value=None))
     @patch('crassus.deployer.Crassus.notify', Mock())
     @patch('crassus.deployer.logger')
     def test_update_stack_load_throws_clienterror_exception(self, logger_mock):
@@ -178,6 +444,185 @@ class TestUpdateStack(unittest.TestCase):
         self.crassus.update()
         logger_mock.error.assert_called_once_with(ANY)
 
+    @patch('crassus.deployer.Crassus.notify')
+    def test_update_stack_skips_unchanged_parameters(self, notify_mock):
+        self.crassus._stack_update_parameters = StackUpdateParameter(
+            dict(self.update_parameters,
+                 parameters={"KeyOne": "OriginalValueOne",
+                             "UnknownKey": "AnyValue"}))
+        self.crassus.update()
+        self.assertFalse(self.stack_mock.update.called)
+        notify_mock.assert_called_once_with(
+            DeploymentResponse.STATUS_UNCHANGED, ANY)
+
+    @patch('crassus.deployer.get_lambda_config_property',
+           Mock(return_value=None))
+    @patch('crassus.deployer.Crassus.notify')
+    @patch('crassus.deployer.logger')
+    def test_update_stack_reports_no_updates_as_unchanged(
+            self, logger_mock, notify_mock):
+        self.stack_mock.update.side_effect = ClientError(
+            {'Error': {'Code': 'ValidationError',
+                       'Message': 'No updates are to be performed.'}},
+            'UpdateStack')
+        self.crassus.update()
+        self.assertFalse(logger_mock.error.called)
+        notify_mock.assert_called_once_with(
+            DeploymentResponse.STATUS_UNCHANGED, ANY)
+
+    @patch('crassus.deployer.get_lambda_config_property',
+           Mock(return_value=None))
+    @patch('crassus.deployer.Crassus.notify', Mock())
+    def test_update_invalidates_cached_stack(self):
+        deployer_module._stack_cache.put(
+            self.crassus.stack_cache_key, {'StackStatus': 'UPDATE_COMPLETE'})
+        self.crassus.update()
+        self.assertIsNone(
+            deployer_module._stack_cache.get(self.crassus.stack_cache_key))
+
+    def cached_stack(self):
+        """
+        Let the stack data come from the cache, loading describes the
+        stack with the values of self.stack_mock.
+        """
+        self.crassus.loaded_from_cache = True
+        self.crassus._aws_cfn = Mock()
+        self.crassus._aws_cfn.Stack.return_value = self.stack_mock
+        self.stack_mock.meta.data = {'StackStatus': 'UPDATE_COMPLETE'}
+
+    @patch('crassus.deployer.get_lambda_config_property',
+           Mock(return_value=None))
+    @patch('crassus.deployer.Crassus.notify')
+    @patch('crassus.deployer.logger', Mock())
+    def test_unchanged_cached_stack_is_described_again(self, notify_mock):
+        self.cached_stack()
+        self.crassus._stack_update_parameters = StackUpdateParameter(
+            dict(self.update_parameters,
+                 parameters={'KeyOne': 'OriginalValueOne'}))
+        self.crassus.update()
+        self.stack_mock.load.assert_called_once_with()
+        self.assertFalse(self.crassus.loaded_from_cache)
+        notify_mock.assert_called_once_with(
+            DeploymentResponse.STATUS_UNCHANGED, ANY)
+
+    @patch('crassus.deployer.get_lambda_config_property',
+           Mock(return_value=None))
+    @patch('crassus.deployer.Crassus.notify')
+    @patch('crassus.deployer.logger', Mock())
+    def test_failed_update_of_cached_stack_is_retried(self, notify_mock):
+        self.cached_stack()
+        self.stack_mock.update.side_effect = [
+            ClientError({'Error': {'Code': 'ValidationError',
+                                   'Message': 'is in UPDATE_IN_PROGRESS'}},
+                        'UpdateStack'),
+            None]
+        self.crassus.update()
+        self.stack_mock.load.assert_called_once_with()
+        self.assertEqual(self.stack_mock.update.call_count, 2)
+        notify_mock.assert_called_once_with(
+            DeploymentResponse.STATUS_SUCCESS, ANY)
+
+    def change_set_mode(self):
+        self.crassus._use_change_sets = True
+        self.crassus._aws_cfn = Mock()
+        self.client_mock = self.crassus._aws_cfn.meta.client
+        self.client_mock.create_change_set.return_value = {'Id': 'ANY_ID'}
+
+    def created_change_set(self, status, status_reason=None, changes=()):
+        self.change_set_mode()
+        with patch('crassus.deployer.Crassus.notify', Mock()):
+            self.crassus.update()
+        self.client_mock.describe_change_set.return_value = {
+            'Status': status, 'StatusReason': status_reason,
+            'Changes': list(changes)}
+        self.crassus.change_set.poll()
+
+    @patch('crassus.deployer.get_lambda_config_property',
+           Mock(return_value=['CFN-SNS-TOPIC']))
+    @patch('crassus.deployer.Crassus.notify')
+    def test_update_stack_creates_change_set(self, notify_mock):
+        self.change_set_mode()
+        self.crassus.update()
+        self.assertFalse(self.stack_mock.update.called)
+        self.client_mock.create_change_set.assert_called_once_with(
+            StackName=STACK_NAME,
+            ChangeSetName=self.crassus.change_set.name,
+            UsePreviousTemplate=True,
+            Parameters=self.expected_parameters,
+            Capabilities=['CAPABILITY_IAM'],
+            NotificationARNs=['CFN-SNS-TOPIC'])
+        self.assertFalse(notify_mock.called)
+
+    @patch('crassus.deployer.get_lambda_config_property',
+           Mock(return_value=None))
+    @patch('crassus.deployer.Crassus.notify')
+    def test_empty_change_set_is_deleted(self, notify_mock):
+        self.created_change_set(
+            'FAILED', "The submitted information didn't contain changes.")
+        self.crassus.finish_change_set()
+        self.client_mock.delete_change_set.assert_called_once_with(
+            ChangeSetName='ANY_ID')
+        self.assertFalse(self.client_mock.execute_change_set.called)
+        self.assertIsNone(self.crassus.change_set)
+        notify_mock.assert_called_once_with(
+            DeploymentResponse.STATUS_UNCHANGED, ANY)
+
+    @patch('crassus.deployer.get_lambda_config_property',
+           Mock(return_value=None))
+    @patch('crassus.deployer.Crassus.notify')
+    @patch('crassus.deployer.logger', Mock())
+    def test_change_set_with_changes_is_executed(self, notify_mock):
+        self.created_change_set('CREATE_COMPLETE', changes=[
+            {'ResourceChange': {'LogicalResourceId': 'Instance',
+                                'Replacement': 'True'}}])
+        self.crassus.finish_change_set()
+        self.client_mock.execute_change_set.assert_called_once_with(
+            ChangeSetName='ANY_ID')
+        self.assertFalse(self.client_mock.delete_change_set.called)
+        notify_mock.assert_called_once_with(
+            DeploymentResponse.STATUS_SUCCESS, ANY,
+            replacements=['Instance'])
+
+    @patch('crassus.deployer.get_lambda_config_property',
+           Mock(return_value=None))
+    @patch('crassus.deployer.Crassus.notify')
+    @patch('crassus.deployer.logger', Mock())
+    def test_change_set_not_ready_in_time_fails(self, notify_mock):
+        self.created_change_set('CREATE_IN_PROGRESS')
+        self.crassus.finish_change_set()
+        self.assertFalse(self.client_mock.execute_change_set.called)
+        self.client_mock.delete_change_set.assert_called_once_with(
+            ChangeSetName='ANY_ID')
+        notify_mock.assert_called_once_with(
+            DeploymentResponse.STATUS_FAILURE,
+            'Change set of stack ANY_STACK was not ready in time, status '
+            'CREATE_IN_PROGRESS.')
+
+    @patch('crassus.deployer.get_lambda_config_property',
+           Mock(return_value=None))
+    @patch('crassus.deployer.Crassus.notify', Mock())
+    @patch('crassus.deployer.Crassus.load', Mock(return_value=True))
+    @patch('crassus.deployer.wait_for_change_sets')
+    def test_deploy_waits_for_change_set(self, wait_mock):
+        self.change_set_mode()
+        self.client_mock.describe_change_set.return_value = {
+            'Status': 'CREATE_COMPLETE'}
+        wait_mock.side_effect = lambda change_sets, context: [
+            change_set.poll() for change_set in change_sets]
+        self.crassus.deploy()
+        self.client_mock.execute_change_set.assert_called_once_with(
+            ChangeSetName='ANY_ID')
+
+    @patch('crassus.deployer.get_lambda_config_property',
+           Mock(return_value=None))
+    @patch('crassus.deployer.Crassus.notify', Mock())
+    @patch('crassus.deployer.Crassus.load', Mock(return_value=True))
+    def test_deploy_can_leave_change_set_open(self):
+        self.change_set_mode()
+        self.crassus.deploy(finish_change_set=False)
+        self.assertIsNotNone(self.crassus.change_set)
+        self.assertFalse(self.client_mock.describe_change_set.called)
+
     """@patch('crassus.deployer.notify')
     def test_update_stack_should_notify_in_case_of_error(self, notify_mock):
         self.stack_mock.update.side_effect = ClientError(
@@ -192,24 +637,98 @@ class TestUpdateStack(unittest.TestCase):
 class TestLoad(unittest.TestCase):
 
     def setUp(self):
-        self.patcher = patch('boto3.resource')
+        self.patcher = patch('crassus.deployer.get_resource')
         self.resource_mock = self.patcher.start()
 
         self.cloudformation_mock = Mock()
         self.stack_mock = Mock()
         self.resource_mock.return_value = self.cloudformation_mock
         self.cloudformation_mock.Stack.return_value = self.stack_mock
-        self.crassus = Crassus(None, None)
-        self.crassus._stack_name = STACK_NAME
+        self.crassus = Crassus(None, None, StackUpdateParameter({
+            'version': '1',
+            'stackName': STACK_NAME,
+            'region': 'ANY_REGION',
+            'parameters': {}}))
         self.crassus._output_topics = ANY_TOPIC
+        deployer_module._stack_cache.clear()
+        self.addCleanup(deployer_module._stack_cache.clear)
 
     def tearDown(self):
         self.patcher.stop()
 
+    def test_uses_resource_of_stack_region(self):
+        self.crassus.load()
+        self.resource_mock.assert_called_once_with(
+            'cloudformation', 'ANY_REGION', None, retries=False)
+
+    def test_uses_resource_of_given_role(self):
+        self.crassus.stack_update_parameters.role_arn = 'ANY_ROLE_ARN'
+        self.crassus.load()
+        self.resource_mock.assert_called_once_with(
+            'cloudformation', 'ANY_REGION', 'ANY_ROLE_ARN', retries=False)
+
+    @patch('crassus.deployer.get_lambda_config')
+    def test_uses_resource_of_given_account(self, config_mock):
+        config_mock.return_value = {'cross_account_role': 'ANY_ROLE'}
+        self.crassus.stack_update_parameters.account_id = '123456789012'
+        self.crassus.load()
+        self.resource_mock.assert_called_once_with(
+            'cloudformation', 'ANY_REGION',
+            'arn:aws:iam::123456789012:role/ANY_ROLE', retries=False)
+
+    @patch('crassus.deployer.get_lambda_config')
+    def test_uses_default_role_of_given_account(self, config_mock):
+        config_mock.return_value = {}
+        self.crassus.stack_update_parameters.account_id = '123456789012'
+        self.assertEqual(
+            self.crassus.role_arn,
+            'arn:aws:iam::123456789012:role/crassus-deployer')
+
+    @patch('crassus.deployer.Crassus.notify')
+    @patch('crassus.deployer.logger')
+    def test_assume_role_throws_clienterror_exception(
+            self, logger_mock, notify_mock):
+        self.crassus.stack_update_parameters.role_arn = 'ANY_ROLE_ARN'
+        self.resource_mock.side_effect = ClientError(
+            {'Error': {'Code': 'AccessDenied', 'Message': 'denied'}},
+            'AssumeRole')
+        self.assertFalse(self.crassus.load())
+        logger_mock.error.assert_called_once_with(ANY)
+        notify_mock.assert_called_once_with(
+            DeploymentResponse.STATUS_FAILURE, ANY)
+
     def test_deploy_stack_should_load_stack(self):
         self.crassus.load()
         self.stack_mock.load.assert_called_once_with()
 
+    def test_caches_loaded_stack(self):
+        self.stack_mock.meta.data = {'StackStatus': 'UPDATE_COMPLETE'}
+        self.crassus.load()
+        self.assertEqual(
+            deployer_module._stack_cache.get(self.crassus.stack_cache_key),
+            {'StackStatus': 'UPDATE_COMPLETE'})
+        self.assertFalse(self.crassus.loaded_from_cache)
+
+    def test_uses_cached_stack(self):
+        deployer_module._stack_cache.put(
+            self.crassus.stack_cache_key, {'StackStatus': 'UPDATE_COMPLETE'})
+        self.assertTrue(self.crassus.load())
+        self.assertFalse(self.stack_mock.load.called)
+        self.assertEqual(
+            self.stack_mock.meta.data, {'StackStatus': 'UPDATE_COMPLETE'})
+        self.assertTrue(self.crassus.loaded_from_cache)
+
+    @patch('crassus.throttling.time')
+    def test_retries_throttled_stack_load(self, time_mock):
+        time_mock.time.return_value = 1000
+        self.crassus.cfn_caller.bucket = TokenBucket()
+        self.stack_mock.load.side_effect = [
+            ClientError({'Error': {'Code': 'Throttling', 'Message': ''}},
+                        'DescribeStacks'),
+            None]
+        self.assertTrue(self.crassus.load())
+        self.assertEqual(self.stack_mock.load.call_count, 2)
+
     @patch('crassus.deployer.sqs_send_message')
     @patch('crassus.deployer.logger')
     def test_stack_load_throws_clienterror_exception(
@@ -234,6 +753,44 @@ class TestLoad(unittest.TestCase):
     """
 
 
+class TestDescribeStacks(unittest.TestCase):
+
+    def setUp(self):
+        self.crassus = Crassus(None, None, StackUpdateParameter({
+            'version': '2',
+            'stackName': None,
+            'region': 'ANY_REGION',
+            'parameters': {}}))
+        self.crassus._aws_cfn = Mock()
+        self.crassus.cfn_caller.bucket = TokenBucket()
+        self.client_mock = self.crassus._aws_cfn.meta.client
+        deployer_module._stack_cache.clear()
+        self.addCleanup(deployer_module._stack_cache.clear)
+
+    def test_returns_matching_stacks_of_all_pages(self):
+        self.client_mock.describe_stacks.side_effect = [
+            {'Stacks': [{'StackName': 'app-1'}, {'StackName': 'db-1'}],
+             'NextToken': 'TOKEN'},
+            {'Stacks': [{'StackName': 'app-2'}]}]
+        stacks = self.crassus.describe_stacks(
+            lambda stack: stack['StackName'].startswith('app-'))
+        self.assertEqual(stacks, [{'StackName': 'app-1'},
+                                  {'StackName': 'app-2'}])
+        self.client_mock.describe_stacks.assert_has_calls(
+            [call(), call(NextToken='TOKEN')])
+
+    def test_caches_matching_stacks(self):
+        self.client_mock.describe_stacks.return_value = {
+            'Stacks': [{'StackName': 'app-1'}, {'StackName': 'db-1'}]}
+        self.crassus.describe_stacks(
+            lambda stack: stack['StackName'] == 'app-1')
+        self.assertEqual(
+            deployer_module._stack_cache.get((None, 'ANY_REGION', 'app-1')),
+            {'StackName': 'app-1'})
+        self.assertIsNone(
+            deployer_module._stack_cache.get((None, 'ANY_REGION', 'db-1')))
+
+
 class TestStackUpdateParameters(unittest.TestCase):
 
     def setUp(self):
@@ -252,10 +809,40 @@ class TestStackUpdateParameters(unittest.TestCase):
         self.assertEqual(sup.version, 1)
         self.assertEqual(sup.stack_name, "ANY_STACK")
         self.assertEqual(sup.region, "ANY_REGION")
+        self.assertEqual(sup.role_arn, None)
+        self.assertEqual(sup.account_id, None)
         self.assertEqual(sup.items(), [
             ("PARAMETER1", "VALUE1"),
             ("PARAMETER2", "VALUE2")])
 
+    def test_from_sqs_record(self):
+        stack_update_parameters = StackUpdateParameter.from_record({
+            'eventSource': 'aws:sqs',
+            'messageId': 'ANY_MESSAGE_ID',
+            'body': json.dumps(self.input_message)})
+        self.assertEqual(stack_update_parameters.stack_name, STACK_NAME)
+        self.assertEqual(
+            stack_update_parameters.message_ids, ['ANY_MESSAGE_ID'])
+
+    def test_from_sqs_record_with_sns_notification(self):
+        stack_update_parameters = StackUpdateParameter.from_record({
+            'eventSource': 'aws:sqs',
+            'messageId': 'ANY_MESSAGE_ID',
+            'body': json.dumps({
+                'Type': 'Notification',
+                'MessageId': 'ANY_SNS_MESSAGE_ID',
+                'Message': json.dumps(self.input_message)})})
+        self.assertEqual(stack_update_parameters.stack_name, STACK_NAME)
+        self.assertEqual(
+            stack_update_parameters.message_ids, ['ANY_MESSAGE_ID'])
+
+    def test_init_cross_account(self):
+        self.input_message['roleArn'] = 'ANY_ROLE_ARN'
+        self.input_message['accountId'] = '123456789012'
+        sup = StackUpdateParameter(self.input_message)
+        self.assertEqual(sup.role_arn, 'ANY_ROLE_ARN')
+        self.assertEqual(sup.account_id, '123456789012')
+
     def test_to_aws_format(self):
         expected_output = [{"ParameterKey": "PARAMETER1",
                             "ParameterValue": "VALUE1"},
@@ -329,19 +916,44 @@ class TestStackUpdateParameters(unittest.TestCase):
 
         self.assertItemsEqual(result, expected_output)
 
+    def test_merge_keeps_stack_order_of_unchanged_parameters(self):
+        sup = StackUpdateParameter({
+            'parameters': {'param2': 'value2change'},
+            'version': 1,
+            'stackName': 'bla',
+            'region': 'eu-west-1'})
+        original_parameters = [
+            {'ParameterKey': 'param{0}'.format(index),
+             'ParameterValue': 'value{0}'.format(index)}
+            for index in range(1, 5)]
+
+        self.assertEqual(sup.merge(original_parameters), [
+            {'ParameterKey': 'param2', 'ParameterValue': 'value2change'},
+            {'ParameterKey': 'param1', 'UsePreviousValue': True},
+            {'ParameterKey': 'param3', 'UsePreviousValue': True},
+            {'ParameterKey': 'param4', 'UsePreviousValue': True}])
+
+    def test_is_unchanged(self):
+        self.assertTrue(StackUpdateParameter.is_unchanged([
+            {'ParameterKey': 'param1', 'UsePreviousValue': True}]))
+        self.assertTrue(StackUpdateParameter.is_unchanged([]))
+        self.assertFalse(StackUpdateParameter.is_unchanged([
+            {'ParameterKey': 'param1', 'UsePreviousValue': True},
+            {'ParameterKey': 'param2', 'ParameterValue': 'value2'}]))
+
+    def test_merge_stack_without_parameters(self):
+        sup = StackUpdateParameter(self.input_message)
+        self.assertEqual(sup.merge(None), [])
+
 
 class TestOutputTopic(unittest.TestCase):
 
     def setUp(self):
-        self.patcher = patch('boto3.client')
-        self.boto3_client = self.patcher.start()
+        clear_lambda_config_cache()
         self.context_mock = Mock(invoked_function_arn="any_arn",
                                  function_version="any_version")
         self.crassus = Crassus(None, self.context_mock)
 
-    def tearDown(self):
-        self.patcher.stop()
-
     @patch('crassus.utils.aws_lambda')
     def test_output_topics_returns_arn_list(self, mock_lambda):
         mock_lambda.get_function_configuration.return_value = {
@@ -390,3 +1002,53 @@ class TestGaiusMessage(unittest.TestCase):
         self.assertEqual(result_message['timestamp'], 'timestamp')
         self.assertEqual(result_message['emitter'], 'emitter')
         self.assertNotEqual(result_message['message'], 'invalid message')
+
+    def test_extra_fields(self):
+        result_message = DeploymentResponse(
+            'status', 'message', 'stack_name', 'timestamp', 'emitter',
+            resourceType='AWS::CloudFormation::Stack')
+        self.assertEqual(
+            result_message['resourceType'], 'AWS::CloudFormation::Stack')
+        self.assertEqual(len(result_message), 7)
+
+    def test_is_immutable(self):
+        result_message = DeploymentResponse(
+            'status', 'message', 'stack_name', 'timestamp', 'emitter')
+        with self.assertRaises(AttributeError):
+            result_message.status = 'other'
+        with self.assertRaises(TypeError):
+            result_message['status'] = 'other'
+        self.assertFalse(hasattr(result_message, '__dict__'))
+
+    def test_to_json_keeps_wire_format(self):
+        result_message = DeploymentResponse(
+            'status', 'message', 'stack_name', 'timestamp', 'emitter',
+            resourceType='ANY_TYPE')
+        self.assertEqual(json.loads(result_message.to_json()), {
+            'version': '1.1',
+            'status': 'status',
+            'message': 'message',
+            'stackName': 'stack_name',
+            'timestamp': 'timestamp',
+            'emitter': 'emitter',
+            'resourceType': 'ANY_TYPE'})
+        self.assertIs(result_message.to_json(), result_message.to_json())
+
+    def test_equals_dict_of_its_fields(self):
+        result_message = DeploymentResponse(
+            'status', 'message', 'stack_name', 'timestamp', 'emitter')
+        self.assertEqual(result_message, result_message.to_dict())
+        self.assertEqual(result_message, DeploymentResponse(
+            'status', 'message', 'stack_name', 'timestamp', 'emitter'))
+        self.assertNotEqual(result_message, DeploymentResponse(
+            'other', 'message', 'stack_name', 'timestamp', 'emitter'))
+
+    def test_subclass(self):
+        class OtherResponse(DeploymentResponse):
+            __slots__ = ()
+            version = '2.0'
+
+        result_message = OtherResponse(
+            'status', 'message', 'stack_name', 'timestamp', 'emitter')
+        self.assertEqual(result_message['version'], '2.0')
+        self.assertIsInstance(result_message, DeploymentResponse)
@@ -0,0 +1,80 @@
+import unittest
+
+from crassus.event_filter import EventFilter
+from mock import patch
+
+
+def cfn_message(status='UPDATE_COMPLETE',
+                resource_type='AWS::CloudFormation::Stack',
+                logical_resource_id='ANY_STACK', stack_name='ANY_STACK'):
+    return {
+        'ResourceStatus': status,
+        'ResourceType': resource_type,
+        'LogicalResourceId': logical_resource_id,
+        'StackName': stack_name}
+
+
+class TestEventFilter(unittest.TestCase):
+
+    def setUp(self):
+        self.patch_logger = patch('crassus.event_filter.logger')
+        self.mock_logger = self.patch_logger.start()
+
+    def tearDown(self):
+        self.patch_logger.stop()
+
+    def test_accepts_everything_without_config(self):
+        event_filter = EventFilter()
+        self.assertTrue(event_filter.accepts(cfn_message()))
+        self.assertTrue(event_filter.accepts({}))
+
+    def test_deny_list(self):
+        event_filter = EventFilter(
+            {'ResourceStatus': {'deny': ['*_IN_PROGRESS', 'DELETE_SKIPPED']}})
+        self.assertFalse(event_filter.accepts(
+            cfn_message(status='UPDATE_IN_PROGRESS')))
+        self.assertFalse(event_filter.accepts(
+            cfn_message(status='DELETE_SKIPPED')))
+        self.assertTrue(event_filter.accepts(
+            cfn_message(status='UPDATE_COMPLETE')))
+
+    def test_allow_list(self):
+        event_filter = EventFilter({'ResourceType': {
+            'allow': ['AWS::CloudFormation::Stack', 'AWS::EC2::*']}})
+        self.assertTrue(event_filter.accepts(cfn_message()))
+        self.assertTrue(event_filter.accepts(
+            cfn_message(resource_type='AWS::EC2::Instance')))
+        self.assertFalse(event_filter.accepts(
+            cfn_message(resource_type='AWS::SQS::Queue')))
+
+    def test_allow_and_deny_list(self):
+        event_filter = EventFilter({'StackName': {
+            'allow': ['app-*'], 'deny': ['app-test-*']}})
+        self.assertTrue(event_filter.accepts(
+            cfn_message(stack_name='app-live')))
+        self.assertFalse(event_filter.accepts(
+            cfn_message(stack_name='app-test-1')))
+        self.assertFalse(event_filter.accepts(
+            cfn_message(stack_name='other')))
+
+    def test_stack_level_only(self):
+        event_filter = EventFilter({'stack_level_only': True})
+        self.assertTrue(event_filter.accepts(cfn_message()))
+        self.assertFalse(event_filter.accepts(
+            cfn_message(resource_type='AWS::EC2::Instance',
+                        logical_resource_id='instance')))
+        # Nested stacks are resources of the stack
+        self.assertFalse(event_filter.accepts(
+            cfn_message(logical_resource_id='nestedStack')))
+
+    def test_invalid_config_is_ignored(self):
+        event_filter = EventFilter(['no', 'object'])
+        self.assertTrue(event_filter.accepts(cfn_message()))
+        self.assertEqual(self.mock_logger.error.call_count, 1)
+
+    def test_unknown_rules_are_ignored(self):
+        event_filter = EventFilter({
+            'Timestamp': {'deny': ['*']},
+            'ResourceStatus': ['no', 'object']})
+        self.assertTrue(event_filter.accepts(cfn_message()))
+        self.assertEqual(self.mock_logger.warning.call_count, 2)
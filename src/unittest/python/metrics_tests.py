@@ -0,0 +1,62 @@
+import json
+import unittest
+
+from crassus.metrics import PhaseTimer
+from mock import patch
+
+
+class TestPhaseTimer(unittest.TestCase):
+
+    def setUp(self):
+        self.patch_time = patch('crassus.metrics.time')
+        self.mock_time = self.patch_time.start()
+        self.timer = PhaseTimer()
+
+    def tearDown(self):
+        self.patch_time.stop()
+
+    def test_phases_are_timed_in_milliseconds(self):
+        self.mock_time.time.side_effect = [10.0, 10.25, 20.0, 20.5]
+        with self.timer.phase('load'):
+            pass
+        with self.timer.phase('update'):
+            pass
+        self.assertEqual(self.timer.timings, {'load': 250, 'update': 500})
+        self.assertEqual(list(self.timer.timings), ['load', 'update'])
+
+    def test_repeated_phases_add_up(self):
+        self.mock_time.time.side_effect = [10.0, 10.25, 20.0, 20.5]
+        for _ in range(2):
+            with self.timer.phase('config'):
+                pass
+        self.assertEqual(self.timer.timings, {'config': 750})
+
+    def test_phase_is_timed_on_error(self):
+        self.mock_time.time.side_effect = [10.0, 10.25]
+        with self.assertRaises(ValueError):
+            with self.timer.phase('parse'):
+                raise ValueError()
+        self.assertEqual(self.timer.timings, {'parse': 250})
+
+    @patch('crassus.metrics.print', create=True)
+    def test_emit_prints_emf_document(self, print_mock):
+        self.mock_time.time.side_effect = [10.0, 10.25, 1000.0]
+        with self.timer.phase('load'):
+            pass
+        self.timer.emit('deploy', StackName='ANY_STACK')
+        document = json.loads(print_mock.call_args[0][0])
+        self.assertEqual(document, {
+            '_aws': {
+                'Timestamp': 1000000,
+                'CloudWatchMetrics': [{
+                    'Namespace': 'Crassus',
+                    'Dimensions': [['Operation']],
+                    'Metrics': [{'Name': 'load', 'Unit': 'Milliseconds'}]}]},
+            'Operation': 'deploy',
+            'StackName': 'ANY_STACK',
+            'load': 250})
+
+    @patch('crassus.metrics.print', create=True)
+    def test_emit_without_timings_prints_nothing(self, print_mock):
+        self.timer.emit('deploy')
+        self.assertFalse(print_mock.called)
@@ -1,8 +1,10 @@
 import json
 import unittest
 
+from botocore.exceptions import ClientError
+from crassus import output_converter as output_converter_module
 from crassus.deployment_response import DeploymentResponse
-from crassus.output_converter import OutputConverter
+from crassus.output_converter import OutputConverter, event_key
 from mock import call, patch
 from utils import load_fixture_json
 
@@ -28,19 +30,36 @@ class TestOutputConverter(unittest.TestCase):
         self.mock_getconfig = self.patch_getconfig.start()
         self.mock_getconfig.return_value = ['OUTPUT-SQS-QUEUE-1']
 
+        # Patch get_lambda_config
+        self.patch_config = patch(
+            'crassus.output_converter.get_lambda_config')
+        self.mock_config = self.patch_config.start()
+        self.mock_config.return_value = {}
+
         # Patch logger
         self.patch_logger = patch('crassus.output_converter.logger')
         self.mock_logger = self.patch_logger.start()
 
-        # Patch sqs_send_message
-        self.patch_sqs_send = patch(
-            'crassus.output_converter.sqs_send_message')
-        self.mock_sqs_send = self.patch_sqs_send.start()
+        # Patch BackgroundResultPublisher
+        self.patch_publisher = patch(
+            'crassus.output_converter.BackgroundResultPublisher')
+        self.mock_publisher_class = self.patch_publisher.start()
+        self.mock_publisher = \
+            self.mock_publisher_class.return_value.__enter__.return_value
+        self.mock_publisher.flush.return_value = {}
+
+        output_converter_module._event_window.clear()
+
+        # Keep the printed EMF metrics out of the test output
+        patcher = patch('crassus.metrics.print', create=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
 
     def teardown(self):
         self.patch_getconfig.stop()
+        self.patch_config.stop()
         self.patch_logger.stop()
-        self.patch_sqs_send.stop()
+        self.patch_publisher.stop()
 
     def test_cast_type_string(self):
         """
@@ -60,6 +79,39 @@ class TestOutputConverter(unittest.TestCase):
         return_value = self.output_converter._cast_type(valid_json)
         self.assertEqual(return_value, json.loads(valid_json))
 
+    def test_cast_type_does_not_decode_plain_strings(self):
+        """
+        _cast_type() should not try to decode values that do not look
+        like JSON.
+        """
+        with patch('crassus.output_converter.json') as json_mock:
+            for value in ['2015-11-23T16:53:46.443Z', 'CREATE_COMPLETE',
+                          '', 'truevalue']:
+                self.assertEqual(
+                    self.output_converter._cast_type(value), value)
+            self.assertFalse(json_mock.loads.called)
+
+    def test_cast_type_literals_and_numbers(self):
+        cast_type = self.output_converter._cast_type
+        self.assertEqual(cast_type('123456789012'), 123456789012)
+        self.assertEqual(cast_type('-1.5e3'), -1500.0)
+        self.assertEqual(cast_type('true'), True)
+        self.assertEqual(cast_type('null'), None)
+        self.assertEqual(cast_type('["a"]'), ['a'])
+
+    def test_parser_parses_only_given_keys(self):
+        return_value = self.output_converter._parse_sns_message(
+            self.event['Records'][0]['Sns']['Message'],
+            ['StackName', 'Namespace', 'NoSuchKey'])
+        self.assertEqual(return_value, {
+            'StackName': 'crassus-karolyi-temp1', 'Namespace': 123456789012})
+
+    def test_parser_yields_lazily(self):
+        iterator = self.output_converter._iter_sns_message(
+            "First='1'\nUnparseable line'\nSecond='two'\nThird='{'")
+        self.assertEqual(next(iterator), ('First', 1))
+        self.assertEqual(list(iterator), [('Second', 'two'), ('Third', '{')])
+
     def test_parser_parses_correctly(self):
         """
         Test if the input event is parsed correctly.
@@ -119,7 +171,7 @@ class TestOutputConverter(unittest.TestCase):
         """
         self.output_converter.convert()
         self.assertEqual(self.mock_logger.warning.call_count, 0)
-        self.mock_sqs_send.assert_called_once_with(
+        self.mock_publisher.publish.assert_called_once_with(
             ['OUTPUT-SQS-QUEUE-1'], {
                 'status': 'CREATE_IN_PROGRESS',
                 'timestamp': '2015-11-23T16:53:46.443Z',
@@ -128,8 +180,82 @@ class TestOutputConverter(unittest.TestCase):
                 'message': 'Resource creation Initiated',
                 'emitter': 'cloudformation',
                 'resourceType': 'AWS::Lambda::Permission'})
-        deployment_parameter = self.mock_sqs_send.call_args[0][1]
+        deployment_parameter = self.mock_publisher.publish.call_args[0][1]
         self.assertIs(type(deployment_parameter), DeploymentResponse)
+        self.assertTrue(
+            self.mock_publisher_class.return_value.__exit__.called)
+
+    @patch('crassus.output_converter.PhaseTimer')
+    def test_convert_emits_timings(self, timer_mock):
+        self.output_converter.convert()
+        self.mock_publisher.flush.assert_called_once_with()
+        timer_mock.return_value.emit.assert_called_once_with(
+            'convert', Records=1)
+
+    def test_redelivered_events_are_published_once(self):
+        self.output_converter.event = {
+            'Records': cfn_event['Records'] * 2}
+        self.output_converter.convert()
+        self.output_converter.convert()
+        self.assertEqual(self.mock_publisher.publish.call_count, 1)
+
+    def test_event_key(self):
+        self.assertEqual(event_key({'EventId': 'ANY_ID'}), 'ANY_ID')
+        self.assertEqual(event_key({
+            'StackName': 'stack', 'LogicalResourceId': 'resource',
+            'ResourceStatus': 'UPDATE_COMPLETE', 'Timestamp': 'time'}),
+            'stack|resource|UPDATE_COMPLETE|time')
+
+    def test_undelivered_events_are_published_again(self):
+        def flush():
+            body = self.mock_publisher.publish.call_args[0][1].to_json()
+            return {'OUTPUT-SQS-QUEUE-1': [body]}
+        self.mock_publisher.flush.side_effect = flush
+        self.output_converter.convert()
+        self.mock_publisher.flush.side_effect = None
+        self.output_converter.convert()
+        self.output_converter.convert()
+        self.assertEqual(self.mock_publisher.publish.call_count, 2)
+
+    def test_events_of_failed_invocation_are_published_again(self):
+        self.mock_publisher.flush.side_effect = Exception('Timed out')
+        self.assertRaises(Exception, self.output_converter.convert)
+        self.mock_publisher.flush.side_effect = None
+        self.output_converter.convert()
+        self.assertEqual(self.mock_publisher.publish.call_count, 2)
+
+    @patch('crassus.output_converter.DynamoDBDedupStore')
+    def test_events_seen_by_dedup_store_are_dropped(self, store_class_mock):
+        self.mock_config.return_value = {'cfn_event_dedup_table': 'TABLE'}
+        store_class_mock.return_value.__contains__.return_value = True
+        self.output_converter.convert()
+        store_class_mock.assert_called_once_with('TABLE', 3600)
+        store_class_mock.return_value.__contains__.assert_called_once_with(
+            'cfnOutputConverterPermission-CREATE_IN_PROGRESS-'
+            '2015-11-23T16:53:46.443Z')
+        self.assertFalse(self.mock_publisher.publish.called)
+
+    @patch('crassus.output_converter.DynamoDBDedupStore')
+    def test_delivered_events_are_added_to_dedup_store(
+            self, store_class_mock):
+        self.mock_config.return_value = {'cfn_event_dedup_table': 'TABLE'}
+        store_class_mock.return_value.__contains__.return_value = False
+        self.output_converter.convert()
+        self.assertEqual(self.mock_publisher.publish.call_count, 1)
+        store_class_mock.return_value.add.assert_called_once_with(
+            'cfnOutputConverterPermission-CREATE_IN_PROGRESS-'
+            '2015-11-23T16:53:46.443Z')
+
+    @patch('crassus.output_converter.DynamoDBDedupStore')
+    def test_events_are_published_if_dedup_store_fails(
+            self, store_class_mock):
+        self.mock_config.return_value = {'cfn_event_dedup_table': 'TABLE'}
+        store_class_mock.return_value.__contains__.side_effect = ClientError(
+            {'Error': {'Code': 'ResourceNotFoundException', 'Message': ''}},
+            'GetItem')
+        self.output_converter.convert()
+        self.assertEqual(self.mock_publisher.publish.call_count, 1)
+        self.assertEqual(self.mock_logger.error.call_count, 1)
 
     def test_skips_empty_messages(self):
         """
@@ -138,7 +264,22 @@ class TestOutputConverter(unittest.TestCase):
         """
         self.output_converter.event = {'Records': [{}, {'foo': 1}]}
         self.output_converter.convert()
-        self.assertFalse(self.mock_sqs_send.called)
+        self.assertFalse(self.mock_publisher.publish.called)
         self.assertEqual(list(self.mock_logger.warning.call_args_list), [
             call('No \'Sns\' or \'Message\' in received event: {}'),
             call('No \'Sns\' or \'Message\' in received event: {\'foo\': 1}')])
+
+    def test_filtered_events_are_not_published(self):
+        """
+        Events the configured filter does not accept should be dropped.
+        """
+        self.mock_config.return_value = {'cfn_event_filter': {
+            'ResourceStatus': {'deny': ['*_IN_PROGRESS']}}}
+        self.output_converter.convert()
+        self.assertFalse(self.mock_publisher.publish.called)
+
+    def test_accepted_events_are_published(self):
+        self.mock_config.return_value = {'cfn_event_filter': {
+            'ResourceType': {'allow': ['AWS::Lambda::*']}}}
+        self.output_converter.convert()
+        self.assertEqual(self.mock_publisher.publish.call_count, 1)
@@ -0,0 +1,43 @@
+import unittest
+
+from crassus.polling import PollInterval, call, remaining_time
+from mock import Mock
+
+
+class TestPolling(unittest.TestCase):
+
+    def test_call_passes_arguments(self):
+        function = Mock(return_value='RESULT')
+        self.assertEqual(call(function, 1, key='value'), 'RESULT')
+        function.assert_called_once_with(1, key='value')
+
+    def test_remaining_time_keeps_margin(self):
+        context = Mock()
+        context.get_remaining_time_in_millis.return_value = 12000
+        self.assertEqual(remaining_time(context, 5.0), 7.0)
+
+    def test_no_remaining_time_without_context(self):
+        self.assertIsNone(remaining_time(None, 5.0))
+
+
+class TestPollInterval(unittest.TestCase):
+
+    def setUp(self):
+        self.interval = PollInterval(2.0, 5.0)
+
+    def test_grows_up_to_maximum_without_progress(self):
+        seconds = []
+        for _ in range(4):
+            self.interval.update(False)
+            seconds.append(self.interval.seconds)
+        self.assertEqual(seconds, [3.0, 4.5, 5.0, 5.0])
+
+    def test_starts_over_after_progress(self):
+        self.interval.update(False)
+        self.interval.update(True)
+        self.assertEqual(self.interval.seconds, 2.0)
+
+    def test_exceeds_remaining_time(self):
+        self.assertTrue(self.interval.exceeds(1.5))
+        self.assertFalse(self.interval.exceeds(2.0))
+        self.assertFalse(self.interval.exceeds(None))
@@ -0,0 +1,239 @@
+import threading
+import unittest
+
+from botocore.exceptions import ClientError
+from crassus.deployment_response import DeploymentResponse
+from crassus.result_publisher import (
+    BackgroundResultPublisher, ResultPublisher)
+from mock import Mock, call, patch
+
+
+def deployment_response(index):
+    return DeploymentResponse(
+        'status', 'message {0}'.format(index), 'stack_name', 'timestamp',
+        'emitter')
+
+
+def client_error(operation_name):
+    return ClientError(
+        {'Error': {'Code': 'ExpectedException', 'Message': 'Error'}},
+        operation_name)
+
+
+class TestResultPublisher(unittest.TestCase):
+
+    """
+    Tests for ResultPublisher.
+    """
+
+    def setUp(self):
+        self.patch_logger = patch('crassus.result_publisher.logger')
+        self.mock_logger = self.patch_logger.start()
+
+        self.patch_sqs = patch('crassus.utils.aws_sqs')
+        self.mock_aws_sqs = self.patch_sqs.start()
+        self.mock_aws_sqs.send_message_batch.return_value = {
+            'Successful': [], 'Failed': []}
+
+        self.messages = [deployment_response(index) for index in range(23)]
+        self.bodies = [message.to_json() for message in self.messages]
+
+    def tearDown(self):
+        self.patch_logger.stop()
+        self.patch_sqs.stop()
+
+    def batch_call(self, queue_url, bodies):
+        return call(QueueUrl=queue_url, Entries=[
+            {'Id': str(index), 'MessageBody': body, 'DelaySeconds': 0}
+            for index, body in enumerate(bodies)])
+
+    def test_messages_are_buffered_until_flush(self):
+        publisher = ResultPublisher()
+        publisher.publish(['QUEUE'], self.messages[0])
+        self.assertFalse(self.mock_aws_sqs.send_message_batch.called)
+        self.assertEqual(publisher.flush(), {'QUEUE': []})
+        self.assertEqual(
+            self.mock_aws_sqs.send_message_batch.call_args_list,
+            [self.batch_call('QUEUE', self.bodies[:1])])
+
+    def test_context_manager_flushes(self):
+        with ResultPublisher() as publisher:
+            publisher.publish(['QUEUE'], self.messages[0])
+        self.assertEqual(self.mock_aws_sqs.send_message_batch.call_count, 1)
+
+    def test_messages_are_sent_in_chunks_per_queue(self):
+        publisher = ResultPublisher()
+        for message in self.messages:
+            publisher.publish(['QUEUE1', 'QUEUE2'], message)
+        publisher.flush()
+        for queue_url in ['QUEUE1', 'QUEUE2']:
+            self.assertEqual(
+                [batch_call for batch_call
+                 in self.mock_aws_sqs.send_message_batch.call_args_list
+                 if batch_call[1]['QueueUrl'] == queue_url], [
+                    self.batch_call(queue_url, self.bodies[:10]),
+                    self.batch_call(queue_url, self.bodies[10:20]),
+                    self.batch_call(queue_url, self.bodies[20:])])
+        self.assertFalse(self.mock_aws_sqs.send_message.called)
+
+    def test_queues_are_sent_to_concurrently(self):
+        queue2_sent = threading.Event()
+
+        def send_message_batch(QueueUrl, Entries):
+            if QueueUrl == 'SLOW_QUEUE':
+                # Only succeeds if the other queue is not waiting for us
+                if not queue2_sent.wait(5):
+                    raise client_error('SendMessageBatch')
+            else:
+                queue2_sent.set()
+            return {'Successful': [], 'Failed': []}
+        self.mock_aws_sqs.send_message_batch.side_effect = send_message_batch
+
+        publisher = ResultPublisher()
+        publisher.publish(['SLOW_QUEUE', 'QUEUE2'], self.messages[0])
+        self.assertEqual(
+            publisher.flush(), {'SLOW_QUEUE': [], 'QUEUE2': []})
+        self.assertFalse(self.mock_aws_sqs.send_message.called)
+
+    def test_unexpected_error_only_fails_its_queue(self):
+        def send_message_batch(QueueUrl, Entries):
+            if QueueUrl == 'BROKEN_QUEUE':
+                raise RuntimeError('unexpected')
+            return {'Successful': [], 'Failed': []}
+        self.mock_aws_sqs.send_message_batch.side_effect = send_message_batch
+
+        publisher = ResultPublisher()
+        publisher.publish(['BROKEN_QUEUE', 'QUEUE2'], self.messages[0])
+        self.assertEqual(publisher.flush(), {
+            'BROKEN_QUEUE': [self.bodies[0]], 'QUEUE2': []})
+        self.assertEqual(self.mock_logger.exception.call_count, 1)
+
+    def test_flush_empties_the_buffer(self):
+        publisher = ResultPublisher()
+        publisher.publish(['QUEUE'], self.messages[0])
+        publisher.flush()
+        self.assertEqual(publisher.flush(), {})
+        self.assertEqual(self.mock_aws_sqs.send_message_batch.call_count, 1)
+
+    def test_failed_entries_are_retried_individually(self):
+        self.mock_aws_sqs.send_message_batch.return_value = {
+            'Successful': [{'Id': '0'}, {'Id': '2'}],
+            'Failed': [{'Id': '1', 'SenderFault': False, 'Code': 'Error'}]}
+        publisher = ResultPublisher()
+        for message in self.messages[:3]:
+            publisher.publish(['QUEUE'], message)
+        self.assertEqual(publisher.flush(), {'QUEUE': []})
+        self.mock_aws_sqs.send_message.assert_called_once_with(
+            QueueUrl='QUEUE', MessageBody=self.bodies[1], DelaySeconds=0)
+
+    def test_failed_batch_is_retried_individually(self):
+        self.mock_aws_sqs.send_message_batch.side_effect = \
+            client_error('SendMessageBatch')
+        self.mock_aws_sqs.send_message.side_effect = [
+            None, client_error('SendMessage')]
+        publisher = ResultPublisher()
+        for message in self.messages[:2]:
+            publisher.publish(['QUEUE'], message)
+        self.assertEqual(publisher.flush(), {'QUEUE': [self.bodies[1]]})
+        self.assertEqual(self.mock_aws_sqs.send_message.call_count, 2)
+        self.assertEqual(self.mock_logger.error.call_count, 1)
+
+    def test_message_is_not_valid_type(self):
+        publisher = ResultPublisher()
+        publisher.publish(['QUEUE'], 'invalid message')
+        self.assertEqual(publisher.flush(), {})
+        self.assertEqual(self.mock_logger.error.call_count, 1)
+
+    def test_no_queues(self):
+        publisher = ResultPublisher()
+        publisher.publish(None, self.messages[0])
+        self.assertEqual(publisher.flush(), {})
+
+
+class TestBackgroundResultPublisher(unittest.TestCase):
+
+    """
+    Tests for BackgroundResultPublisher.
+    """
+
+    def setUp(self):
+        self.patch_logger = patch('crassus.result_publisher.logger')
+        self.mock_logger = self.patch_logger.start()
+
+        self.patch_sqs = patch('crassus.utils.aws_sqs')
+        self.mock_aws_sqs = self.patch_sqs.start()
+        self.mock_aws_sqs.send_message_batch.return_value = {
+            'Successful': [], 'Failed': []}
+
+        self.messages = [deployment_response(index) for index in range(3)]
+        self.bodies = [message.to_json() for message in self.messages]
+
+    def tearDown(self):
+        self.patch_logger.stop()
+        self.patch_sqs.stop()
+
+    def test_messages_are_sent_before_flush(self):
+        sent = threading.Event()
+        self.mock_aws_sqs.send_message_batch.side_effect = \
+            lambda **kwargs: sent.set() or {'Successful': [], 'Failed': []}
+        publisher = BackgroundResultPublisher()
+        publisher.publish(['QUEUE'], self.messages[0])
+        self.assertTrue(sent.wait(5))
+        self.assertEqual(publisher.flush(), {'QUEUE': []})
+
+    def test_messages_published_while_sending_go_in_next_batch(self):
+        sending = threading.Event()
+        release = threading.Event()
+
+        def send_message_batch(QueueUrl, Entries):
+            sending.set()
+            release.wait(5)
+            return {'Successful': [], 'Failed': []}
+        self.mock_aws_sqs.send_message_batch.side_effect = send_message_batch
+
+        publisher = BackgroundResultPublisher()
+        publisher.publish(['QUEUE'], self.messages[0])
+        self.assertTrue(sending.wait(5))
+        publisher.publish(['QUEUE'], self.messages[1])
+        publisher.publish(['QUEUE'], self.messages[2])
+        release.set()
+        self.assertEqual(publisher.flush(), {'QUEUE': []})
+        self.assertEqual(
+            [len(batch_call[1]['Entries']) for batch_call
+             in self.mock_aws_sqs.send_message_batch.call_args_list],
+            [1, 2])
+
+    def test_undelivered_messages_are_reported(self):
+        self.mock_aws_sqs.send_message_batch.side_effect = \
+            client_error('SendMessageBatch')
+        self.mock_aws_sqs.send_message.side_effect = \
+            client_error('SendMessage')
+        with BackgroundResultPublisher() as publisher:
+            publisher.publish(['QUEUE'], self.messages[0])
+            self.assertEqual(
+                publisher.flush(), {'QUEUE': [self.bodies[0]]})
+        self.assertTrue(self.mock_logger.error.called)
+
+    def test_flush_stops_waiting_at_the_deadline(self):
+        release = threading.Event()
+        self.mock_aws_sqs.send_message_batch.side_effect = \
+            lambda **kwargs: release.wait(5) and {'Failed': []}
+        context = Mock()
+        context.get_remaining_time_in_millis.return_value = 1100
+        publisher = BackgroundResultPublisher(context=context)
+        publisher.publish(['QUEUE'], self.messages[0])
+        try:
+            self.assertEqual(publisher.flush(), {'QUEUE': [self.bodies[0]]})
+        finally:
+            release.set()
+
+    def test_flush_without_messages(self):
+        self.assertEqual(BackgroundResultPublisher().flush(), {})
+
+    def test_publisher_can_be_used_after_flush(self):
+        publisher = BackgroundResultPublisher()
+        publisher.publish(['QUEUE'], self.messages[0])
+        publisher.flush()
+        publisher.publish(['QUEUE'], self.messages[1])
+        self.assertEqual(publisher.flush(), {'QUEUE': []})
+        self.assertEqual(self.mock_aws_sqs.send_message_batch.call_count, 2)
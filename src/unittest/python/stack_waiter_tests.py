@@ -0,0 +1,127 @@
+import unittest
+
+from crassus.stack_waiter import (
+    MAX_POLL_INTERVAL, MIN_POLL_INTERVAL, StackWaiter, is_terminal)
+from mock import Mock, call, patch
+
+STACK_NAME = 'ANY_STACK'
+STACK_TYPE = 'AWS::CloudFormation::Stack'
+
+
+def stack_event(event_id, status, logical_id=STACK_NAME,
+                resource_type=STACK_TYPE, reason=None):
+    event = {
+        'EventId': event_id, 'StackName': STACK_NAME,
+        'LogicalResourceId': logical_id, 'ResourceType': resource_type,
+        'ResourceStatus': status}
+    if reason is not None:
+        event['ResourceStatusReason'] = reason
+    return event
+
+
+class TestStackWaiter(unittest.TestCase):
+
+    def setUp(self):
+        self.patch_time = patch('crassus.stack_waiter.time')
+        self.mock_time = self.patch_time.start()
+        self.patch_logger = patch('crassus.stack_waiter.logger')
+        self.patch_logger.start()
+        self.client = Mock()
+        self.context = Mock()
+        self.context.get_remaining_time_in_millis.return_value = 300000
+        self.waiter = StackWaiter(self.client, STACK_NAME, self.context)
+
+    def tearDown(self):
+        self.patch_time.stop()
+        self.patch_logger.stop()
+
+    def test_is_terminal(self):
+        self.assertTrue(is_terminal('UPDATE_COMPLETE'))
+        self.assertTrue(is_terminal('UPDATE_ROLLBACK_FAILED'))
+        self.assertFalse(is_terminal('UPDATE_COMPLETE_CLEANUP_IN_PROGRESS'))
+
+    def test_start_remembers_newest_event(self):
+        self.client.describe_stack_events.return_value = {'StackEvents': [
+            stack_event('E2', 'CREATE_COMPLETE'),
+            stack_event('E1', 'CREATE_IN_PROGRESS')]}
+        self.waiter.start()
+        self.assertEqual(self.waiter.last_event_id, 'E2')
+
+    def test_new_events_reads_pages_until_last_seen_event(self):
+        self.waiter.last_event_id = 'E1'
+        self.client.describe_stack_events.side_effect = [
+            {'StackEvents': [stack_event('E4', 'UPDATE_COMPLETE'),
+                             stack_event('E3', 'UPDATE_IN_PROGRESS')],
+             'NextToken': 'TOKEN'},
+            {'StackEvents': [stack_event('E2', 'UPDATE_IN_PROGRESS'),
+                             stack_event('E1', 'CREATE_COMPLETE'),
+                             stack_event('E0', 'CREATE_IN_PROGRESS')],
+             'NextToken': 'OTHER_TOKEN'}]
+        self.assertEqual(
+            [event['EventId'] for event in self.waiter.new_events()],
+            ['E2', 'E3', 'E4'])
+        self.assertEqual(self.waiter.last_event_id, 'E4')
+        self.assertEqual(self.client.describe_stack_events.call_args_list, [
+            call(StackName=STACK_NAME),
+            call(StackName=STACK_NAME, NextToken='TOKEN')])
+
+    def test_wait_returns_terminal_status(self):
+        self.waiter.last_event_id = 'E1'
+        self.client.describe_stack_events.side_effect = [
+            {'StackEvents': [stack_event('E2', 'UPDATE_IN_PROGRESS'),
+                             stack_event('E1', 'CREATE_COMPLETE')]},
+            {'StackEvents': [stack_event('E2', 'UPDATE_IN_PROGRESS')]},
+            {'StackEvents': [stack_event('E2', 'UPDATE_IN_PROGRESS')]},
+            {'StackEvents': [stack_event('E3', 'UPDATE_COMPLETE'),
+                             stack_event('E2', 'UPDATE_IN_PROGRESS')]}]
+        self.assertEqual(self.waiter.wait(), 'UPDATE_COMPLETE')
+        self.assertEqual(self.mock_time.sleep.call_args_list, [
+            call(MIN_POLL_INTERVAL), call(MIN_POLL_INTERVAL * 1.5),
+            call(MIN_POLL_INTERVAL * 1.5 * 1.5)])
+
+    def test_wait_collects_failure_reasons(self):
+        self.waiter.last_event_id = 'E1'
+        self.client.describe_stack_events.return_value = {'StackEvents': [
+            stack_event('E4', 'UPDATE_ROLLBACK_COMPLETE'),
+            stack_event('E3', 'UPDATE_FAILED', 'Instance',
+                        'AWS::EC2::Instance', 'Invalid type'),
+            stack_event('E2', 'UPDATE_IN_PROGRESS'),
+            stack_event('E1', 'CREATE_COMPLETE')]}
+        self.assertEqual(self.waiter.wait(), 'UPDATE_ROLLBACK_COMPLETE')
+        self.assertEqual(
+            self.waiter.failure_reasons, ['Instance: Invalid type'])
+
+    def test_poll_interval_is_bounded(self):
+        self.waiter.last_event_id = 'E1'
+        self.client.describe_stack_events.side_effect = (
+            [{'StackEvents': [stack_event('E1', 'CREATE_COMPLETE')]}] * 10 +
+            [{'StackEvents': [stack_event('E2', 'UPDATE_COMPLETE')]}])
+        self.waiter.wait()
+        self.assertEqual(
+            max(args[0][0] for args in self.mock_time.sleep.call_args_list),
+            MAX_POLL_INTERVAL)
+
+    def test_wait_stops_when_time_is_up(self):
+        self.context.get_remaining_time_in_millis.return_value = 6000
+        self.waiter.last_event_id = 'E1'
+        self.client.describe_stack_events.return_value = {'StackEvents': [
+            stack_event('E2', 'UPDATE_IN_PROGRESS'),
+            stack_event('E1', 'CREATE_COMPLETE')]}
+        self.assertEqual(self.waiter.wait(), 'UPDATE_IN_PROGRESS')
+        self.assertFalse(self.mock_time.sleep.called)
+
+    def test_wait_stops_after_timeout(self):
+        self.mock_time.time.side_effect = [1000.0, 1000.0, 1004.0]
+        waiter = StackWaiter(self.client, STACK_NAME, self.context,
+                             timeout=5.0)
+        waiter.last_event_id = 'E1'
+        self.client.describe_stack_events.return_value = {'StackEvents': []}
+        self.assertIsNone(waiter.wait())
+        self.assertEqual(self.mock_time.sleep.call_count, 1)
+
+    def test_calls_are_made_through_caller(self):
+        caller = Mock(return_value={'StackEvents': []})
+        waiter = StackWaiter(self.client, STACK_NAME, caller=caller)
+        waiter.start()
+        caller.assert_called_once_with(
+            self.client.describe_stack_events, StackName=STACK_NAME)
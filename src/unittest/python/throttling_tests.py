@@ -0,0 +1,147 @@
+import unittest
+
+from botocore.exceptions import ClientError, EndpointConnectionError
+from crassus.throttling import (
+    MAX_ATTEMPTS, MIN_RATE, RateLimitTimeout, ThrottledCaller, TokenBucket,
+    get_bucket)
+from mock import Mock, patch
+
+
+def client_error(code, status_code=400):
+    return ClientError({
+        'Error': {'Code': code, 'Message': code},
+        'ResponseMetadata': {'HTTPStatusCode': status_code}}, 'Test')
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def setUp(self):
+        self.patch_time = patch('crassus.throttling.time')
+        self.mock_time = self.patch_time.start()
+        self.mock_time.time.return_value = 1000
+        self.bucket = TokenBucket(rate=2.0, capacity=2)
+
+    def tearDown(self):
+        self.patch_time.stop()
+
+    def test_burst_up_to_capacity_without_waiting(self):
+        self.assertEqual(self.bucket.take(), 0)
+        self.assertEqual(self.bucket.take(), 0)
+        self.assertEqual(self.bucket.take(), 0.5)
+        self.assertEqual(self.bucket.take(), 1.0)
+
+    def test_clock_set_back_costs_no_tokens(self):
+        self.mock_time.time.return_value = 900
+        self.assertEqual(self.bucket.take(), 0)
+        self.mock_time.time.return_value = 1000
+        self.assertEqual(self.bucket.take(), 0)
+
+    def test_tokens_refill_with_rate(self):
+        self.bucket.take()
+        self.bucket.take()
+        self.mock_time.time.return_value = 1000.5
+        self.assertEqual(self.bucket.take(), 0)
+
+    def test_rate_adapts_to_throttling(self):
+        self.bucket.throttled()
+        self.assertEqual(self.bucket.rate, 1.0)
+        for _ in range(10):
+            self.bucket.throttled()
+        self.assertEqual(self.bucket.rate, MIN_RATE)
+        for _ in range(100):
+            self.bucket.succeeded()
+        self.assertEqual(self.bucket.rate, 2.0)
+
+    def test_token_put_back_is_available_again(self):
+        self.bucket.take()
+        self.bucket.take()
+        self.bucket.take()
+        self.bucket.put_back()
+        self.assertEqual(self.bucket.take(), 0.5)
+
+    def test_buckets_are_shared_per_key(self):
+        self.assertIs(get_bucket(('ROLE', 'eu-west-1')),
+                      get_bucket(('ROLE', 'eu-west-1')))
+        self.assertIsNot(get_bucket(('ROLE', 'eu-west-1')),
+                         get_bucket(('ROLE', 'us-east-1')))
+
+
+class TestThrottledCaller(unittest.TestCase):
+
+    def setUp(self):
+        self.patch_time = patch('crassus.throttling.time')
+        self.mock_time = self.patch_time.start()
+        self.mock_time.time.return_value = 1000
+        self.context = Mock()
+        self.context.get_remaining_time_in_millis.return_value = 60000
+        self.caller = ThrottledCaller(('ROLE', 'REGION'), self.context)
+        self.caller.bucket = TokenBucket()
+
+    def tearDown(self):
+        self.patch_time.stop()
+
+    def test_returns_result_and_passes_arguments(self):
+        function = Mock(return_value='RESULT')
+        self.assertEqual(self.caller(function, 1, key='value'), 'RESULT')
+        function.assert_called_once_with(1, key='value')
+        self.assertFalse(self.mock_time.sleep.called)
+
+    def test_retries_throttled_calls(self):
+        function = Mock(side_effect=[
+            client_error('Throttling'), client_error('RequestLimitExceeded'),
+            'RESULT'])
+        self.assertEqual(self.caller(function), 'RESULT')
+        self.assertEqual(function.call_count, 3)
+        self.assertEqual(self.mock_time.sleep.call_count, 2)
+
+    def test_retries_transient_errors_without_lowering_the_rate(self):
+        function = Mock(side_effect=[
+            client_error('InternalFailure', 500),
+            client_error('UnknownError', 503),
+            EndpointConnectionError(endpoint_url='ANY_URL'), 'RESULT'])
+        self.assertEqual(self.caller(function), 'RESULT')
+        self.assertEqual(function.call_count, 4)
+        self.assertEqual(self.caller.bucket.rate, self.caller.bucket.max_rate)
+
+    def test_gives_up_on_transient_errors_after_max_attempts(self):
+        function = Mock(side_effect=EndpointConnectionError(
+            endpoint_url='ANY_URL'))
+        self.assertRaises(EndpointConnectionError, self.caller, function)
+        self.assertEqual(function.call_count, MAX_ATTEMPTS)
+
+    def test_no_call_without_time_for_the_rate_limit(self):
+        self.caller.bucket = TokenBucket(rate=0.5, capacity=1)
+        self.caller.bucket.take()
+        self.context.get_remaining_time_in_millis.return_value = 3000
+        function = Mock()
+        self.assertRaises(RateLimitTimeout, self.caller, function)
+        self.assertFalse(function.called)
+        self.assertFalse(self.mock_time.sleep.called)
+
+    def test_raises_other_errors_right_away(self):
+        function = Mock(side_effect=client_error('ValidationError'))
+        self.assertRaises(ClientError, self.caller, function)
+        self.assertEqual(function.call_count, 1)
+
+    def test_gives_up_after_max_attempts(self):
+        function = Mock(side_effect=client_error('Throttling'))
+        self.assertRaises(ClientError, self.caller, function)
+        self.assertEqual(function.call_count, MAX_ATTEMPTS)
+
+    @patch('crassus.throttling.random')
+    def test_gives_up_when_lambda_runs_out_of_time(self, mock_random):
+        mock_random.uniform.return_value = 1.0
+        self.context.get_remaining_time_in_millis.return_value = 2500
+        function = Mock(side_effect=client_error('Throttling'))
+        self.assertRaises(ClientError, self.caller, function)
+        self.assertEqual(function.call_count, 1)
+        self.assertFalse(self.mock_time.sleep.called)
+
+    @patch('crassus.throttling.random')
+    def test_backoff_grows_exponentially(self, mock_random):
+        mock_random.uniform.side_effect = lambda low, high: high
+        function = Mock(side_effect=[client_error('Throttling')] * 3 + [1])
+        self.caller(function)
+        self.assertEqual(
+            [args[0][1] for args in mock_random.uniform.call_args_list],
+            [1.0, 2.0, 4.0])
@@ -0,0 +1,51 @@
+import unittest
+
+from crassus.ttl_cache import TTLCache
+from mock import patch
+
+KEY = (None, 'eu-west-1', 'ANY_STACK')
+
+
+@patch('crassus.ttl_cache.time')
+class TestTTLCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = TTLCache(ttl=30, max_size=2)
+
+    def test_returns_data_within_ttl(self, time_mock):
+        time_mock.time.return_value = 1000
+        self.cache.put(KEY, {'StackStatus': 'UPDATE_COMPLETE'})
+        time_mock.time.return_value = 1029
+        self.assertEqual(
+            self.cache.get(KEY), {'StackStatus': 'UPDATE_COMPLETE'})
+
+    def test_forgets_expired_data(self, time_mock):
+        time_mock.time.return_value = 1000
+        self.cache.put(KEY, {'StackStatus': 'UPDATE_COMPLETE'})
+        time_mock.time.return_value = 1030
+        self.assertIsNone(self.cache.get(KEY))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_invalidate_forgets_data(self, time_mock):
+        time_mock.time.return_value = 1000
+        self.cache.put(KEY, {'StackStatus': 'UPDATE_COMPLETE'})
+        self.cache.invalidate(KEY)
+        self.assertIsNone(self.cache.get(KEY))
+
+    def test_forgets_least_recently_put_keys(self, time_mock):
+        time_mock.time.return_value = 1000
+        self.cache.put('A', {})
+        self.cache.put('B', {})
+        self.cache.put('A', {'StackStatus': 'UPDATE_COMPLETE'})
+        self.cache.put('C', {})
+        self.assertIsNone(self.cache.get('B'))
+        self.assertEqual(
+            self.cache.get('A'), {'StackStatus': 'UPDATE_COMPLETE'})
+        self.assertEqual(self.cache.get('C'), {})
+
+    def test_get_returns_default_without_value(self, time_mock):
+        time_mock.time.return_value = 1000
+        self.assertEqual(self.cache.get(KEY, 'DEFAULT'), 'DEFAULT')
+        self.assertNotIn(KEY, self.cache)
+        self.cache.put(KEY, None)
+        self.assertIn(KEY, self.cache)
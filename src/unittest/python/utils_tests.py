@@ -1,9 +1,14 @@
-import json
+import os
+import shutil
+import tempfile
 import unittest
 
-from crassus.utils import sqs_send_message
+from crassus import utils
+from crassus.utils import (
+    clear_lambda_config_cache, get_lambda_config, get_lambda_config_property,
+    sqs_send_message)
 from crassus.deployment_response import DeploymentResponse
-from mock import patch
+from mock import Mock, patch
 
 
 class TestSqsSendMessage(unittest.TestCase):
@@ -30,7 +35,123 @@ class TestSqsSendMessage(unittest.TestCase):
     def test_message_is_valid(self):
         message = DeploymentResponse(
             'status', 'message', 'stack_name', 'timestamp', 'emitter')
-        message_json = json.dumps(message)
         sqs_send_message(['123'], message)
         self.mock_aws_sqs.send_message.assert_called_once_with(
-            QueueUrl='123', MessageBody=message_json, DelaySeconds=0)
+            QueueUrl='123', MessageBody=message.to_json(), DelaySeconds=0)
+
+    def test_message_subclass_is_valid(self):
+        class OtherResponse(DeploymentResponse):
+            __slots__ = ()
+
+        message = OtherResponse(
+            'status', 'message', 'stack_name', 'timestamp', 'emitter')
+        sqs_send_message(['123'], message)
+        self.mock_aws_sqs.send_message.assert_called_once_with(
+            QueueUrl='123', MessageBody=message.to_json(), DelaySeconds=0)
+
+
+class TestGetLambdaConfig(unittest.TestCase):
+
+    """
+    Tests for get_lambda_config() and get_lambda_config_property().
+    """
+
+    def setUp(self):
+        self.patch_logger = patch('crassus.utils.logger')
+        self.mock_logger = self.patch_logger.start()
+
+        self.patch_lambda = patch('crassus.utils.aws_lambda')
+        self.mock_aws_lambda = self.patch_lambda.start()
+        self.mock_aws_lambda.get_function_configuration.return_value = {
+            'Description': '{"result_queue": ["QUEUE"], "cfn_events": []}'}
+
+        self.patch_time = patch('crassus.utils.time')
+        self.mock_time = self.patch_time.start()
+        self.mock_time.time.return_value = 1000
+
+        clear_lambda_config_cache()
+        self.context = Mock(invoked_function_arn='any_arn',
+                            function_version='any_version')
+
+    def tearDown(self):
+        self.patch_logger.stop()
+        self.patch_lambda.stop()
+        self.patch_time.stop()
+        clear_lambda_config_cache()
+
+    def test_config_is_decoded(self):
+        self.assertEqual(get_lambda_config(self.context), {
+            'result_queue': ['QUEUE'], 'cfn_events': []})
+        self.mock_aws_lambda.get_function_configuration\
+            .assert_called_once_with(
+                FunctionName='any_arn', Qualifier='any_version')
+
+    def test_config_is_cached_for_all_properties(self):
+        self.assertEqual(
+            get_lambda_config_property(self.context, 'result_queue'),
+            ['QUEUE'])
+        self.assertEqual(
+            get_lambda_config_property(self.context, 'cfn_events'), [])
+        self.assertEqual(
+            self.mock_aws_lambda.get_function_configuration.call_count, 1)
+
+    def test_config_is_cached_per_version(self):
+        get_lambda_config(self.context)
+        get_lambda_config(Mock(invoked_function_arn='any_arn',
+                               function_version='other_version'))
+        self.assertEqual(
+            self.mock_aws_lambda.get_function_configuration.call_count, 2)
+
+    def test_config_is_reloaded_after_ttl(self):
+        get_lambda_config(self.context)
+        self.mock_time.time.return_value = 1299
+        get_lambda_config(self.context)
+        self.assertEqual(
+            self.mock_aws_lambda.get_function_configuration.call_count, 1)
+        self.mock_time.time.return_value = 1300
+        get_lambda_config(self.context)
+        self.assertEqual(
+            self.mock_aws_lambda.get_function_configuration.call_count, 2)
+
+    def test_invalid_config_is_logged_once(self):
+        self.mock_aws_lambda.get_function_configuration.return_value = {
+            'Description': 'NO_SUCH_JSON'}
+        self.assertIsNone(
+            get_lambda_config_property(self.context, 'result_queue'))
+        self.assertIsNone(
+            get_lambda_config_property(self.context, 'cfn_events'))
+        self.assertEqual(self.mock_logger.error.call_count, 1)
+
+
+class TestGetVersion(unittest.TestCase):
+
+    """
+    Tests for _get_VERSION().
+    """
+
+    def setUp(self):
+        self.task_root = tempfile.mkdtemp()
+        with open(os.path.join(self.task_root, 'VERSION'), 'w') as fp:
+            fp.write('42\n')
+        self.patch_environ = patch.dict(
+            'os.environ', {'LAMBDA_TASK_ROOT': self.task_root})
+        self.patch_environ.start()
+        self.patch_version = patch('crassus.utils._VERSION', None)
+        self.patch_version.start()
+
+    def tearDown(self):
+        self.patch_environ.stop()
+        self.patch_version.stop()
+        shutil.rmtree(self.task_root)
+
+    def test_version_from_task_root(self):
+        self.assertEqual(utils._get_VERSION(), 'v42')
+
+    def test_version_is_cached(self):
+        utils._get_VERSION()
+        os.remove(os.path.join(self.task_root, 'VERSION'))
+        self.assertEqual(utils._get_VERSION(), 'v42')
+
+    def test_no_version(self):
+        os.remove(os.path.join(self.task_root, 'VERSION'))
+        self.assertEqual(utils._get_VERSION(), 'NO_VERSION')